@@ -0,0 +1,155 @@
+"""
+Compare the memory usage of the secret read paths.
+
+Writes a large secret to a throwaway vault, then reads it back in a
+fresh child process for each method, reporting the time taken and the
+growth of the peak resident set size caused by the read:
+
+``read_secret``
+    reads the whole file, then decrypts it into a new string
+
+``read_secret_buffer``
+    memory-maps the file and decrypts it into a preallocated
+    ``bytearray``
+
+No GPG keyring is needed: the AES key is passed explicitly.
+
+Usage::
+
+    python benchmarks/read_memory.py --size 256 -o read_memory.json
+"""
+
+import argparse
+import binascii
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from password_manager import PasswordManager, __version__  # noqa
+from password_manager.utils import write_file_atomic  # noqa
+
+METHODS = ('read_secret', 'read_secret_buffer')
+
+
+def maxrss():
+    """Peak RSS of this process, in bytes"""
+
+    # ru_maxrss is inherited across exec() on Linux, so it
+    # would include the parent (which generated the secret).
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024  # kilobytes on Linux
+
+
+def child(basedir, method, key):
+    """Read the secret once, print the measurements as JSON"""
+
+    pm = PasswordManager(basedir, use_index=False)
+    read = getattr(pm, method)
+    # Warm up code paths and imports, so they're not accounted for
+    read('small', key=key)
+
+    before = maxrss()
+    start = default_timer()
+    data = read('large', key=key)
+    elapsed = default_timer() - start
+    after = maxrss()
+
+    sys.stdout.write(json.dumps({
+        'time': elapsed,
+        'size': len(data),
+        'rss_growth': after - before,
+    }))
+
+
+def run_child(basedir, method, key):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--child', method,
+        '--basedir', basedir, '--key', binascii.hexlify(key).decode()])
+    return json.loads(output.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--size', type=int, default=256,
+                        help='Size of the secret, in MiB')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('-o', '--output',
+                        help='Write JSON results to this file '
+                        '(default: standard output)')
+    parser.add_argument('--child', choices=METHODS, help=argparse.SUPPRESS)
+    parser.add_argument('--basedir', help=argparse.SUPPRESS)
+    parser.add_argument('--key', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.basedir, args.child, binascii.unhexlify(args.key))
+        return
+
+    workdir = tempfile.mkdtemp()
+    try:
+        pm = PasswordManager(workdir, use_index=False)
+        key = pm.generate_aes_key()
+        write_file_atomic(pm.get_secret_filename('small'),
+                          pm.aes_encrypt(b'small secret', key=key))
+        size = args.size * 1024 * 1024
+        write_file_atomic(pm.get_secret_filename('large'),
+                          pm.aes_encrypt(os.urandom(size), key=key))
+
+        results = []
+        for method in METHODS:
+            runs = [run_child(workdir, method, key)
+                    for _ in range(args.runs)]
+            runs.sort(key=lambda x: x['time'])
+            result = {
+                'name': method,
+                'size': size,
+                'runs': args.runs,
+                'median_time': runs[len(runs) // 2]['time'],
+                'max_rss_growth': max(x['rss_growth'] for x in runs),
+            }
+            results.append(result)
+            sys.stderr.write('{0:<20} {1:.4f}s  +{2:.1f} MiB peak RSS\n'
+                             .format(method, result['median_time'],
+                                     result['max_rss_growth'] / 1048576.0))
+    finally:
+        shutil.rmtree(workdir)
+
+    output = json.dumps({
+        'meta': {
+            'version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+        },
+        'results': results,
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Benchmarks for the password manager hot paths.
+
+Builds a synthetic vault in a temporary directory, with a throwaway
+GPG keyring (same approach as ``tests/keys/generate.py``), then times
+the main operations and writes the results as JSON, so that they can
+be compared between releases.
+
+Usage::
+
+    python benchmarks/run.py --secrets 1000 --identities 5 -o results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+try:
+    import gnupg
+except ImportError:
+    sys.exit("The benchmarks require python-gnupg: "
+             "pip install -e .[bench]")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from password_manager import PasswordManager, __version__  # noqa
+
+
+def generate_keys(gnupghome, count, key_length=1024):
+    """Generate ``count`` keys in a throwaway keyring"""
+
+    gpg = gnupg.GPG(gnupghome=gnupghome)
+    fingerprints = []
+    for i in range(count):
+        input_data = gpg.gen_key_input(
+            key_type='RSA', key_length=key_length,
+            name_email='bench{0}@example.com'.format(i),
+            no_protection=True)
+        fingerprints.append(gpg.gen_key(input_data).fingerprint)
+    return fingerprints
+
+
+def parse_sizes(value):
+    return [int(x) for x in value.split(',')]
+
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+
+    def measure(self, name, func, repeat=None, setup=None, **params):
+        """Time ``func``, ``repeat`` times, and record the results"""
+
+        if repeat is None:
+            repeat = self.args.repeat
+        timings = []
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = default_timer()
+            func()
+            timings.append(default_timer() - start)
+        timings.sort()
+        result = {
+            'name': name,
+            'params': params,
+            'repeat': repeat,
+            'min': timings[0],
+            'median': timings[len(timings) // 2],
+            'mean': sum(timings) / len(timings),
+            'max': timings[-1],
+        }
+        self.results.append(result)
+        sys.stderr.write('{0:<32} {1:<40} {2:.6f}s\n'.format(
+            name, json.dumps(params, sort_keys=True), result['median']))
+        return result
+
+    def run(self, workdir):
+        args = self.args
+        gnupghome = os.path.join(workdir, 'gnupg')
+        os.makedirs(gnupghome, 0o700)
+
+        sys.stderr.write('Generating {0} keys..\n'.format(
+            args.identities + 1))
+        fingerprints = generate_keys(gnupghome, args.identities + 1)
+        extra_identity = fingerprints.pop()
+
+        pm = PasswordManager(os.path.join(workdir, 'vault'),
+                             gpghome=gnupghome)
+        pm.setup(fingerprints)
+
+        sys.stderr.write('Writing {0} secrets..\n'.format(args.secrets))
+        key = pm.get_aes_key()
+        payload = os.urandom(args.secret_size)
+        for i in range(args.secrets):
+            dirname = 'dir{0:03d}'.format(i % 100)
+            if not os.path.exists(pm.get_secret_filename(dirname)):
+                os.makedirs(pm.get_secret_filename(dirname))
+            pm.write_secret(os.path.join(dirname, 'secret{0}'.format(i)),
+                            payload, key=key)
+
+        common = {'secrets': args.secrets, 'identities': args.identities}
+
+        self.measure('get_aes_key', pm.get_aes_key, setup=pm.forget,
+                     cached=False, **common)
+        self.measure('get_aes_key', pm.get_aes_key, cached=True, **common)
+
+        for size in args.sizes:
+            data = os.urandom(size)
+            encrypted = pm.aes_encrypt(data, key=key)
+            self.measure('aes_encrypt', lambda: pm.aes_encrypt(data, key=key),
+                         size=size)
+            self.measure('aes_decrypt',
+                         lambda: pm.aes_decrypt(encrypted, key=key),
+                         size=size)
+
+        self.measure('list_secrets', lambda: list(pm.list_secrets()),
+                     index=True, **common)
+        pm.use_index = False
+        self.measure('list_secrets', lambda: list(pm.list_secrets()),
+                     index=False, **common)
+        pm.use_index = True
+
+        names = list(pm.list_secrets())
+        self.measure('read_secret (all)',
+                     lambda: [pm.read_secret(x) for x in names],
+                     repeat=1, **common)
+        self.measure('read_all', lambda: list(pm.read_all()),
+                     repeat=1, **common)
+
+        self.measure('add_identity',
+                     lambda: pm.add_identity(extra_identity),
+                     repeat=1, **common)
+
+        # Last, as it changes the whole vault
+        self.measure('regenerate_aes_key', pm.regenerate_aes_key,
+                     repeat=1, **common)
+
+    def report(self):
+        return {
+            'meta': {
+                'version': __version__,
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'args': vars(self.args),
+            },
+            'results': self.results,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--secrets', type=int, default=500,
+                        help='Number of secrets in the vault')
+    parser.add_argument('--identities', type=int, default=3,
+                        help='Number of users of the vault')
+    parser.add_argument('--secret-size', type=int, default=256,
+                        help='Size of the secrets in the vault, in bytes')
+    parser.add_argument('--sizes', type=parse_sizes,
+                        default=[64, 4096, 1024 * 1024],
+                        help='Comma-separated payload sizes for the '
+                        'AES benchmarks')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Times each (fast) operation is repeated')
+    parser.add_argument('-o', '--output',
+                        help='Write JSON results to this file '
+                        '(default: standard output)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        benchmark = Benchmark(args)
+        benchmark.run(workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    output = json.dumps(benchmark.report(), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
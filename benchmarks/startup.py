@@ -0,0 +1,114 @@
+"""
+Measure the start-up time of the command-line interface.
+
+Runs ``password_manager secret get`` repeatedly against a throwaway
+vault, through the fast command path and through the full cliff
+application (``PM_NO_FASTPATH=1``), and compares them with the time
+needed to just start the interpreter and import the package.
+
+Usage::
+
+    python benchmarks/startup.py --runs 20 -o startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from run import generate_keys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from password_manager import PasswordManager, __version__  # noqa
+
+CLI = 'import sys; from password_manager.cli import main; sys.exit(main())'
+
+
+def time_command(argv, runs, env):
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = default_timer()
+            subprocess.check_call(argv, env=env, stdout=devnull)
+            timings.append(default_timer() - start)
+    timings.sort()
+    return {
+        'runs': runs,
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('-o', '--output',
+                        help='Write JSON results to this file '
+                        '(default: standard output)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        gnupghome = os.path.join(workdir, 'gnupg')
+        os.makedirs(gnupghome, 0o700)
+        fingerprints = generate_keys(gnupghome, 1)
+        pm = PasswordManager(os.path.join(workdir, 'vault'),
+                             gpghome=gnupghome)
+        pm.setup(fingerprints)
+        pm.write_secret('example', b'Hello, world!')
+
+        env = dict(os.environ, GNUPGHOME=gnupghome, PM_HOME=pm.basedir,
+                   PYTHONPATH=ROOT)
+        env.pop('PM_AGENT_SOCK', None)
+        env.pop('PM_NO_FASTPATH', None)
+        slow_env = dict(env, PM_NO_FASTPATH='1')
+
+        cases = [
+            ('interpreter', [sys.executable, '-c', 'pass'], env),
+            ('import', [sys.executable, '-c', 'import password_manager'],
+             env),
+            ('secret get (fast path)',
+             [sys.executable, '-c', CLI, 'secret', 'get', 'example'], env),
+            ('secret get (cliff)',
+             [sys.executable, '-c', CLI, 'secret', 'get', 'example'],
+             slow_env),
+        ]
+
+        results = []
+        for name, argv, case_env in cases:
+            result = time_command(argv, args.runs, case_env)
+            result['name'] = name
+            results.append(result)
+            sys.stderr.write('{0:<24} {1:.4f}s\n'.format(
+                name, result['median']))
+    finally:
+        shutil.rmtree(workdir)
+
+    output = json.dumps({
+        'meta': {
+            'version': __version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+        },
+        'results': results,
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,14 +5,22 @@ Manages encrypted passwords in a directory, using GPG + AES
 to encrypt them for multiple users.
 """
 
+import hashlib
+import hmac
 import json
 import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 from io import BytesIO
 
-# import gnupg
-import gpgme
-from Crypto.Cipher import AES
-from Crypto import Random
+# Note: gpgme, Crypto and multiprocessing are imported when first
+# needed, to keep the start-up time of command-line tools down.
+
+from password_manager.context_pool import default_pool
+from password_manager.instrumentation import instrumented
+from password_manager.keyring_cache import KeyringCache, get_gpghome
 
 # Keep in sync with setup.py
 __version__ = '0.1a'
@@ -22,19 +30,248 @@ class PasswordManagerException(Exception):
     pass
 
 
+# Outcome of reading a single secret in a bulk operation.
+# Exactly one of ``secret`` and ``error`` is set.
+SecretResult = namedtuple('SecretResult', 'name,secret,error')
+
+# Directory keeping the AES key files of a vault, or of a key scope
+KEYS_DIRNAME = '.keys'
+
+# Vault settings (stored in .keys/config.json) and their defaults
+CONFIG_OPTIONS = {
+    'deterministic_iv': False,
+    'storage': 'directory',
+}
+
+
+def aes_key_id(aes_key):
+    """
+    Get an identifier for an AES key.
+
+    The identifier is derived from the key with HMAC, so it can be
+    stored in the clear and used to tell keys apart.
+    """
+
+    return hmac.new(aes_key, b'password-manager aes key id',
+                    hashlib.sha256).hexdigest()[:16]
+
+
+def _encryption_subkey_fpr(key):
+    """
+    Fingerprint of the sub-key GnuPG will encrypt to
+    (the most recent one that is usable for encryption).
+    """
+
+    usable = [sk for sk in key.subkeys
+              if getattr(sk, 'can_encrypt', True) and
+              not (sk.revoked or sk.expired or sk.disabled or sk.invalid)]
+    if not usable:
+        return None
+    return usable[-1].fpr
+
+
+def _match_gpg_key(keys, name):
+    """Find the key matching a fingerprint, key id or user id"""
+
+    upper = name.upper()
+    if upper.startswith('0X'):
+        upper = upper[2:]
+    is_hex = len(upper) >= 8 and all(c in '0123456789ABCDEF' for c in upper)
+    if is_hex:
+        for key in keys:
+            if any(sk.fpr.upper().endswith(upper) for sk in key.subkeys):
+                return key
+    for key in keys:
+        if any(name in (uid.uid or '') for uid in key.uids):
+            return key
+    return None
+
+
 class PasswordManager(object):
-    def __init__(self, basedir, gpghome=None):
+    def __init__(self, basedir, gpghome=None, key_cache_ttl=300,
+                 context_pool=None, use_index=True, deterministic_iv=None,
+                 keyring_cache_size=256, storage=None):
+        """
+        :param basedir: directory containing the secrets
+        :param gpghome: GnuPG home directory (defaults to GNUPGHOME)
+        :param key_cache_ttl:
+            number of seconds the decrypted AES key is kept in
+            memory after being unwrapped. Use ``0`` to disable caching.
+        :param context_pool:
+            :py:class:`~password_manager.context_pool.ContextPool` used
+            to obtain gpgme contexts (defaults to a shared pool)
+        :param use_index:
+            keep track of the secret files in an index
+            (see :py:mod:`password_manager.index`), instead of
+            walking the whole directory to list them.
+        :param deterministic_iv:
+            derive the encryption nonce from the contents of each
+            secret, so that unchanged secrets are always encrypted
+            to the same file (see :py:mod:`password_manager.fileformat`).
+            Defaults to the ``deterministic_iv`` setting of the vault
+            (see :py:meth:`read_config`).
+        :param keyring_cache_size:
+            number of GnuPG keys whose metadata is kept in memory
+            (see :py:mod:`password_manager.keyring_cache`).
+            Use ``0`` to disable caching.
+        :param storage:
+            name of the storage backend for the secrets, or a
+            :py:class:`~password_manager.storage.SecretStorage`
+            instance.  Defaults to the ``storage`` setting of the
+            vault (see :py:mod:`password_manager.storage`).
+        """
         self.basedir = basedir
         self.gpghome = gpghome
+        self.key_cache_ttl = key_cache_ttl
+        self._aes_key_cache = None
+        self._aes_key_cache_lock = threading.Lock()
+        if context_pool is None:
+            context_pool = default_pool
+        self.context_pool = context_pool
+        self._gpg = None
+        self.use_index = use_index
+        self._index = None
+        self._search_index = None
+        self._storage = storage
+        self._deterministic_iv = deterministic_iv
+        self._config_cache = None
+        self.keyring_cache = KeyringCache(gpghome,
+                                          max_size=keyring_cache_size)
+        self._scopes = {}
+        self._scopes_lock = threading.Lock()
+        self._parent = None  # For key scopes
+        self._batch_depth = 0
 
     @property
     def keydir(self):
-        return os.path.join(self.basedir, '.keys')
+        return os.path.join(self.basedir, KEYS_DIRNAME)
+
+    @property
+    def index(self):
+        """
+        The :py:class:`~password_manager.index.SecretIndex`, or ``None``
+        if disabled or the directory was not set up yet.
+        """
+        if not self.use_index or not os.path.isdir(self.keydir):
+            return None
+        if self._index is None:
+            from password_manager.index import SecretIndex
+            self._index = SecretIndex(self)
+        return self._index
+
+    @property
+    def storage(self):
+        """
+        The :py:class:`~password_manager.storage.SecretStorage`
+        keeping the encrypted secrets
+        """
+        from password_manager.storage import SecretStorage, get_storage
+
+        if not isinstance(self._storage, SecretStorage):
+            name = self._storage or self.read_config().get(
+                'storage', CONFIG_OPTIONS['storage'])
+            self._storage = get_storage(name, self)
+        return self._storage
+
+    def migrate_storage(self, name):
+        """
+        Move all the secrets to another storage backend, and make
+        it the default for the vault.
+
+        Secrets are copied first, then the setting is changed, then
+        the originals are deleted: if interrupted, nothing is lost.
+        The old storage is compacted afterwards.
+
+        :return: the number of secrets moved
+        """
+
+        from password_manager.storage import get_storage
+
+        source = self.storage
+        if source.name == name:
+            return 0
+        target = get_storage(name, self)
+        names = sorted(source.list())
+        for secret in names:
+            target.write(secret, source.read(secret))
+        self.write_config(storage=name)
+        self._storage = target
+        for secret in names:
+            source.delete(secret)
+        source.compact()
+        return len(names)
+
+    @property
+    def search_index(self):
+        """
+        The :py:class:`~password_manager.search.SearchIndex`, or
+        ``None`` if the directory was not set up yet.
+        """
+        if not os.path.isdir(self.keydir):
+            return None
+        if self._search_index is None:
+            from password_manager.search import SearchIndex
+            self._search_index = SearchIndex(self)
+        return self._search_index
+
+    @property
+    def deterministic_iv(self):
+        if self._deterministic_iv is not None:
+            return self._deterministic_iv
+        return bool(self.read_config().get('deterministic_iv', False))
+
+    def read_config(self):
+        """
+        Read the vault settings, shared by all the users.
+
+        The file is parsed again only when it changes (it is read
+        for every encryption, see :py:attr:`deterministic_iv`).
+
+        :return: dict of settings (see :py:data:`CONFIG_OPTIONS`)
+        """
+
+        filename = self.get_config_filename()
+        try:
+            st = os.stat(filename)
+            file_id = (st.st_dev, st.st_ino, st.st_size,
+                       st.st_mtime, st.st_ctime)
+            cached = self._config_cache
+            if cached is None or cached[0] != file_id:
+                with open(filename, 'rb') as fp:
+                    config = json.loads(fp.read().decode('utf-8'))
+                cached = self._config_cache = (file_id, config)
+        except (IOError, OSError):
+            return {}
+        return dict(cached[1])
+
+    def write_config(self, **settings):
+        """Update the vault settings"""
+
+        from password_manager.utils import write_file_atomic
+
+        for name in settings:
+            if name not in CONFIG_OPTIONS:
+                raise ValueError("Unknown setting: {0}".format(name))
+        config = self.read_config()
+        config.update(settings)
+        write_file_atomic(self.get_config_filename(),
+                          json.dumps(config, indent=4, sort_keys=True)
+                          .encode('utf-8'))
 
     @property
     def gpg(self):
-        # todo: cache on a per-gpghome basis?
-        return self._get_gpg()
+        """
+        A gpgme context for our gpghome, dedicated to this instance
+        (not taken from the pool, which stays available to the other
+        operations).  Not thread-safe: prefer :py:meth:`gpg_context`.
+        """
+        if self._gpg is None:
+            self._gpg = self.context_pool.create(self.gpghome)
+        return self._gpg
+
+    def gpg_context(self):
+        """Context manager checking out a pooled gpgme context"""
+        return self.context_pool.context(self.gpghome)
 
     def setup(self, identities):
         """
@@ -46,7 +283,7 @@ class PasswordManager(object):
             we want to encrypt the AES key.
         """
 
-        identities = [self.get_key_fingerprint(x) for x in identities]
+        keys = self.resolve_gpg_keys(identities)
 
         if os.path.exists(self.basedir) and len(os.listdir(self.basedir)) > 0:
             raise ValueError("Destination directory not empty")
@@ -54,10 +291,7 @@ class PasswordManager(object):
         os.makedirs(self.keydir)
 
         aes_key = self.generate_aes_key()
-
-        for identity in identities:
-            self.write_aes_key(aes_key, identity)
-            self.store_gpg_pubkey(identity)
+        self._write_identities(aes_key, keys)
 
         # Just to try things, let's create a new encrypted file..
         hello = json.dumps({'username': 'Hello', 'password': 'Word'})
@@ -79,10 +313,89 @@ class PasswordManager(object):
         #       a private key, we risk trying to decrypt it with
         #       the wrong key!
 
-        identity = self.get_key_fingerprint(identity)
+        self.add_identities([identity])
+
+    def add_identities(self, identities, max_workers=8):
+        """
+        Create many users at once.
+
+        Keys are looked up in a single keyring listing and exported
+        in a single pass, the AES key is encrypted for the users in
+        parallel and all the files in ``.keys`` are renamed in place
+        only once everything succeeded.
+        """
+
+        keys = self.resolve_gpg_keys(identities)
         aes_key = self.get_aes_key()
-        self.write_aes_key(aes_key, identity)
-        self.store_gpg_pubkey(identity)
+        self._write_identities(aes_key, keys, max_workers=max_workers)
+
+    def _write_identities(self, aes_key, keys, max_workers=8,
+                          export_pubkeys=True):
+        """
+        Write the encrypted AES key and public key of many users.
+
+        :param keys: dict mapping fingerprints to gpgme keys
+        :param export_pubkeys:
+            also store the public keys; otherwise, the ones
+            already in the keys directory are kept.
+        """
+
+        from multiprocessing.pool import ThreadPool
+        from password_manager.openpgp import split_keys
+
+        fingerprints = sorted(keys)
+        if not fingerprints:
+            return
+
+        staged = []  # (temporary, final) file names
+
+        def _stage(filename, data):
+            tmpname = os.path.join(
+                os.path.dirname(filename),
+                '.{0}.tmp'.format(os.path.basename(filename)))
+            with open(tmpname, 'wb') as fp:
+                fp.write(data)
+            staged.append((tmpname, filename))
+
+        def _encrypt(fpr):
+            with self.gpg_context() as gpg:
+                return fpr, self._encrypt_aes_key(gpg, keys[fpr], aes_key)
+
+        try:
+            if export_pubkeys:
+                with self.gpg_context() as gpg:
+                    exported = BytesIO()
+                    gpg.export(fingerprints, exported)
+                pubkeys = split_keys(exported.getvalue())
+            else:
+                pubkeys = {}
+                for fpr in fingerprints:
+                    with open(self.get_gpg_pubkey_filename(fpr), 'rb') as fp:
+                        pubkeys[fpr] = fp.read()
+
+            pool = ThreadPool(max(1, min(max_workers, len(fingerprints))))
+            try:
+                for fpr, data in pool.imap_unordered(_encrypt, fingerprints):
+                    _stage(self.get_aes_key_filename(fpr), data)
+                    meta = self._make_aes_key_meta(
+                        keys[fpr], aes_key, data, pubkeys[fpr])
+                    _stage(self.get_aes_key_meta_filename(fpr), meta)
+            finally:
+                pool.terminate()
+
+            if export_pubkeys:
+                for fpr in fingerprints:
+                    _stage(self.get_gpg_pubkey_filename(fpr), pubkeys[fpr])
+
+        except Exception:
+            for tmpname, filename in staged:
+                os.unlink(tmpname)
+            raise
+
+        for fpr in fingerprints:
+            self._invalidate_aes_key(fpr)
+        for tmpname, filename in staged:
+            os.rename(tmpname, filename)
 
     def list_identities(self):
         """List GPG fingerprints for the configured users"""
@@ -94,99 +407,346 @@ class PasswordManager(object):
                 yield name[:-4]
 
     def remove_identity(self, identity):
+        """
+        Remove a user, and change the AES key to one they never had.
+
+        The key is changed first: if that fails, the user is left
+        in place (and the operation can be retried).
+        """
+
+        from password_manager.rotation import KeyRotation
+
         identity = self.get_key_fingerprint(identity)
+        rotation = KeyRotation(self)
+        if rotation.in_progress():
+            rotation.resume()
+        rotation.start(identities=[
+            x for x in self.list_identities() if x != identity])
+        rotation.resume()
+
+        self._invalidate_aes_key(identity)
         os.unlink(self.get_aes_key_filename(identity))
         os.unlink(self.get_gpg_pubkey_filename(identity))
-        self.regenerate_aes_key()
+        if os.path.exists(self.get_aes_key_meta_filename(identity)):
+            os.unlink(self.get_aes_key_meta_filename(identity))
 
     # ----------------------------------------------------------------------
     #   Symmetric encryption operations
 
+    @instrumented('get_aes_key')
     def get_aes_key(self, identity=None):
-        """Get the AES key, decrypted using GPG"""
+        """
+        Get the AES key, decrypted using GPG.
+
+        The decrypted key is cached for ``key_cache_ttl`` seconds;
+        the cache is invalidated as soon as the ``.key`` file changes.
+        """
+
+        cached = self._get_cached_aes_key(identity)
+        if cached is not None:
+            return cached
 
         if identity is None:
-            # Figure out one key we own..
-            # todo: we might also want to try *all* our keys..?
-            our_keys = set(self.list_gpg_privkeys())
-            user_keys = set(self.list_identities())
-            common_keys = our_keys.intersection(user_keys)
-            if len(common_keys) < 1:
-                raise PasswordManagerException(
-                    "Unable to find a key for decryption!")
-            identity = common_keys.pop()
-
-        return self.read_aes_key(identity)
+            identity = self.get_own_identity()
+
+            # We might have a cached key for the identity we just found
+            cached = self._get_cached_aes_key(identity)
+            if cached is not None:
+                return cached
+
+        aes_key = self.read_aes_key(identity)
+        self._set_cached_aes_key(identity, aes_key)
+        return aes_key
+
+    @instrumented('get_own_identity')
+    def get_own_identity(self):
+        """Figure out one of the configured identities we own a key for"""
+
+        # todo: we might also want to try *all* our keys..?
+        our_keys = set(self.list_gpg_privkeys())
+        user_keys = set(self.list_identities())
+        common_keys = our_keys.intersection(user_keys)
+        if len(common_keys) < 1:
+            raise PasswordManagerException(
+                "Unable to find a key for decryption!")
+        return common_keys.pop()
+
+    def forget(self):
+        """Wipe the cached AES key from memory"""
+
+        with self._aes_key_cache_lock:
+            self._clear_aes_key_cache()
+
+    def _clear_aes_key_cache(self):
+        if self._aes_key_cache is not None:
+            buf = self._aes_key_cache[2]
+            for i in range(len(buf)):
+                buf[i] = 0
+            self._aes_key_cache = None
+
+    def _get_aes_key_file_id(self, identity):
+        """
+        Identify the current version of an encrypted key file,
+        so we can tell when the cached key is stale.
+        """
+
+        st = os.stat(self.get_aes_key_filename(identity))
+        return (identity, st.st_dev, st.st_ino, st.st_size,
+                st.st_mtime, st.st_ctime)
+
+    def _get_cached_aes_key(self, identity=None):
+        if not self.key_cache_ttl:
+            return None
+
+        with self._aes_key_cache_lock:
+            if self._aes_key_cache is None:
+                return None
+
+            file_id, expires, buf = self._aes_key_cache
+            if identity is not None and file_id[0] != identity:
+                return None
+
+            if time.time() >= expires:
+                self._clear_aes_key_cache()
+                return None
+
+            try:
+                current_id = self._get_aes_key_file_id(file_id[0])
+            except OSError:
+                current_id = None
+            if current_id != file_id:
+                self._clear_aes_key_cache()
+                return None
+
+            return bytes(buf)
+
+    def _set_cached_aes_key(self, identity, aes_key):
+        if not self.key_cache_ttl:
+            return
+
+        with self._aes_key_cache_lock:
+            self._clear_aes_key_cache()
+            try:
+                file_id = self._get_aes_key_file_id(identity)
+            except OSError:
+                return
+            expires = time.time() + self.key_cache_ttl
+            self._aes_key_cache = (file_id, expires, bytearray(aes_key))
+
+    def _invalidate_aes_key(self, identity=None):
+        """Drop the cached key, if it was read for ``identity``"""
+
+        with self._aes_key_cache_lock:
+            if self._aes_key_cache is None:
+                return
+            if identity is None or self._aes_key_cache[0][0] == identity:
+                self._clear_aes_key_cache()
 
     def generate_aes_key(self, keysize=32):
         """Generate a new random AES key"""
 
+        from Crypto import Random
         return Random.new().read(keysize)
 
-    def read_aes_key(self, identity):
-        """Read the AES key, using the selected identity"""
+    @instrumented('read_aes_key')
+    def read_aes_key(self, identity, filename=None):
+        """
+        Read the AES key, using the selected identity
+
+        :param filename:
+            read the encrypted key from this file, instead
+            of the one in the keys directory
+        """
+
+        if filename is None:
+            filename = self.get_aes_key_filename(identity)
 
         _io = BytesIO()
-        gpg = self._get_gpg()
-        with open(self.get_aes_key_filename(identity), 'rb') as fp:
+        with self.gpg_context() as gpg, open(filename, 'rb') as fp:
             gpg.decrypt(fp, _io)
         return _io.getvalue()
 
-    def write_aes_key(self, aes_key, identity):
-        """Store the AES key, encrypted for a given identity"""
+    @instrumented('write_aes_key')
+    def write_aes_key(self, aes_key, identity, filename=None):
+        """
+        Store the AES key, encrypted for a given identity
+
+        :param filename:
+            write the encrypted key to this file, instead
+            of the one in the keys directory
+        """
+
+        if filename is None:
+            filename = self.get_aes_key_filename(identity)
+
+            # The file might get rewritten within the mtime granularity
+            self._invalidate_aes_key(identity)
+
+        with self.gpg_context() as gpg:
+            key = gpg.get_key(identity)
+            data = self._encrypt_aes_key(gpg, key, aes_key)
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+
+        try:
+            with open(self.get_gpg_pubkey_filename(identity), 'rb') as fp:
+                pubkey = fp.read()
+        except IOError:
+            pubkey = None  # Not stored yet
+        meta = self._make_aes_key_meta(key, aes_key, data, pubkey)
+        with open(_meta_filename(filename), 'wb') as fp:
+            fp.write(meta)
+
+    def _make_aes_key_meta(self, key, aes_key, encrypted, pubkey):
+        """
+        Describe an encrypted AES key file, so that we can
+        later tell whether it needs to be re-encrypted.
+        """
+
+        meta = {
+            'aes_key_id': aes_key_id(aes_key),
+            'recipient': _encryption_subkey_fpr(key),
+            'key_sha256': hashlib.sha256(encrypted).hexdigest(),
+            'pubkey_sha256': (hashlib.sha256(pubkey).hexdigest()
+                              if pubkey is not None else None),
+        }
+        return json.dumps(meta, indent=4, sort_keys=True).encode('utf-8')
+
+    def read_aes_key_meta(self, identity):
+        """
+        :return:
+            the metadata recorded when the AES key was encrypted
+            for ``identity``, or ``None``
+        """
+
+        try:
+            with open(self.get_aes_key_meta_filename(identity), 'rb') as fp:
+                return json.loads(fp.read().decode('utf-8'))
+        except (IOError, ValueError):
+            return None
+
+    def recrypt_aes_key(self, force=False, max_workers=8):
+        """
+        Re-encrypt the AES key for all the users.
+
+        The key is decrypted once, then encrypted again in parallel
+        for all the identities whose key file is not current, that is:
+        the file was changed since we wrote it, it contains a different
+        AES key, or the identity public key (or its encryption
+        sub-key) changed.
 
-        gpg = self._get_gpg()
-        key = gpg.get_key(identity)
+        :param force: re-encrypt for all the identities
+        :return: dict with ``rewritten`` and ``skipped`` identities
+        """
+
+        aes_key = self.get_aes_key()
+        current_id = aes_key_id(aes_key)
+        identities = sorted(self.list_identities())
+        keys = self.resolve_gpg_keys(identities)
+
+        rewrite = {}
+        skipped = []
+        for identity in identities:
+            key = keys[identity]
+            if not force and self._is_aes_key_current(
+                    identity, key, current_id):
+                skipped.append(identity)
+            else:
+                rewrite[identity] = key
+
+        self._write_identities(aes_key, rewrite, max_workers=max_workers,
+                               export_pubkeys=False)
+        return {'rewritten': sorted(rewrite), 'skipped': skipped}
+
+    def _is_aes_key_current(self, identity, key, current_id):
+        meta = self.read_aes_key_meta(identity)
+        if meta is None:
+            return False
+        if meta.get('aes_key_id') != current_id:
+            return False
+        if meta.get('recipient') != _encryption_subkey_fpr(key):
+            return False
+        for filename, field in [
+                (self.get_aes_key_filename(identity), 'key_sha256'),
+                (self.get_gpg_pubkey_filename(identity), 'pubkey_sha256')]:
+            try:
+                with open(filename, 'rb') as fp:
+                    digest = hashlib.sha256(fp.read()).hexdigest()
+            except IOError:
+                return False
+            if meta.get(field) != digest:
+                return False
+        return True
+
+    def _encrypt_aes_key(self, gpg, key, aes_key):
+        import gpgme
 
         # todo: tell the user to trust more people!
         flags = gpgme.ENCRYPT_ALWAYS_TRUST
 
-        with open(self.get_aes_key_filename(identity), 'wb') as fp:
-            gpg.encrypt([key], flags, BytesIO(aes_key), fp)
+        encrypted = BytesIO()
+        gpg.encrypt([key], flags, BytesIO(aes_key), encrypted)
+        return encrypted.getvalue()
 
-    def regenerate_aes_key(self):
+    def regenerate_aes_key(self, max_workers=8):
         """
         Generate a new AES key.
 
         - update encrypted key for all the configured pubkeys
         - decrypt all entries with the old key, recrypt with the new one
 
-        .. warning::
-
-            The old key is kept in memory during the process,
-            if something goes wrong in the meanwhile, there is a high
-            risk password entries would be corrupted.
-
-            But we assume the directory is under version control,
-            so you can just revert the changes and restart..
+        New files are written aside the existing ones and swapped in
+        only at the end; if the process gets interrupted, calling this
+        method again will resume the pending rotation.
+        See :py:class:`~password_manager.rotation.KeyRotation`.
         """
 
-        old_aes_key = self.get_aes_key()
-        new_aes_key = self.generate_aes_key()
+        from password_manager.rotation import KeyRotation
+        KeyRotation(self, max_workers=max_workers).run()
 
-        for identity in self.list_identities():
-            self.write_aes_key(new_aes_key, identity)
+    @instrumented('aes_encrypt')
+    def aes_encrypt(self, data, key=None, deterministic=None):
+        """
+        Encrypt a secret (see :py:mod:`password_manager.fileformat`)
 
-        for secret in self.list_secrets():
-            secret_data = self.read_secret(secret, key=old_aes_key)
-            self.write_secret(secret, secret_data, key=new_aes_key)
+        :param deterministic:
+            use a synthetic nonce; defaults to :py:attr:`deterministic_iv`
+        """
 
-        # todo: now iterate all the password files and recrypt them
+        from password_manager import fileformat
 
-    def aes_encrypt(self, data, key=None):
         if isinstance(data, unicode):
             data = data.encode('utf-8')
         if key is None:
             key = self.get_aes_key()
-        iv = Random.new().read(AES.block_size)
-        cipher = AES.new(key, AES.MODE_CFB, iv)
-        return iv + cipher.encrypt(data)
+        if deterministic is None:
+            deterministic = self.deterministic_iv
+        return fileformat.encrypt(key, data, deterministic=deterministic)
 
+    @instrumented('aes_decrypt')
     def aes_decrypt(self, data, key=None):
+        """
+        Decrypt a secret, in the current or legacy format.
+
+        :raises password_manager.fileformat.WrongKeyError:
+            if the secret was encrypted with a different key
+        :raises password_manager.fileformat.SecretFormatError:
+            if the secret is corrupt
+        """
+
+        from password_manager import fileformat
+        from password_manager.utils import buffer_view
+
         if key is None:
             key = self.get_aes_key()
+        if fileformat.parse_header(data) is not None:
+            return fileformat.decrypt(key, data)
+
+        from Crypto.Cipher import AES
+
         enc_iv = data[:AES.block_size]
-        enc_msg = data[AES.block_size:]
+        # Don't copy the whole message just to skip the IV
+        enc_msg = buffer_view(data, AES.block_size, len(data))
         cipher = AES.new(key, AES.MODE_CFB, enc_iv)
         return cipher.decrypt(enc_msg)
 
@@ -195,13 +755,59 @@ class PasswordManager(object):
 
     def _get_gpg(self):
         """
-        Get a gpgme Context instance, with correct gnupghome set
+        Get a new (non-pooled) gpgme Context instance,
+        with correct gnupghome set
+        """
+
+        return self.context_pool.create(self.gpghome)
+
+    def get_gpg_key(self, name):
+        """Get a gpgme key object from our keyring"""
+
+        key = self.keyring_cache.get(name)
+        if key is None:
+            key = self._get_gpg_key(name)
+            self.keyring_cache.put(name, key)
+        return key
+
+    @instrumented('gpg.get_key')
+    def _get_gpg_key(self, name):
+        with self.gpg_context() as gpg:
+            return gpg.get_key(name)
+
+    def resolve_gpg_keys(self, names):
+        """
+        Look up many keys with a single keyring listing.
+
+        Keys found in the :py:attr:`keyring_cache` are not listed again.
+
+        :param names: key fingerprints, ids, or identity names
+        :return: dict mapping (main sub-key) fingerprints to gpgme keys
         """
 
-        ctx = gpgme.Context()
-        if self.gpghome is not None:
-            ctx.set_engine_info(gpgme.PROTOCOL_OpenPGP, None, self.gpghome)
-        return ctx
+        names = list(names)
+        cached = dict((name, self.keyring_cache.get(name)) for name in names)
+        missing = [name for name in names if cached[name] is None]
+        found = self._list_gpg_keys(missing) if missing else []
+
+        keys = {}
+        for name in names:
+            key = cached[name]
+            if key is None:
+                key = _match_gpg_key(found, name)
+                if key is None:
+                    # Let gpgme figure it out (and raise a proper error)
+                    key = self.get_gpg_key(name)
+                self.keyring_cache.put(name, key)
+            keys[key.subkeys[0].fpr] = key
+        return keys
+
+    @instrumented('gpg.keylist')
+    def _list_gpg_keys(self, patterns=None, secret=False):
+        with self.gpg_context() as gpg:
+            if patterns is None:
+                return list(gpg.keylist('', secret))
+            return list(gpg.keylist(patterns, secret))
 
     def get_key_fingerprint(self, name):
         """
@@ -210,70 +816,528 @@ class PasswordManager(object):
         :param name: either key fingerprint, id, or identity name
         """
 
-        gpg = self._get_gpg()
-        key = gpg.get_key(name)
+        key = self.get_gpg_key(name)
         # Return fingerprint of the first (main) sub-key
         return key.subkeys[0].fpr
 
     def list_gpg_privkeys(self):
         """List fingerprints of our private GPG keys"""
 
-        for key in self._get_gpg().keylist('', True):
-            yield key.subkeys[0].fpr
+        return iter([key.subkeys[0].fpr
+                     for key in self._get_keyring_listing(secret=True)])
 
     def list_gpg_pubkeys(self):
         """List fingerprints of public keys in our keyring"""
 
-        for key in self._get_gpg().keylist():
-            yield key.subkeys[0].fpr
+        return iter([key.subkeys[0].fpr
+                     for key in self._get_keyring_listing()])
+
+    def _get_keyring_listing(self, secret=False):
+        keys = self.keyring_cache.get_listing(secret)
+        if keys is None:
+            keys = self._list_gpg_keys(secret=secret)
+            self.keyring_cache.put_listing(keys, secret)
+        return keys
 
     def store_gpg_pubkey(self, identity):
         """Export a GPG public key"""
 
         identity = self.get_key_fingerprint(identity)
-        gpg = self._get_gpg()
-        with open(self.get_gpg_pubkey_filename(identity), 'wb') as fp:
+        with self.gpg_context() as gpg, \
+                open(self.get_gpg_pubkey_filename(identity), 'wb') as fp:
             gpg.export(identity, fp)
 
-    def import_all_pubkeys(self):
-        # todo: do this in a better way!
-        gpg = self._get_gpg()
-        for identity in self.list_identities():
-            pubkeyfile = self.get_gpg_pubkey_filename(identity)
-            with open(pubkeyfile, 'rb') as fp:
-                gpg.import_(fp)
+    def read_gpg_pubkey(self, identity):
+        """
+        Read fingerprints and user ids from the public key file of
+        a user, without importing it in the keyring.
+
+        :return: a :py:class:`password_manager.openpgp.PublicKey`
+        :raises password_manager.openpgp.OpenPGPError:
+            if the file can't be parsed
+        """
+
+        from password_manager.openpgp import OpenPGPError, parse_keys
+
+        with open(self.get_gpg_pubkey_filename(identity), 'rb') as fp:
+            keys = parse_keys(fp.read())
+        for key in keys:
+            if key.fpr == identity:
+                return key
+        raise OpenPGPError("{0}.pub doesn't contain key {0}"
+                           .format(identity))
+
+    @instrumented('gpg.import')
+    def import_all_pubkeys(self, force=False):
+        """
+        Import the public keys of all the users in our keyring.
+
+        Only the keys missing from the keyring, or whose ``.pub`` file
+        changed since we last imported it, are imported, in a single
+        batch.  What was imported is recorded, per GnuPG home, in
+        ``.keys/.imported`` (local state, not to be committed).
+
+        :param force: import all the keys
+        :return: fingerprints of the imported keys
+        """
+
+        from password_manager.openpgp import dearmor
+
+        gpghome = os.path.abspath(get_gpghome(self.gpghome))
+        state = self._read_import_state()
+        imported = state.get(gpghome, {})
+        in_keyring = set(self.list_gpg_pubkeys())
+
+        todo = []
+        for identity in sorted(self.list_identities()):
+            with open(self.get_gpg_pubkey_filename(identity), 'rb') as fp:
+                data = fp.read()
+            digest = hashlib.sha256(data).hexdigest()
+            if (force or identity not in in_keyring or
+                    imported.get(identity) != digest):
+                todo.append((identity, data))
+                imported[identity] = digest
+
+        if todo:
+            with self.gpg_context() as gpg:
+                gpg.import_(BytesIO(b''.join(dearmor(data)
+                                             for _, data in todo)))
+            self.keyring_cache.clear()
+
+        state[gpghome] = imported
+        self._write_import_state(state)
+        return [identity for identity, _ in todo]
+
+    def _read_import_state(self):
+        try:
+            with open(self.get_import_state_filename(), 'rb') as fp:
+                state = json.loads(fp.read().decode('utf-8'))
+        except (IOError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _write_import_state(self, state):
+        from password_manager.utils import ensure_gitignored, write_file_atomic
+
+        ensure_gitignored(self.keydir, ['/.imported'])
+        write_file_atomic(self.get_import_state_filename(),
+                          json.dumps(state, indent=4, sort_keys=True)
+                          .encode('utf-8'))
 
     # ----------------------------------------------------------------------
     #   High-level operations
 
+    @instrumented('read_secret')
     def read_secret(self, name, key=None):
-        name = self.get_secret_filename(name)
-        with open(name, 'rb') as f:
-            raw_secret = self.aes_decrypt(f.read(), key=key)
-        return raw_secret
+        scope, name = self._scoped(name)
+        if scope is not self:
+            return scope.read_secret(name, key=self._scope_key(scope, key))
+        data = self.storage.read(self._secret_name(name))
+        return self.aes_decrypt(data, key=key)
+
+    def read_secret_buffer(self, name, key=None):
+        """
+        Read a secret into a new ``bytearray``.
+
+        The secret is memory-mapped and decrypted in chunks straight
+        into the (preallocated) output buffer, so the ciphertext is
+        never copied in memory; use this to read large secrets.
+        The returned buffer can be wiped after use.
+        """
+
+        from password_manager.fileformat import parse_header, plaintext_size
+        from password_manager.streams import decrypt_into
+
+        scope, name = self._scoped(name)
+        if scope is not self:
+            return scope.read_secret_buffer(
+                name, key=self._scope_key(scope, key))
+        if key is None:
+            key = self.get_aes_key()
+        with self.storage.map(self._secret_name(name)) as data:
+            if not len(data):
+                return bytearray(self.aes_decrypt(b'', key=key))
+            header = parse_header(data)
+            output = bytearray(plaintext_size(len(data), header))
+            decrypt_into(key, data, output)
+        return output
+
+    def read_secret_header(self, name):
+        """
+        Read just the header of a secret file.
+
+        :return:
+            a :py:class:`~password_manager.fileformat.SecretHeader`,
+            or ``None`` if the secret is in the legacy format
+        """
+
+        from password_manager.fileformat import parse_header, HEADER_SIZE
+
+        scope, name = self._scoped(name)
+        if scope is not self:
+            return scope.read_secret_header(name)
+        return parse_header(
+            self.storage.read_header(self._secret_name(name), HEADER_SIZE))
 
+    @instrumented('write_secret')
     def write_secret(self, name, secret, key=None):
-        name = self.get_secret_filename(name)
-        with open(name, 'wb') as f:
-            f.write(self.aes_encrypt(secret, key=key))
+        """
+        Encrypt and store a secret.
+
+        If the secret file already contains the same data, encrypted
+        with the same key, it is left untouched.
+
+        :return: whether the file was written
+        """
+
+        scope, name = self._scoped(name)
+        if scope is not self:
+            return scope.write_secret(
+                name, secret, key=self._scope_key(scope, key))
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        if key is None:
+            key = self.get_aes_key()
+        name = self._secret_name(name)
+        encrypted = self.aes_encrypt(secret, key=key)
+        if self._is_unchanged(name, secret, encrypted, key):
+            return False
+        self.storage.write(name, encrypted)
+        self._update_search_index(name, secret)
+        return True
+
+    def _is_unchanged(self, name, secret, encrypted, key):
+        """Whether secret ``name`` already contains ``secret``"""
+
+        from password_manager import fileformat
+
+        try:
+            existing = self.storage.read(name)
+        except IOError:
+            return False
+        if existing == encrypted:
+            return True  # Deterministic nonce
+
+        try:
+            header = fileformat.parse_header(existing)
+            if header is None or header.key_id != aes_key_id(key):
+                return False  # Rewrite legacy and stale files
+            return fileformat.decrypt(key, existing) == secret
+        except fileformat.SecretFormatError:
+            return False
+
+    def open_secret(self, name, mode='rb', key=None):
+        """
+        Open a secret for streaming.
+
+        :param mode: either ``'rb'`` or ``'wb'``
+        :return:
+            a :py:class:`~password_manager.streams.SecretReader` or
+            :py:class:`~password_manager.streams.SecretWriter`, which
+            encrypt / decrypt data in fixed-size chunks.
+        """
+
+        from password_manager.streams import SecretReader, SecretWriter
+
+        if mode not in ('rb', 'wb'):
+            raise ValueError("Invalid mode: {0!r}".format(mode))
+
+        scope, name = self._scoped(name)
+        if scope is not self:
+            return scope.open_secret(
+                name, mode, key=self._scope_key(scope, key))
+        name = self._secret_name(name)
+        if key is None:
+            key = self.get_aes_key()
+
+        if mode == 'rb':
+            fp, size = self.storage.open(name)
+            return SecretReader(fp, key, size=size)
+
+        def _on_close():
+            # Contents unknown here: indexed again on the next search
+            self._update_search_index(name)
+
+        return SecretWriter(self.storage, name, key, on_close=_on_close,
+                            skip_unchanged=True)
+
+    def read_secrets(self, names, key=None, max_workers=8):
+        """
+        Read many secrets at once.
+
+        The AES key is unwrapped only once, then files are read and
+        decrypted concurrently by a pool of ``max_workers`` threads.
+
+        Errors reading a secret don't abort the whole operation:
+        they are reported in the ``error`` attribute of the result.
+
+        :return:
+            an iterator of :py:class:`SecretResult`, yielded
+            as soon as they are ready (not in the original order)
+        """
+
+        if key is None:
+            key = self.get_aes_key()
+
+        def _read(name):
+            try:
+                return SecretResult(name, self.read_secret(name, key=key),
+                                    None)
+            except Exception as e:
+                return SecretResult(name, None, e)
+
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(max(1, max_workers))
+        try:
+            for result in pool.imap_unordered(_read, names):
+                yield result
+        finally:
+            pool.terminate()
+
+    def read_all(self, key=None, max_workers=8):
+        """Read all the secrets, see :py:meth:`read_secrets`"""
+
+        return self.read_secrets(self.list_secrets(), key=key,
+                                 max_workers=max_workers)
 
     def delete_secret(self, name):
-        name = self.get_secret_filename(name)
-        os.unlink(name)
+        scope, name = self._scoped(name)
+        if scope is not self:
+            return scope.delete_secret(name)
+        name = self._secret_name(name)
+        self.storage.delete(name)
+        self._update_search_index(name)
+
+    def search_secrets(self, text=None, fields=None, tags=None):
+        """
+        Find secrets by contents, without decrypting all of them
+        (see :py:mod:`password_manager.search`).
 
+        :param text: text in the secret name or any field value or tag
+        :param fields: dict mapping field names to text in their value
+        :param tags: tags the secrets must have
+        :return: sorted list of secret names
+        """
+
+        return self.search_index.search(text=text, fields=fields, tags=tags)
+
+    @instrumented('list_secrets')
     def list_secrets(self):
         """Find all the files containing secrets"""
 
         # todo: yield paths relative to the root?
-        for dirpath, dirnames, filenames in os.walk(self.basedir):
-            dirnames[:] = [x for x in dirnames if not x.startswith('.')]
-            for filename in filenames:
-                if self._is_secret_file(filename):
-                    yield os.path.join(dirpath, filename)
+        for name in self.storage.list():
+            yield os.path.join(self.basedir, name)
 
     # ----------------------------------------------------------------------
     #   Utility functions
 
+    def _update_index(self, filename, deleted=False):
+        index = self.index
+        if index is None:
+            return
+        relpath = os.path.relpath(filename, self.basedir)
+        if relpath.startswith(os.pardir):
+            return
+        if deleted:
+            index.remove(relpath)
+        else:
+            index.update(relpath)
+
+    def _update_search_index(self, name, secret=None):
+        """
+        Keep the search index (if one was built) up to date: index
+        ``secret``, or forget the secret if its contents are unknown.
+        """
+
+        search_index = self.search_index
+        if search_index is None or not search_index.exists():
+            return
+        if secret is None:
+            search_index.remove(name)
+        else:
+            search_index.update(name, secret)
+
+    @contextmanager
+    def batch_updates(self):
+        """
+        Defer the index and search index updates of the secrets
+        written or deleted within the block (in this vault and its key
+        scopes), and save them at the end, rather than once per secret.
+        """
+
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._flush_updates()
+
+    def _deferring_updates(self):
+        pm = self
+        while pm is not None:
+            if pm._batch_depth:
+                return True
+            pm = pm._parent
+        return False
+
+    def _flush_updates(self):
+        if self._index is not None:
+            self._index.flush()
+        if self._search_index is not None:
+            self._search_index.flush()
+        with self._scopes_lock:
+            scopes = list(self._scopes.values())
+        for scope in scopes:
+            if not scope._deferring_updates():
+                scope._flush_updates()
+
+    # ----------------------------------------------------------------------
+    #   Key scopes
+
+    def get_scope(self, name):
+        """
+        Get the key scope holding a secret (or directory).
+
+        A key scope is a directory with its own ``.keys`` directory,
+        thus its own AES key and users: it's a vault of its own, nested
+        in this one.  Its secrets are not listed by
+        :py:meth:`list_secrets`, and not touched when the AES key of
+        this vault is changed; the secret operations
+        (:py:meth:`read_secret`, :py:meth:`write_secret`, ..) find the
+        right scope for the given name, walking up from its file, and
+        use the key of that scope (the ``key`` argument is passed on
+        only if it is the key of that scope).
+
+        :return: the :py:class:`PasswordManager` for the innermost
+            scope containing ``name`` (``self``, if none)
+        """
+
+        basedir = os.path.abspath(self.basedir)
+        path = os.path.abspath(self.get_secret_filename(name))
+        while path.startswith(os.path.join(basedir, '')):
+            if self._is_scope_dir(path):
+                return self._get_scope_manager(path)
+            path = os.path.dirname(path)
+        return self
+
+    def list_scopes(self):
+        """Directories of the key scopes nested in this vault"""
+
+        scopes = []
+        for dirpath, dirnames, filenames in os.walk(self.basedir):
+            dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+            if dirpath != self.basedir and self._is_scope_dir(dirpath):
+                scopes.append(os.path.relpath(dirpath, self.basedir))
+        return sorted(scopes)
+
+    def iter_scopes(self):
+        """
+        This vault, then the key scopes nested in it.
+
+        :return: iterator of ``(dirname, scope)``: the directory of
+            the scope, relative to the base directory (``''`` for this
+            vault), and its :py:class:`PasswordManager`
+        """
+
+        yield '', self
+        for dirname in self.list_scopes():
+            yield dirname, self.get_scope(dirname)
+
+    def create_scope(self, dirname, identities):
+        """
+        Turn a directory into a key scope, with a new AES key shared
+        by ``identities`` only.
+
+        Secrets already in the directory are re-encrypted with the new
+        key, and move to the new scope.  If this is interrupted, the
+        remaining ones can be fixed with
+        :py:class:`~password_manager.scanner.VaultScanner`, given
+        the key of this vault.
+
+        :return: the :py:class:`PasswordManager` for the new scope
+        """
+
+        from password_manager.storage import DirectoryStorage
+
+        path = os.path.abspath(self.get_secret_filename(dirname))
+        if self._is_scope_dir(path):
+            raise PasswordManagerException(
+                "Already a key scope: {0}".format(dirname))
+        parent, dirname = self._scoped(dirname)
+        if parent is not self:
+            return parent.create_scope(dirname, identities)
+
+        prefix = os.path.join(os.path.relpath(path, self.basedir), '')
+        names = [x for x in self.storage.list() if x.startswith(prefix)]
+        key = self.get_aes_key() if names else None
+
+        scope = self._get_scope_manager(path)
+        keys = scope.resolve_gpg_keys(identities)
+        os.makedirs(scope.keydir)
+        scope._write_identities(scope.generate_aes_key(), keys)
+        if self.index is not None:
+            # Don't depend on the mtime resolution to notice it
+            self.index.remove_dir(os.path.dirname(prefix))
+
+        # With one file per secret on both sides, the new version
+        # replaces the old one, rather than being a copy.
+        same_files = (isinstance(self.storage, DirectoryStorage) and
+                      isinstance(scope.storage, DirectoryStorage))
+        scope_key = scope.get_aes_key()
+        for name in names:
+            secret = self.aes_decrypt(self.storage.read(name), key=key)
+            scope.storage.write(
+                os.path.relpath(name, prefix),
+                scope.aes_encrypt(secret, key=scope_key), atomic=True)
+            if not same_files:
+                self.storage.delete(name)
+        return scope
+
+    def _scoped(self, name):
+        """
+        :return: ``(scope, name)``: the :py:class:`PasswordManager`
+            for the scope of a secret, and its name within the scope
+        """
+
+        scope = self.get_scope(name)
+        if scope is self:
+            return self, name
+        return scope, os.path.relpath(self.get_secret_filename(name),
+                                      scope.basedir)
+
+    def _scope_key(self, scope, key):
+        """
+        The ``key`` passed for a secret in a nested ``scope``, if it is
+        the key of that scope (rather than, say, the key of this vault,
+        as used for all the secrets by bulk operations and the agent).
+        """
+
+        if key is None or aes_key_id(key) != aes_key_id(scope.get_aes_key()):
+            return None
+        return key
+
+    def _get_scope_manager(self, path):
+        with self._scopes_lock:
+            scope = self._scopes.get(path)
+            if scope is None:
+                scope = self.__class__(
+                    path, gpghome=self.gpghome,
+                    key_cache_ttl=self.key_cache_ttl,
+                    context_pool=self.context_pool,
+                    use_index=self.use_index,
+                    keyring_cache_size=self.keyring_cache.max_size)
+                # Same keyring: share what we know about it
+                scope.keyring_cache = self.keyring_cache
+                scope._parent = self
+                self._scopes[path] = scope
+            return scope
+
+    def _is_scope_dir(self, path):
+        return os.path.isdir(os.path.join(path, KEYS_DIRNAME))
+
     def _is_secret_file(self, name):
         if name.startswith('.'):
             return False
@@ -281,6 +1345,11 @@ class PasswordManager(object):
             return False
         return True
 
+    def _secret_name(self, name):
+        """Name of a secret, relative to the base directory"""
+
+        return os.path.relpath(self.get_secret_filename(name), self.basedir)
+
     def get_secret_filename(self, name):
         return os.path.join(self.basedir, name)
 
@@ -289,3 +1358,18 @@ class PasswordManager(object):
 
     def get_gpg_pubkey_filename(self, identity):
         return os.path.join(self.keydir, '{0}.pub'.format(identity))
+
+    def get_config_filename(self):
+        return os.path.join(self.keydir, 'config.json')
+
+    def get_import_state_filename(self):
+        return os.path.join(self.keydir, '.imported')
+
+    def get_aes_key_meta_filename(self, identity):
+        return _meta_filename(self.get_aes_key_filename(identity))
+
+
+def _meta_filename(aes_key_filename):
+    """Name of the metadata file for an encrypted AES key file"""
+
+    return os.path.splitext(aes_key_filename)[0] + '.meta'
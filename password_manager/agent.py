@@ -0,0 +1,449 @@
+"""
+Password manager agent.
+
+Similar to ``ssh-agent`` / ``gpg-agent``: a long-running process that
+unwraps the AES key once, keeps it in memory and serves requests over a
+Unix domain socket, so that command-line invocations don't need to go
+through GPG every time.
+
+The protocol is line-based: each request is a JSON object on a single
+line, answered by a JSON object on a single line.  Secret contents are
+base64-encoded.
+
+The socket lives in a directory only accessible by the current user;
+after ``idle_timeout`` seconds without requests, the agent wipes the key
+from memory and exits.
+"""
+
+import base64
+import errno
+import hashlib
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+from password_manager import PasswordManagerException, aes_key_id
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 600
+
+
+def get_socket_path(basedir):
+    """
+    Get the path of the agent socket serving a given directory.
+
+    The ``PM_AGENT_SOCK`` environment variable, if set, takes
+    precedence.
+    """
+
+    if os.environ.get('PM_AGENT_SOCK'):
+        return os.environ['PM_AGENT_SOCK']
+
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    rundir = os.path.join(rundir, 'password-manager-{0}'.format(os.getuid()))
+    basedir = os.path.realpath(basedir).encode('utf-8')
+    name = hashlib.sha1(basedir).hexdigest()[:16]
+    return os.path.join(rundir, 'agent-{0}.sock'.format(name))
+
+
+def _encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _decode(data):
+    return base64.b64decode(data.encode('ascii'))
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        if not self.server.check_peer(self.request):
+            logger.warning('Refusing connection from another user')
+            return
+
+        for line in iter(self.rfile.readline, b''):
+            self.server.touch()
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.dispatch(request)
+                response['ok'] = True
+            except Exception as e:
+                response = {'ok': False, 'error': str(e),
+                            'errno': getattr(e, 'errno', None)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # Granularity of the idle timeout checks
+    timeout = 1
+
+    def __init__(self, pm, socket_path=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        :param pm: the :py:class:`~password_manager.PasswordManager`
+        :param socket_path: path of the socket to listen on
+        :param idle_timeout:
+            seconds of inactivity after which the key is wiped and
+            the agent exits (``None`` to run forever)
+        """
+
+        self.pm = pm
+        if socket_path is None:
+            socket_path = get_socket_path(pm.basedir)
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.last_activity = time.time()
+        self._stopped = threading.Event()
+
+        # Requests are handled in threads: the key must not be wiped
+        # (or replaced) while another one is reading it.
+        self._key_lock = threading.RLock()
+
+        # Unwrap the key before we start accepting connections
+        self._identity = pm.get_own_identity()
+        self._aes_key = bytearray()
+        self._key_file_id = None
+        self._codec = None
+        self._unwrap_key()
+
+        self._prepare_socket_path()
+        old_umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(
+                self, socket_path, AgentRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def _prepare_socket_path(self):
+        sockdir = os.path.dirname(self.socket_path)
+        if not os.path.exists(sockdir):
+            os.makedirs(sockdir, 0o700)
+        st = os.stat(sockdir)
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            raise PasswordManagerException(
+                "Insecure permissions on {0}".format(sockdir))
+
+        if os.path.exists(self.socket_path):
+            if AgentClient(self.socket_path).ping() is not None:
+                raise PasswordManagerException(
+                    "Another agent is already listening on {0}"
+                    .format(self.socket_path))
+            # Stale socket from a dead agent
+            os.unlink(self.socket_path)
+
+    def check_peer(self, sock):
+        """Make sure the peer runs as our same user, where supported"""
+
+        SO_PEERCRED = getattr(socket, 'SO_PEERCRED', None)
+        if SO_PEERCRED is None:
+            # Rely on the socket directory permissions
+            return True
+        creds = sock.getsockopt(
+            socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    def _unwrap_key(self):
+        """(Re-)read the AES key, remembering the key file it came from"""
+
+        with self._key_lock:
+            # Identify the file first: if it changes while we read it,
+            # the next request notices and reads it again.
+            file_id = self.pm._get_aes_key_file_id(self._identity)
+            aes_key = bytearray(self.pm.get_aes_key(self._identity))
+            self.pm.forget()
+            self._wipe_key()
+            self._aes_key = aes_key
+            self._key_file_id = file_id
+
+    def _wipe_key(self):
+        with self._key_lock:
+            for i in range(len(self._aes_key)):
+                self._aes_key[i] = 0
+            if self._codec is not None:
+                self._codec.forget()
+                self._codec = None
+
+    @property
+    def aes_key(self):
+        """
+        The AES key; it is unwrapped again if the key file changed
+        since (key regenerated, rotated or pulled from git), or the
+        request is refused if that fails.
+        """
+        with self._key_lock:
+            try:
+                file_id = self.pm._get_aes_key_file_id(self._identity)
+            except OSError:
+                file_id = None
+            if file_id != self._key_file_id:
+                logger.info('Key file changed, unwrapping the AES key again')
+                self._unwrap_key()
+            return bytes(self._aes_key)
+
+    @property
+    def codec(self):
+        """
+        :py:class:`~password_manager.gitmerge.SecretCodec` keeping
+        the old AES keys found so far, for the git merge driver
+        """
+        with self._key_lock:
+            aes_key = self.aes_key
+            if self._codec is None:
+                from password_manager.gitmerge import SecretCodec
+                self._codec = SecretCodec(self.pm, current_key=aes_key)
+            return self._codec
+
+    def dispatch(self, request):
+        op = request.get('op')
+
+        if op == 'ping':
+            return {'basedir': os.path.realpath(self.pm.basedir)}
+
+        if op == 'get':
+            data = self.pm.read_secret(request['name'], key=self.aes_key)
+            return {'data': _encode(data)}
+
+        if op == 'put':
+            changed = self.pm.write_secret(
+                request['name'], _decode(request['data']), key=self.aes_key)
+            return {'changed': changed}
+
+        if op == 'delete':
+            self.pm.delete_secret(request['name'])
+            return {}
+
+        if op == 'list':
+            return {'names': list(self.pm.list_secrets())}
+
+        # Raw data, for the git merge driver
+        if op == 'key_id':
+            return {'key_id': aes_key_id(self.aes_key)}
+
+        if op == 'decrypt':
+            data = self.codec.decrypt(_decode(request['data']))
+            return {'data': _encode(data)}
+
+        if op == 'encrypt':
+            data = self.codec.encrypt(_decode(request['data']))
+            return {'data': _encode(data)}
+
+        raise ValueError("Unsupported operation: {0!r}".format(op))
+
+    def serve(self):
+        """Serve requests until idle for too long, or stopped"""
+
+        logger.info('Agent listening on {0}'.format(self.socket_path))
+        try:
+            while not self._stopped.is_set() and not self.is_expired():
+                self.handle_request()
+        finally:
+            self.close()
+
+    def is_expired(self):
+        if self.idle_timeout is None:
+            return False
+        return time.time() - self.last_activity >= self.idle_timeout
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        """Wipe the key and remove the socket"""
+
+        self._wipe_key()
+        self.server_close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class AgentClient(object):
+    def __init__(self, socket_path, timeout=30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+        self._rfile = None
+        self._key_id = None
+
+    @classmethod
+    def connect(cls, basedir, timeout=30):
+        """
+        Get a client for the agent serving ``basedir``.
+
+        :return: the client, or ``None`` if no agent is running
+        """
+
+        client = cls(get_socket_path(basedir), timeout=timeout)
+        served = client.ping()
+        if served is None or served != os.path.realpath(basedir):
+            client.close()
+            return None
+        return client
+
+    def _connect(self):
+        if self._sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except Exception:
+                sock.close()
+                raise
+            self._sock = sock
+            self._rfile = sock.makefile('rb')
+        return self._sock
+
+    def close(self):
+        if self._sock is not None:
+            self._rfile.close()
+            self._sock.close()
+            self._sock = self._rfile = None
+
+    def request(self, op, **kwargs):
+        kwargs['op'] = op
+        sock = self._connect()
+        sock.sendall(json.dumps(kwargs).encode('utf-8') + b'\n')
+        line = self._rfile.readline()
+        if not line:
+            self.close()
+            raise PasswordManagerException("Agent closed the connection")
+        response = json.loads(line.decode('utf-8'))
+        if not response.pop('ok'):
+            if response.get('errno') is not None:
+                raise IOError(response['errno'], response['error'])
+            raise PasswordManagerException(response['error'])
+        return response
+
+    def ping(self):
+        """
+        :return:
+            the directory served by the agent, or ``None``
+            if the agent is not reachable.
+        """
+
+        try:
+            return self.request('ping')['basedir']
+        except (socket.error, OSError, PasswordManagerException):
+            self.close()
+            return None
+
+    def read_secret(self, name):
+        return _decode(self.request('get', name=name)['data'])
+
+    def write_secret(self, name, secret):
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        return self.request('put', name=name, data=_encode(secret))['changed']
+
+    def delete_secret(self, name):
+        self.request('delete', name=name)
+
+    def list_secrets(self):
+        return iter(self.request('list')['names'])
+
+    # Same interface as password_manager.gitmerge.SecretCodec
+
+    def decrypt(self, data):
+        return _decode(self.request('decrypt', data=_encode(data))['data'])
+
+    def encrypt(self, data):
+        return _decode(self.request('encrypt', data=_encode(data))['data'])
+
+    def is_current(self, data):
+        from password_manager.fileformat import parse_header
+
+        header = parse_header(data)
+        if header is None:
+            return False
+        if self._key_id is None:
+            self._key_id = self.request('key_id')['key_id']
+        return header.key_id == self._key_id
+
+
+class _AgentSecretWriter(BytesIO):
+    """Buffer a secret, then send it to the agent when closed"""
+
+    def __init__(self, client, name):
+        BytesIO.__init__(self)
+        self._client = client
+        self._name = name
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return BytesIO.write(self, data)
+
+    def close(self):
+        if not self.closed:
+            self._client.write_secret(self._name, self.getvalue())
+        BytesIO.close(self)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            BytesIO.close(self)
+
+
+class AgentPasswordManager(object):
+    """
+    Proxy to a :py:class:`~password_manager.PasswordManager`, sending
+    secret operations to a running agent.
+
+    Any other operation is performed by the wrapped password manager.
+    """
+
+    def __init__(self, client, pm):
+        self.agent = client
+        self._pm = pm
+
+    def __getattr__(self, name):
+        return getattr(self._pm, name)
+
+    def read_secret(self, name, key=None):
+        if key is not None:
+            return self._pm.read_secret(name, key=key)
+        return self.agent.read_secret(name)
+
+    def write_secret(self, name, secret, key=None):
+        if key is not None:
+            return self._pm.write_secret(name, secret, key=key)
+        return self.agent.write_secret(name, secret)
+
+    def delete_secret(self, name):
+        return self.agent.delete_secret(name)
+
+    def list_secrets(self):
+        return self.agent.list_secrets()
+
+    def open_secret(self, name, mode='rb', key=None):
+        if key is not None:
+            return self._pm.open_secret(name, mode, key=key)
+        # The agent only sends whole (authenticated) secrets: unlike
+        # PasswordManager.open_secret(), reading is not streamed, and
+        # the secret is kept in memory.
+        if mode == 'rb':
+            return BytesIO(self.agent.read_secret(name))
+        if mode == 'wb':
+            return _AgentSecretWriter(self.agent, name)
+        raise ValueError("Invalid mode: {0!r}".format(mode))
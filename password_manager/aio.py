@@ -0,0 +1,141 @@
+"""
+Asynchronous interface to the password manager.
+
+All the blocking work (GPG, disk I/O and AES) is run in an executor;
+operations return :py:class:`concurrent.futures.Future` objects, so
+the caller is never blocked.
+
+With asyncio (Python 3), wrap them to get awaitables::
+
+    secret = await asyncio.wrap_future(apm.read_secret('db/prod'))
+
+.. note:: On Python 2, this module requires the ``futures`` backport.
+"""
+
+import functools
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
+
+class AsyncPasswordManager(object):
+    """
+    Asynchronous facade for a :py:class:`~password_manager.PasswordManager`.
+
+    - concurrent requests needing the AES key share a single
+      in-flight unwrap operation;
+    - at most ``max_concurrency`` requests run at the same time.
+    """
+
+    def __init__(self, pm, max_concurrency=8, executor=None):
+        """
+        :param pm: the wrapped PasswordManager
+        :param max_concurrency: maximum number of concurrent requests
+        :param executor:
+            executor running the blocking operations; by default,
+            a thread pool with ``max_concurrency`` workers is created.
+        """
+
+        self.pm = pm
+        self.max_concurrency = max_concurrency
+        self._own_executor = executor is None
+        if executor is None:
+            # One more worker, for the key unwrap
+            executor = ThreadPoolExecutor(max_workers=max_concurrency + 1)
+        self._executor = executor
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._key_future = None
+        self._key_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    def _run(self, func, *args, **kwargs):
+        """Run a request in the executor, within the concurrency limit"""
+
+        def _limited():
+            with self._semaphore:
+                return func(*args, **kwargs)
+
+        return self._executor.submit(_limited)
+
+    def _with_key(self, func, *args, **kwargs):
+        """Run a request once the AES key is available, passing it along"""
+
+        result = Future()
+
+        def _key_done(key_future):
+            if key_future.cancelled() or key_future.exception() is not None:
+                _copy(result, key_future)
+                return
+            try:
+                future = self._run(func, *args, key=key_future.result(),
+                                   **kwargs)
+            except RuntimeError as e:  # Executor shut down
+                if result.set_running_or_notify_cancel():
+                    result.set_exception(e)
+                return
+            future.add_done_callback(functools.partial(_copy, result))
+
+        self.get_aes_key().add_done_callback(_key_done)
+        return result
+
+    def get_aes_key(self):
+        """
+        Get the AES key.
+
+        If an unwrap operation is already running, wait
+        for it instead of starting another one.
+        """
+
+        with self._key_lock:
+            future = self._key_future
+            started = future is None
+            if started:
+                future = self._executor.submit(self.pm.get_aes_key)
+                self._key_future = future
+        if started:
+            # Not under the lock: the callback runs at once if the
+            # future is already done
+            future.add_done_callback(self._key_done)
+
+        # Don't let one caller's cancellation affect the others
+        result = Future()
+        future.add_done_callback(functools.partial(_copy, result))
+        return result
+
+    def _key_done(self, future):
+        with self._key_lock:
+            if self._key_future is future:
+                self._key_future = None
+
+    def read_secret(self, name):
+        return self._with_key(self.pm.read_secret, name)
+
+    def write_secret(self, name, secret):
+        return self._with_key(self.pm.write_secret, name, secret)
+
+    def delete_secret(self, name):
+        return self._run(self.pm.delete_secret, name)
+
+    def list_secrets(self):
+        return self._run(lambda: list(self.pm.list_secrets()))
+
+
+def _copy(target, source):
+    """Copy the outcome of the ``source`` future to ``target``"""
+
+    if not target.set_running_or_notify_cancel():
+        return
+    if source.cancelled():
+        target.set_exception(CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
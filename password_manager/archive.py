@@ -0,0 +1,290 @@
+"""
+Export and import of a whole vault, as a single encrypted archive.
+
+The archive is a stream of records, encrypted with a random archive
+key; the key itself is encrypted with GnuPG for the chosen recipients,
+who can import the archive in another vault (with a different AES
+key, users, storage, ..)::
+
+    magic (4) | version (1) | key length (4) | GPG-encrypted key
+    | record length (4) | record | record length (4) | record | ...
+
+Each record is a secret file (see :py:mod:`password_manager.fileformat`)
+encrypted with the archive key, containing::
+
+    type (1) | sequence number (4) | name length (2) | name | secret
+
+The last record has type ``end``, and carries the number of secrets:
+a truncated (or reordered) archive is detected by the sequence
+numbers.  Since every record is authenticated on its own, secrets
+are decrypted and re-encrypted by a pool of worker threads, and
+written out as soon as they are ready: only a few secrets are in
+memory at any time, whatever the size of the vault.
+"""
+
+import os
+import struct
+import threading
+from collections import deque
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
+
+from password_manager import PasswordManagerException
+
+ARCHIVE_MAGIC = b'\x89PMA'
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER = ARCHIVE_MAGIC + struct.pack('B', ARCHIVE_VERSION)
+
+LENGTH = struct.Struct('>I')
+RECORD_HEADER = struct.Struct('>BIH')
+RECORD_SECRET = 1
+RECORD_END = 2
+
+
+class ArchiveFormatError(PasswordManagerException):
+    """The archive is corrupt, truncated, or in an unsupported format"""
+
+
+class VaultArchive(object):
+    def __init__(self, pm, max_workers=8):
+        """
+        :param pm: the :py:class:`~password_manager.PasswordManager`
+        :param max_workers: number of secrets processed in parallel
+        """
+        self.pm = pm
+        self.max_workers = max(1, max_workers)
+
+    def export(self, fp, recipients=None):
+        """
+        Write all the secrets to an archive, including the ones in
+        nested key scopes (each decrypted with the key of its scope:
+        we must be one of the users of every scope).
+
+        :param fp: binary file to write the archive to
+        :param recipients:
+            GPG keys (fingerprints, ids or names) the archive is
+            encrypted for; defaults to the users of the vault
+        :return: a dict with the ``count`` of secrets, their ``bytes``
+            (plaintext) and the ``elapsed`` time
+        """
+
+        from password_manager import fileformat
+
+        if recipients is None:
+            recipients = list(self.pm.list_identities())
+        keys = list(self.pm.resolve_gpg_keys(recipients).values())
+        # Unwrap all the keys first: don't write half an archive
+        scopes = [(dirname, scope, scope.get_aes_key())
+                  for dirname, scope in self.pm.iter_scopes()]
+        archive_key = self.pm.generate_aes_key()
+        start = default_timer()
+
+        encrypted_key = self._encrypt_archive_key(keys, archive_key)
+        fp.write(ARCHIVE_HEADER + LENGTH.pack(len(encrypted_key)) +
+                 encrypted_key)
+
+        def _export(item):
+            seq, (scope, key, scoped_name, name) = item
+            secret = scope.read_secret_buffer(scoped_name, key=key)
+            record = _pack_record(RECORD_SECRET, seq, name, secret)
+            return len(secret), fileformat.encrypt(archive_key, record)
+
+        def _names():
+            for dirname, scope, key in scopes:
+                for filename in scope.list_secrets():
+                    scoped_name = os.path.relpath(filename, scope.basedir)
+                    yield (scope, key, scoped_name,
+                           os.path.join(dirname, scoped_name))
+
+        count = total = 0
+        for size, record in self._map(_export, enumerate(_names())):
+            fp.write(LENGTH.pack(len(record)) + record)
+            count += 1
+            total += size
+
+        record = _pack_record(RECORD_END, count, '', b'')
+        record = fileformat.encrypt(archive_key, record)
+        fp.write(LENGTH.pack(len(record)) + record)
+        return _stats(count, total, start)
+
+    def import_(self, fp):
+        """
+        Store all the secrets from an archive in the vault, replacing
+        existing secrets with the same name.
+
+        Secrets are written as they are read, by several threads: if
+        the archive turns out to be corrupt, any of them (not only the
+        ones before the error) may have been written already.  An
+        archive containing the same name twice is rejected.
+
+        :param fp: binary file to read the archive from
+        :return: a dict with the ``count`` of secrets, their ``bytes``
+            (plaintext), the number of secrets actually ``written``
+            (the others were unchanged) and the ``elapsed`` time
+        :raises ArchiveFormatError: if the archive is not valid
+        """
+
+        from password_manager import fileformat
+
+        header = fp.read(len(ARCHIVE_HEADER))
+        if header != ARCHIVE_HEADER:
+            raise ArchiveFormatError(
+                "Not a vault archive, or unsupported version")
+        archive_key = self._decrypt_archive_key(_read_chunk(fp))
+        start = default_timer()
+
+        # Secrets may belong to nested key scopes: unwrap the key of
+        # each one only once (and only if needed)
+        scope_keys = {}
+        scope_keys_lock = threading.Lock()
+
+        def _get_key(scope):
+            with scope_keys_lock:
+                if scope not in scope_keys:
+                    scope_keys[scope] = scope.get_aes_key()
+                return scope_keys[scope]
+
+        # Records are written in parallel: with duplicate names, which
+        # one is written last would be down to chance
+        seen = set()
+        seen_lock = threading.Lock()
+
+        def _claim(name):
+            with seen_lock:
+                if name in seen:
+                    raise ArchiveFormatError(
+                        "Duplicate secret in archive: {0!r}".format(name))
+                seen.add(name)
+
+        def _import(record):
+            try:
+                record = fileformat.decrypt(archive_key, record)
+            except fileformat.SecretFormatError as e:
+                raise ArchiveFormatError(
+                    "Corrupt archive record: {0}".format(e))
+            kind, seq, name, secret = _unpack_record(record)
+            if kind != RECORD_SECRET:
+                return kind, seq, name, len(secret), False
+            _claim(name)
+            scope, scoped_name = self.pm._scoped(name)
+            key = _get_key(scope)
+            if scope.write_secret(scoped_name, secret, key=key):
+                return kind, seq, name, len(secret), True
+            return kind, seq, name, len(secret), False
+
+        count = total = written = 0
+        # The search index is saved once, at the end
+        with self.pm.batch_updates():
+            for kind, seq, name, size, changed in self._map(
+                    _import, _read_records(fp)):
+                if seq != count:
+                    raise ArchiveFormatError(
+                        "Unexpected record #{0} (expected #{1})"
+                        .format(seq, count))
+                if kind == RECORD_END:
+                    break
+                count += 1
+                total += size
+                written += changed
+            else:
+                raise ArchiveFormatError("Truncated archive")
+
+        stats = _stats(count, total, start)
+        stats['written'] = written
+        return stats
+
+    # ----------------------------------------------------------------------
+
+    def _map(self, func, items):
+        """
+        Like ``pool.imap``, but with at most a few items in progress:
+        results are consumed (and thrown away) by the caller as they
+        come, so memory use doesn't depend on the number of items.
+        """
+
+        window = 2 * self.max_workers
+        pool = ThreadPool(self.max_workers)
+        try:
+            pending = deque()
+            for item in items:
+                pending.append(pool.apply_async(func, (item,)))
+                if len(pending) >= window:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def _encrypt_archive_key(self, keys, archive_key):
+        import gpgme
+
+        output = BytesIO()
+        with self.pm.gpg_context() as gpg:
+            gpg.encrypt(keys, gpgme.ENCRYPT_ALWAYS_TRUST,
+                        BytesIO(archive_key), output)
+        return output.getvalue()
+
+    def _decrypt_archive_key(self, data):
+        output = BytesIO()
+        with self.pm.gpg_context() as gpg:
+            gpg.decrypt(BytesIO(data), output)
+        return output.getvalue()
+
+
+def _pack_record(kind, seq, name, secret):
+    name = name.encode('utf-8')
+    return RECORD_HEADER.pack(kind, seq, len(name)) + name + bytes(secret)
+
+
+def _unpack_record(record):
+    if len(record) < RECORD_HEADER.size:
+        raise ArchiveFormatError("Truncated archive record")
+    kind, seq, name_size = RECORD_HEADER.unpack(
+        bytes(record[:RECORD_HEADER.size]))
+    offset = RECORD_HEADER.size + name_size
+    name = bytes(record[RECORD_HEADER.size:offset]).decode('utf-8')
+    if kind == RECORD_SECRET:
+        _check_name(name)
+    elif kind != RECORD_END:
+        raise ArchiveFormatError("Invalid archive record type")
+    return kind, seq, name, bytes(record[offset:])
+
+
+def _check_name(name):
+    """Don't let an archive write outside of the secrets"""
+
+    parts = name.split(os.sep)
+    if (not name or os.path.isabs(name) or
+            any(x.startswith('.') or not x for x in parts)):
+        raise ArchiveFormatError(
+            "Invalid secret name in archive: {0!r}".format(name))
+
+
+def _read_chunk(fp, eof=False):
+    """
+    Read a length-prefixed chunk.
+
+    :param eof: return ``None`` at the end of the file, rather than
+        raising an error
+    """
+
+    header = fp.read(LENGTH.size)
+    if not header and eof:
+        return None
+    if len(header) < LENGTH.size:
+        raise ArchiveFormatError("Truncated archive")
+    size, = LENGTH.unpack(header)
+    data = fp.read(size)
+    if len(data) < size:
+        raise ArchiveFormatError("Truncated archive")
+    return data
+
+
+def _read_records(fp):
+    return iter(lambda: _read_chunk(fp, eof=True), None)
+
+
+def _stats(count, size, start):
+    return {'count': count, 'bytes': size,
+            'elapsed': default_timer() - start}
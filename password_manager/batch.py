@@ -0,0 +1,142 @@
+"""
+Batch mode: many secret operations, in a single process.
+
+Each line of the input is a JSON object describing an operation::
+
+    {"op": "get", "name": "db/prod"}
+    {"op": "put", "name": "db/prod", "data": "<base64>"}
+    {"op": "delete", "name": "db/prod"}
+    {"op": "list"}
+
+Names are relative to the vault directory: secrets in nested key
+scopes (see :py:meth:`~password_manager.PasswordManager.get_scope`)
+are listed, read and written like the others.
+
+Secret contents are base64-encoded, like in the agent protocol (see
+:py:mod:`password_manager.agent`), unless ``"encoding": "utf-8"`` is
+given in the request: they are then plain strings.
+
+Each operation is answered by a JSON object on a line of the output,
+in the same order, with ``"ok": true`` and the result, or ``"ok":
+false`` and the ``error`` (and its ``errno``, if any); an ``id``
+given in the request is copied to the response.  A failed operation
+doesn't stop the batch.
+
+The AES key is unwrapped once, when first needed, instead of once
+per secret (once per key scope, for secrets in nested key scopes).
+"""
+
+import base64
+import json
+import os
+
+ENCODINGS = ('base64', 'utf-8')
+
+
+class BatchRunner(object):
+    def __init__(self, pm):
+        """
+        :param pm: the :py:class:`~password_manager.PasswordManager`
+        """
+        self.pm = pm
+        self._keys = {}
+
+    def get_key(self, scope):
+        """AES key of a key scope (see ``PasswordManager.get_scope``)"""
+
+        if scope not in self._keys:
+            self._keys[scope] = scope.get_aes_key()
+        return self._keys[scope]
+
+    def run(self, infile, outfile):
+        """
+        Run the operations read from ``infile`` (a binary file),
+        writing the responses to ``outfile`` as they are ready.
+
+        :return: the number of failed operations
+        """
+
+        failed = 0
+        # The search index is saved once, at the end
+        with self.pm.batch_updates():
+            for line in iter(infile.readline, b''):
+                if not line.strip():
+                    continue
+                response = self.handle(line)
+                if not response['ok']:
+                    failed += 1
+                outfile.write(json.dumps(response, sort_keys=True)
+                              .encode('utf-8') + b'\n')
+                # Let the caller read the responses as they come
+                outfile.flush()
+        return failed
+
+    def handle(self, line):
+        """Run a single operation, from a line of JSON"""
+
+        request = {}
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            response = self.dispatch(request)
+            response['ok'] = True
+        except Exception as e:
+            response = {'ok': False, 'error': str(e),
+                        'errno': getattr(e, 'errno', None)}
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    def dispatch(self, request):
+        op = request.get('op')
+        encoding = request.get('encoding', 'base64')
+        if encoding not in ENCODINGS:
+            raise ValueError("Unsupported encoding: {0!r}".format(encoding))
+
+        if op == 'get':
+            scope, name = self.pm._scoped(_name(request))
+            data = scope.read_secret_buffer(name, key=self.get_key(scope))
+            return {'data': _encode(bytes(data), encoding)}
+
+        if op == 'put':
+            if 'data' not in request:
+                raise ValueError("Missing data")
+            scope, name = self.pm._scoped(_name(request))
+            changed = scope.write_secret(
+                name, _decode(request['data'], encoding),
+                key=self.get_key(scope))
+            return {'changed': changed}
+
+        if op == 'delete':
+            self.pm.delete_secret(_name(request))
+            return {}
+
+        if op == 'list':
+            # Including the secrets of nested key scopes
+            names = []
+            for dirname, scope in self.pm.iter_scopes():
+                names.extend(os.path.join(dirname, x)
+                             for x in scope.storage.list())
+            return {'names': sorted(names)}
+
+        raise ValueError("Unsupported operation: {0!r}".format(op))
+
+
+def _name(request):
+    name = request.get('name')
+    if not name:
+        raise ValueError("Missing secret name")
+    return name
+
+
+def _encode(data, encoding):
+    if encoding == 'utf-8':
+        return data.decode('utf-8')
+    return base64.b64encode(data).decode('ascii')
+
+
+def _decode(data, encoding):
+    if encoding == 'utf-8':
+        return data.encode('utf-8')
+    return base64.b64decode(data.encode('ascii'))
@@ -1,27 +1,24 @@
-import logging
+import os
 import sys
-
-from cliff.app import App
-from cliff.commandmanager import CommandManager
-
-from password_manager import __version__
-
-
-class PasswordManagerCLI(App):
-
-    log = logging.getLogger(__name__)
-
-    def __init__(self):
-        super(PasswordManagerCLI, self).__init__(
-            description='Password Manager command-line interface',
-            version=__version__,
-            command_manager=CommandManager('password_manager.cli'))
+from timeit import default_timer
 
 
 def main(argv=None):
     """Main entry point"""
 
+    started = default_timer()
+
     if argv is None:
         argv = sys.argv[1:]
-    myapp = PasswordManagerCLI()
+
+    # Frequently used commands skip loading cliff and all
+    # the command plugins, see password_manager.cli.fast
+    if not os.environ.get('PM_NO_FASTPATH'):
+        from password_manager.cli.fast import dispatch
+        result = dispatch(argv)
+        if result is not None:
+            return result
+
+    from password_manager.cli.app import PasswordManagerCLI
+    myapp = PasswordManagerCLI(started=started)
     return myapp.run(argv)
@@ -0,0 +1,69 @@
+import logging
+import sys
+from timeit import default_timer
+
+from cliff.app import App
+from cliff.commandmanager import CommandManager
+
+from password_manager import __version__
+
+
+class PasswordManagerCLI(App):
+
+    log = logging.getLogger(__name__)
+
+    def __init__(self, started=None):
+        """
+        :param started:
+            time (``timeit.default_timer``) the program started
+            at, to measure the startup time with ``--profile``
+        """
+        super(PasswordManagerCLI, self).__init__(
+            description='Password Manager command-line interface',
+            version=__version__,
+            command_manager=CommandManager('password_manager.cli'))
+        self.started = started
+        self.call_stats = None
+        self._command_started = None
+
+    def build_option_parser(self, *args, **kwargs):
+        parser = super(PasswordManagerCLI, self).build_option_parser(
+            *args, **kwargs)
+        parser.add_argument(
+            '--profile', action='store_true', default=False,
+            help='Print a breakdown of the time spent in each operation')
+        parser.add_argument(
+            '--profile-output', metavar='FILE',
+            help='Append the --profile stats to FILE, as JSON lines')
+        return parser
+
+    def prepare_to_run_command(self, cmd):
+        from password_manager.instrumentation import (
+            CallStats, add_hook, record)
+
+        if not (self.options.profile or self.options.profile_output):
+            return
+        self.call_stats = CallStats()
+        add_hook(self.call_stats)
+        self._command_started = default_timer()
+        if self.started is not None:
+            # Only the first command of an interactive session
+            record('cli.startup', self._command_started - self.started)
+            self.started = None
+
+    def clean_up(self, cmd, result, err):
+        from password_manager.instrumentation import record, remove_hook
+
+        if self.call_stats is None:
+            return
+        record('cli.command', default_timer() - self._command_started, err)
+        remove_hook(self.call_stats)
+        call_stats, self.call_stats = self.call_stats, None
+
+        if self.options.profile:
+            sys.stderr.write(call_stats.format() + '\n')
+        if self.options.profile_output:
+            call_stats.export(
+                self.options.profile_output,
+                command=getattr(cmd, 'cmd_name', None), result=result,
+                error=None if err is None else repr(err))
@@ -1,22 +1,42 @@
 import logging
 import os
+import shutil
 
 from cliff.command import Command
 from cliff.lister import Lister
 
-from password_manager import PasswordManager
+from password_manager import CONFIG_OPTIONS
+from password_manager.cli.utils import (
+    get_binary_stream, get_password_manager, get_secret_codec, get_user_list)
+
+# Note: the modules implementing the commands are imported by the
+# commands using them, to keep the start-up time down.
 
 
 class PMCommandMixin(object):
+    # Whether to send operations to a running agent, if available
+    use_agent = True
+
     def _get_password_manager(self, parsed_args):
-        pm_home = None
-        if parsed_args.pm_home:
-            pm_home = parsed_args.pm_home
-        elif 'PM_HOME' in os.environ:
-            pm_home = os.environ['PM_HOME']
-        else:
-            pm_home = os.getcwd()
-        return PasswordManager(pm_home)
+        pm = get_password_manager(parsed_args.pm_home,
+                                  use_agent=self.use_agent)
+        if getattr(parsed_args, 'scope', None):
+            pm = _get_scope(pm, parsed_args.scope)
+        return pm
+
+
+def _add_scope_argument(parser):
+    parser.add_argument('--scope', metavar='DIR',
+                        help='Act on a key scope (see "scope create") '
+                        'instead of the whole vault')
+
+
+def _get_scope(pm, dirname):
+    scope = pm.get_scope(dirname)
+    if (os.path.realpath(scope.basedir) !=
+            os.path.realpath(os.path.join(pm.basedir, dirname))):
+        raise ValueError('Not a key scope: {0}'.format(dirname))
+    return scope
 
 
 class PMCommand(PMCommandMixin, Command):
@@ -39,8 +59,18 @@ class Setup(PMCommand):
     logger = logging.getLogger(__name__)
 
     def get_parser(self, prog_name):
+        from password_manager.storage import STORAGE_BACKENDS
+
         parser = super(Setup, self).get_parser(prog_name)
         parser.add_argument('identity', nargs='+')
+        parser.add_argument('--deterministic-iv', action='store_true',
+                            default=False,
+                            help='Encrypt unchanged secrets to identical '
+                            'files (reveals which secrets are equal)')
+        parser.add_argument('--storage', choices=sorted(STORAGE_BACKENDS),
+                            default=CONFIG_OPTIONS['storage'],
+                            help='How to store the secrets: one file each, '
+                            'or all of them in a single file')
         return parser
 
     def take_action(self, parsed_args):
@@ -51,6 +81,10 @@ class Setup(PMCommand):
         self.logger.info('Initial identities: {0}'
                          .format(', '.join(identities)))
         pm.setup(identities)
+        if parsed_args.deterministic_iv:
+            pm.write_config(deterministic_iv=True)
+        if parsed_args.storage != CONFIG_OPTIONS['storage']:
+            pm.migrate_storage(parsed_args.storage)
 
 
 class UserAdd(PMCommand):
@@ -60,6 +94,7 @@ class UserAdd(PMCommand):
 
     def get_parser(self, prog_name):
         parser = super(UserAdd, self).get_parser(prog_name)
+        _add_scope_argument(parser)
         parser.add_argument('identity')
         return parser
 
@@ -79,6 +114,7 @@ class UserRemove(PMCommand):
 
     def get_parser(self, prog_name):
         parser = super(UserRemove, self).get_parser(prog_name)
+        _add_scope_argument(parser)
         parser.add_argument('identity')
         return parser
 
@@ -99,38 +135,13 @@ class UserList(PMLister):
 
     def get_parser(self, prog_name):
         parser = super(UserList, self).get_parser(prog_name)
+        _add_scope_argument(parser)
         parser.add_argument('--full', action='store_true', default=False)
         return parser
 
-    def _get_full(self, pm):
-        header = ('Fingerprint', 'Other subkeys', 'User id')
-        rows = []
-        for identity in pm.list_identities():
-            key = pm.gpg.get_key(identity)
-            rows.append((
-                identity,
-                '\n'.join(sk.fpr for sk in key.subkeys),
-                '\n'.join(
-                    '{0} <{1}>'.format(u.name, u.email)
-                    for u in key.uids)
-            ))
-        return header, rows
-
-    def _get_compact(self, pm):
-        header = ('Fingerprint', 'User id')
-        rows = []
-        for identity in pm.list_identities():
-            key = pm.gpg.get_key(identity)
-            rows.append((
-                identity,
-                '{0} <{1}>'.format(key.uids[0].name, key.uids[0].email)))
-        return header, rows
-
     def take_action(self, parsed_args):
         pm = self._get_password_manager(parsed_args)
-        if parsed_args.full:
-            return self._get_full(pm)
-        return self._get_compact(pm)
+        return get_user_list(pm, full=parsed_args.full)
 
 
 class KeyRegen(PMCommand):
@@ -138,10 +149,29 @@ class KeyRegen(PMCommand):
 
     logger = logging.getLogger(__name__)
 
+    def get_parser(self, prog_name):
+        parser = super(KeyRegen, self).get_parser(prog_name)
+        _add_scope_argument(parser)
+        parser.add_argument('--jobs', type=int, default=8,
+                            help='Number of secrets to recrypt in parallel')
+        parser.add_argument('--rollback', action='store_true', default=False,
+                            help='Abort an interrupted key regeneration')
+        return parser
+
     def take_action(self, parsed_args):
-        self.logger.info("Regenerating AES key")
+        from password_manager.rotation import KeyRotation
+
         pm = self._get_password_manager(parsed_args)
-        pm.regenerate_aes_key()
+        rotation = KeyRotation(pm, max_workers=parsed_args.jobs)
+        if parsed_args.rollback:
+            self.logger.info("Rolling back AES key regeneration")
+            rotation.rollback()
+            return
+        if rotation.in_progress():
+            self.logger.info("Resuming interrupted AES key regeneration")
+        else:
+            self.logger.info("Regenerating AES key")
+        rotation.run()
 
 
 class KeyRecrypt(PMCommand):
@@ -149,10 +179,26 @@ class KeyRecrypt(PMCommand):
 
     logger = logging.getLogger(__name__)
 
+    def get_parser(self, prog_name):
+        parser = super(KeyRecrypt, self).get_parser(prog_name)
+        _add_scope_argument(parser)
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Re-encrypt even up-to-date keys')
+        parser.add_argument('--jobs', type=int, default=8,
+                            help='Number of keys to encrypt in parallel')
+        return parser
+
     def take_action(self, parsed_args):
-        # todo: write this (we want to get the key and
-        #       re-encrypt for all users)
-        raise NotImplementedError("Not implemented yet")
+        pm = self._get_password_manager(parsed_args)
+        imported = pm.import_all_pubkeys()
+        if imported:
+            self.logger.info('Imported {0} public keys'.format(len(imported)))
+        result = pm.recrypt_aes_key(force=parsed_args.force,
+                                    max_workers=parsed_args.jobs)
+        for identity in result['rewritten']:
+            self.logger.info('Re-encrypted key for {0}'.format(identity))
+        self.logger.info('{0} rewritten, {1} skipped (up to date)'.format(
+            len(result['rewritten']), len(result['skipped'])))
 
 
 class SecretPut(PMCommand):
@@ -168,8 +214,8 @@ class SecretPut(PMCommand):
     def take_action(self, parsed_args):
         # Read secret from the standard input and write to file
         pm = self._get_password_manager(parsed_args)
-        data = self.app.stdin.read()
-        pm.write_secret(parsed_args.name, data)
+        with pm.open_secret(parsed_args.name, 'wb') as fp:
+            shutil.copyfileobj(get_binary_stream(self.app.stdin), fp)
 
 
 class SecretGet(PMCommand):
@@ -185,8 +231,8 @@ class SecretGet(PMCommand):
     def take_action(self, parsed_args):
         # Read secret from file input and write to stdout
         pm = self._get_password_manager(parsed_args)
-        secret = pm.read_secret(parsed_args.name)
-        self.app.stdout.write(secret)
+        with pm.open_secret(parsed_args.name, 'rb') as fp:
+            shutil.copyfileobj(fp, get_binary_stream(self.app.stdout))
 
 
 class SecretDelete(PMCommand):
@@ -202,3 +248,420 @@ class SecretDelete(PMCommand):
     def take_action(self, parsed_args):
         pm = self._get_password_manager(parsed_args)
         pm.delete_secret(parsed_args.name)
+
+
+class Batch(PMCommand):
+    """Run secret operations read from stdin, as JSON lines"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def take_action(self, parsed_args):
+        from password_manager.batch import BatchRunner
+
+        pm = self._get_password_manager(parsed_args)
+        runner = BatchRunner(pm)
+        failed = runner.run(get_binary_stream(self.app.stdin),
+                            get_binary_stream(self.app.stdout))
+        if failed:
+            self.logger.warning('{0} operation(s) failed'.format(failed))
+            return 1
+
+
+class SecretSearch(PMLister):
+    """Find secrets by contents, using the encrypted search index"""
+
+    logger = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(SecretSearch, self).get_parser(prog_name)
+        parser.add_argument('text', nargs='?',
+                            help='Text in the name, or any field or tag')
+        parser.add_argument('--field', action='append', default=[],
+                            metavar='NAME=VALUE',
+                            help='Text in the value of a field')
+        parser.add_argument('--tag', action='append', default=[],
+                            help='Tag the secrets must have')
+        parser.add_argument('--rebuild', action='store_true', default=False,
+                            help='Index all the secrets again first')
+        return parser
+
+    def take_action(self, parsed_args):
+        fields = {}
+        for item in parsed_args.field:
+            name, sep, value = item.partition('=')
+            if not sep:
+                raise ValueError('Invalid --field: {0!r} (expected '
+                                 'NAME=VALUE)'.format(item))
+            fields[name] = value
+
+        pm = self._get_password_manager(parsed_args)
+        if parsed_args.rebuild:
+            pm.search_index.rebuild()
+        names = pm.search_secrets(text=parsed_args.text, fields=fields,
+                                  tags=parsed_args.tag)
+        return ('Secret',), [(x,) for x in names]
+
+
+class ScopeCreate(PMCommand):
+    """Create a key scope: a directory with its own AES key and users"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def get_parser(self, prog_name):
+        parser = super(ScopeCreate, self).get_parser(prog_name)
+        parser.add_argument('dirname')
+        parser.add_argument('identity', nargs='+')
+        return parser
+
+    def take_action(self, parsed_args):
+        pm = self._get_password_manager(parsed_args)
+        scope = pm.create_scope(parsed_args.dirname, parsed_args.identity)
+        self.logger.info('Created key scope {0} ({1} secrets)'.format(
+            parsed_args.dirname, len(list(scope.list_secrets()))))
+
+
+class ScopeList(PMLister):
+    """List the key scopes"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def take_action(self, parsed_args):
+        pm = self._get_password_manager(parsed_args)
+        rows = []
+        for dirname in pm.list_scopes():
+            scope = pm.get_scope(dirname)
+            rows.append((dirname, len(list(scope.list_identities()))))
+        return ('Scope', 'Users'), rows
+
+
+class VaultCheck(PMLister):
+    """Find secrets not encrypted with the current AES key"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def get_parser(self, prog_name):
+        parser = super(VaultCheck, self).get_parser(prog_name)
+        parser.add_argument('--jobs', type=int, default=8,
+                            help='Number of secrets to check in parallel')
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='List up-to-date secrets too')
+        _add_scope_argument(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        from password_manager.scanner import VaultScanner, STATUS_CURRENT
+
+        pm = self._get_password_manager(parsed_args)
+        scanner = VaultScanner(pm, max_workers=parsed_args.jobs)
+        self.logger.info('Current AES key: {0}'
+                         .format(scanner.current_key_id))
+        statuses, stats = scanner.scan()
+        _log_scan(self.logger, statuses, stats)
+        rows = [(x.name, x.status, x.key_id or '') for x in statuses
+                if parsed_args.all or x.status != STATUS_CURRENT]
+        return ('Secret', 'Status', 'Key ID'), rows
+
+
+class VaultFix(PMCommand):
+    """Re-encrypt secrets encrypted with an old AES key"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def get_parser(self, prog_name):
+        parser = super(VaultFix, self).get_parser(prog_name)
+        parser.add_argument('--jobs', type=int, default=8,
+                            help='Number of secrets to fix in parallel')
+        parser.add_argument('--key-file', action='append', default=[],
+                            help='Encrypted AES key file containing an old '
+                            'key (can be specified multiple times)')
+        parser.add_argument('--no-history', action='store_true',
+                            default=False,
+                            help="Don't look for old keys in the git history")
+        parser.add_argument('--legacy', action='store_true', default=False,
+                            help='Also upgrade secrets in the old file '
+                            'format (assumed to use the current key)')
+        _add_scope_argument(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        from password_manager.scanner import VaultScanner, STATUS_CURRENT
+
+        pm = self._get_password_manager(parsed_args)
+        scanner = VaultScanner(pm, max_workers=parsed_args.jobs)
+        statuses, stats = scanner.scan()
+        _log_scan(self.logger, statuses, stats)
+
+        keys = {}
+        for filename in parsed_args.key_file:
+            keys.update(scanner.read_key_file(filename))
+        wanted = set(x.key_id for x in statuses
+                     if x.key_id is not None and x.key_id not in keys and
+                     x.status != STATUS_CURRENT)
+        if wanted and not parsed_args.no_history:
+            keys.update(scanner.history_keys(wanted))
+
+        result, stats = scanner.fix(statuses, keys,
+                                    legacy=parsed_args.legacy)
+        for name in result['missing']:
+            self.logger.warning('No key to decrypt {0}'.format(name))
+        for name, error in result['failed']:
+            self.logger.error('Failed to fix {0}: {1}'.format(name, error))
+        self.logger.info(
+            'Fixed {0} secrets ({1} bytes) in {2:.2f}s ({3})'.format(
+                stats['count'], stats['bytes'], stats['elapsed'],
+                _throughput(stats)))
+        if result['missing'] or result['failed']:
+            return 1
+
+
+def _log_scan(logger, statuses, stats):
+    counts = {}
+    for status in statuses:
+        counts[status.status] = counts.get(status.status, 0) + 1
+    logger.info('Checked {0} secrets in {1:.2f}s ({2}): {3}'.format(
+        stats['count'], stats['elapsed'], _throughput(stats),
+        ', '.join('{0} {1}'.format(n, s) for s, n in sorted(counts.items()))
+        or 'nothing to do'))
+
+
+def _throughput(stats):
+    if not stats['elapsed']:
+        return '-'
+    return '{0:.0f} secrets/s'.format(stats['count'] / stats['elapsed'])
+
+
+class VaultConfig(PMLister):
+    """Show or change the vault settings"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def get_parser(self, prog_name):
+        from password_manager.storage import STORAGE_BACKENDS
+
+        parser = super(VaultConfig, self).get_parser(prog_name)
+        parser.add_argument('name', nargs='?', choices=sorted(CONFIG_OPTIONS))
+        parser.add_argument('value', nargs='?',
+                            help='true or false; for "storage", '
+                            'one of: {0}'.format(
+                                ', '.join(sorted(STORAGE_BACKENDS))))
+        return parser
+
+    def take_action(self, parsed_args):
+        from password_manager.storage import STORAGE_BACKENDS
+
+        pm = self._get_password_manager(parsed_args)
+        name, value = parsed_args.name, parsed_args.value
+        if value is None:
+            pass
+        elif name == 'storage':
+            if value not in STORAGE_BACKENDS:
+                raise ValueError('Unknown storage: {0}'.format(value))
+            count = pm.migrate_storage(value)
+            self.logger.info('Moved {0} secrets to the {1} storage'
+                             .format(count, value))
+        elif value in ('true', 'false'):
+            pm.write_config(**{name: value == 'true'})
+        else:
+            raise ValueError('Invalid value for {0}: {1}'
+                             .format(name, value))
+        config = dict(CONFIG_OPTIONS)
+        config.update(pm.read_config())
+        names = [parsed_args.name] if parsed_args.name else sorted(config)
+        return ('Name', 'Value'), [(x, config[x]) for x in names]
+
+
+class VaultCompact(PMCommand):
+    """Reclaim the space taken by old versions of packed secrets"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def take_action(self, parsed_args):
+        pm = self._get_password_manager(parsed_args)
+        reclaimed = pm.storage.compact()
+        self.logger.info('{0} bytes reclaimed'.format(reclaimed))
+
+
+class VaultExport(PMCommand):
+    """Export all the secrets to an encrypted archive"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def get_parser(self, prog_name):
+        parser = super(VaultExport, self).get_parser(prog_name)
+        parser.add_argument('filename',
+                            help='Archive to write ("-" for stdout)')
+        parser.add_argument('--recipient', action='append',
+                            help='GPG key to encrypt the archive for (can '
+                            'be specified multiple times; defaults to '
+                            'all the users of the vault)')
+        parser.add_argument('--jobs', type=int, default=8,
+                            help='Number of secrets to process in parallel')
+        return parser
+
+    def take_action(self, parsed_args):
+        from password_manager.archive import VaultArchive
+
+        pm = self._get_password_manager(parsed_args)
+        archive = VaultArchive(pm, max_workers=parsed_args.jobs)
+        if parsed_args.filename == '-':
+            stats = archive.export(get_binary_stream(self.app.stdout),
+                                   recipients=parsed_args.recipient)
+        else:
+            try:
+                with open(parsed_args.filename, 'wb') as fp:
+                    stats = archive.export(fp,
+                                           recipients=parsed_args.recipient)
+            except Exception:
+                # Don't leave a truncated archive around
+                if os.path.exists(parsed_args.filename):
+                    os.unlink(parsed_args.filename)
+                raise
+        self.logger.info(
+            'Exported {0} secrets ({1} bytes) in {2:.2f}s ({3})'.format(
+                stats['count'], stats['bytes'], stats['elapsed'],
+                _throughput(stats)))
+
+
+class VaultImport(PMCommand):
+    """Import the secrets from an archive made by vault export"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def get_parser(self, prog_name):
+        parser = super(VaultImport, self).get_parser(prog_name)
+        parser.add_argument('filename',
+                            help='Archive to read ("-" for stdin)')
+        parser.add_argument('--jobs', type=int, default=8,
+                            help='Number of secrets to process in parallel')
+        return parser
+
+    def take_action(self, parsed_args):
+        from password_manager.archive import VaultArchive
+
+        pm = self._get_password_manager(parsed_args)
+        archive = VaultArchive(pm, max_workers=parsed_args.jobs)
+        if parsed_args.filename == '-':
+            stats = archive.import_(get_binary_stream(self.app.stdin))
+        else:
+            with open(parsed_args.filename, 'rb') as fp:
+                stats = archive.import_(fp)
+        self.logger.info(
+            'Imported {0} secrets ({1} bytes, {2} changed) in {3:.2f}s '
+            '({4})'.format(stats['count'], stats['bytes'], stats['written'],
+                           stats['elapsed'], _throughput(stats)))
+
+
+class GitMerge(PMCommand):
+    """Git merge driver for secrets (see "git setup")"""
+
+    logger = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(GitMerge, self).get_parser(prog_name)
+        parser.add_argument('base')
+        parser.add_argument('ours')
+        parser.add_argument('theirs')
+        parser.add_argument('--marker-size', type=int, default=None)
+        parser.add_argument('--path')
+        return parser
+
+    def take_action(self, parsed_args):
+        from password_manager.gitmerge import merge_files
+
+        pm = self._get_password_manager(parsed_args)
+        codec = get_secret_codec(pm, parsed_args.path)
+        conflicts = merge_files(
+            codec, parsed_args.base, parsed_args.ours,
+            parsed_args.theirs, marker_size=parsed_args.marker_size,
+            path=parsed_args.path)
+        if conflicts:
+            self.logger.warning('{0}: {1} conflict(s)'.format(
+                parsed_args.path or parsed_args.ours, conflicts))
+            return 1
+
+
+class GitTextconv(PMCommand):
+    """Git textconv filter, to diff secrets (see "git setup")"""
+
+    logger = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(GitTextconv, self).get_parser(prog_name)
+        parser.add_argument('filename')
+        return parser
+
+    def take_action(self, parsed_args):
+        from password_manager.gitmerge import textconv
+
+        pm = self._get_password_manager(parsed_args)
+        codec = get_secret_codec(pm, os.path.abspath(parsed_args.filename))
+        data = textconv(codec, parsed_args.filename)
+        get_binary_stream(self.app.stdout).write(data)
+
+
+class GitSetup(PMCommand):
+    """Configure the git merge driver and diff filter for secrets"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def take_action(self, parsed_args):
+        from password_manager.gitmerge import setup_git
+
+        pm = self._get_password_manager(parsed_args)
+        setup_git(pm.basedir)
+        self.logger.info('Merge driver and diff filter configured; '
+                         'remember to commit .gitattributes')
+
+
+class Agent(PMCommand):
+    """Run an agent keeping the AES key in memory"""
+
+    logger = logging.getLogger(__name__)
+
+    use_agent = False
+
+    def get_parser(self, prog_name):
+        from password_manager.agent import DEFAULT_IDLE_TIMEOUT
+
+        parser = super(Agent, self).get_parser(prog_name)
+        parser.add_argument('--socket', help='Path of the agent socket')
+        parser.add_argument('--timeout', type=int,
+                            default=DEFAULT_IDLE_TIMEOUT,
+                            help='Exit after this many idle seconds '
+                            '(0 to run forever)')
+        return parser
+
+    def take_action(self, parsed_args):
+        from password_manager.agent import AgentServer
+
+        pm = self._get_password_manager(parsed_args)
+        server = AgentServer(pm, socket_path=parsed_args.socket,
+                             idle_timeout=parsed_args.timeout or None)
+        self.app.stdout.write(
+            'PM_AGENT_SOCK={0}; export PM_AGENT_SOCK;\n'
+            .format(server.socket_path))
+        self.app.stdout.flush()
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
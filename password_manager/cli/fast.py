@@ -0,0 +1,184 @@
+"""
+Fast path for the most frequently used commands.
+
+Loading cliff and discovering all the command plugins through entry
+points takes most of the run time of a command such as ``secret get``,
+which is often called in tight shell loops.  The commands below are
+recognized here and run directly; anything we don't fully understand
+(global options, ``--help``, other output formats, ..) is left to the
+full cliff application.
+
+Set ``PM_NO_FASTPATH=1`` in the environment to disable the fast path.
+"""
+
+import logging
+import os
+import shutil
+import sys
+
+from password_manager.cli.utils import (
+    get_binary_stream, get_password_manager, get_secret_codec, get_user_list)
+
+logger = logging.getLogger(__name__)
+
+
+def _parse(args, options=(), flags=(), positional=0):
+    """
+    Minimal parser for the options of the fast commands.
+
+    :return:
+        ``(values, positional_args)``, or ``None`` if the command
+        line contains anything unexpected.
+    """
+
+    values = {}
+    positionals = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('-'):
+            name, sep, value = arg.partition('=')
+            if name in flags and not sep:
+                values[name] = True
+            elif name in options:
+                if not sep:
+                    if not args:
+                        return None
+                    value = args.pop(0)
+                values[name] = value
+            elif arg[:2] in options and len(arg) > 2:  # eg. -fvalue
+                values[arg[:2]] = arg[2:]
+            else:
+                return None
+        else:
+            positionals.append(arg)
+    if len(positionals) != positional:
+        return None
+    return values, positionals
+
+
+def secret_get(args):
+    parsed = _parse(args, options=('--pm-home',), positional=1)
+    if parsed is None:
+        return None
+    values, (name,) = parsed
+
+    def _run():
+        pm = get_password_manager(values.get('--pm-home'))
+        with pm.open_secret(name, 'rb') as fp:
+            shutil.copyfileobj(fp, get_binary_stream(sys.stdout))
+
+    return _run
+
+
+def secret_put(args):
+    parsed = _parse(args, options=('--pm-home',), positional=1)
+    if parsed is None:
+        return None
+    values, (name,) = parsed
+
+    def _run():
+        pm = get_password_manager(values.get('--pm-home'))
+        with pm.open_secret(name, 'wb') as fp:
+            shutil.copyfileobj(get_binary_stream(sys.stdin), fp)
+
+    return _run
+
+
+def user_list(args):
+    parsed = _parse(args, options=('--pm-home', '-f', '--format'),
+                    flags=('--full',))
+    if parsed is None:
+        return None
+    values, _ = parsed
+
+    # Only the "value" format is supported here: tables are
+    # left to cliff, to keep the output consistent.
+    fmt = values.get('-f') or values.get('--format')
+    if fmt != 'value':
+        return None
+
+    def _run():
+        pm = get_password_manager(values.get('--pm-home'))
+        header, rows = get_user_list(pm, full=values.get('--full', False))
+        for row in rows:
+            sys.stdout.write(' '.join(row) + '\n')
+
+    return _run
+
+
+def git_merge(args):
+    parsed = _parse(args, options=('--pm-home', '--marker-size', '--path'),
+                    positional=3)
+    if parsed is None:
+        return None
+    values, (base, ours, theirs) = parsed
+
+    def _run():
+        from password_manager.gitmerge import merge_files
+
+        pm = get_password_manager(values.get('--pm-home'))
+        codec = get_secret_codec(pm, values.get('--path'))
+        marker_size = values.get('--marker-size')
+        conflicts = merge_files(
+            codec, base, ours, theirs,
+            marker_size=int(marker_size) if marker_size else None,
+            path=values.get('--path'))
+        if conflicts:
+            logger.warning('{0}: {1} conflict(s)'.format(
+                values.get('--path') or ours, conflicts))
+            return 1
+
+    return _run
+
+
+def git_textconv(args):
+    parsed = _parse(args, options=('--pm-home',), positional=1)
+    if parsed is None:
+        return None
+    values, (filename,) = parsed
+
+    def _run():
+        from password_manager.gitmerge import textconv
+
+        pm = get_password_manager(values.get('--pm-home'))
+        codec = get_secret_codec(pm, os.path.abspath(filename))
+        get_binary_stream(sys.stdout).write(textconv(codec, filename))
+
+    return _run
+
+
+COMMANDS = {
+    ('secret', 'get'): secret_get,
+    ('secret', 'put'): secret_put,
+    ('user', 'list'): user_list,
+    ('git', 'merge'): git_merge,
+    ('git', 'textconv'): git_textconv,
+}
+
+
+def dispatch(argv):
+    """
+    Run a command through the fast path, if possible.
+
+    :return:
+        the exit status, or ``None`` if the command must
+        be handled by the full cliff application.
+    """
+
+    command = COMMANDS.get(tuple(argv[:2]))
+    if command is None:
+        return None
+
+    run = command(argv[2:])
+    if run is None:
+        return None
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    try:
+        return run() or 0
+    except KeyboardInterrupt:
+        return 130
+    except Exception as e:
+        logger.error(e)
+        return 1
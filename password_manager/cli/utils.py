@@ -0,0 +1,111 @@
+"""
+Helpers shared by the cliff commands and the fast command path.
+
+This module must not import cliff.
+"""
+
+import os
+
+
+def get_binary_stream(stream):
+    """
+    Get the binary stream under a standard stream: on Python 3,
+    text streams carry it as ``.buffer``.
+    """
+
+    return getattr(stream, 'buffer', stream)
+
+
+def get_password_manager(pm_home=None, use_agent=True):
+    """
+    Get a password manager for the selected directory.
+
+    :param pm_home:
+        the passwords directory; defaults to ``$PM_HOME``
+        or the current directory.
+    :param use_agent:
+        if an agent is running for the directory, send
+        secret operations to it.
+    """
+
+    from password_manager import PasswordManager
+
+    if not pm_home:
+        if 'PM_HOME' in os.environ:
+            pm_home = os.environ['PM_HOME']
+        else:
+            pm_home = os.getcwd()
+    pm = PasswordManager(pm_home)
+    if use_agent:
+        from password_manager.agent import AgentClient, AgentPasswordManager
+        client = AgentClient.connect(pm_home)
+        if client is not None:
+            return AgentPasswordManager(client, pm)
+    return pm
+
+
+def get_secret_codec(pm, path=None):
+    """
+    Get the codec (see :py:func:`password_manager.gitmerge.get_codec`)
+    for a secret, using the key of the key scope holding it.
+
+    :param path:
+        path of the secret, relative to the vault (as passed by git
+        to the merge driver), or absolute; ``None`` if unknown, to
+        use the key of the vault itself.
+    """
+
+    from password_manager.gitmerge import get_codec
+
+    if path:
+        if os.path.isabs(path):
+            path = os.path.relpath(path, pm.basedir)
+        if not path.startswith(os.pardir):
+            scope = pm.get_scope(path)
+            if scope.basedir != pm.basedir:
+                # In a nested key scope: the agent only has our key
+                return get_codec(scope)
+    return get_codec(pm)
+
+
+def get_user_list(pm, full=False):
+    """
+    :return: ``(header, rows)`` describing the users
+    """
+
+    from password_manager.openpgp import OpenPGPError
+
+    # Read the exported public keys directly: the keys don't need
+    # to be in our keyring, and we don't need to ask gpg at all.
+    identities = sorted(pm.list_identities())
+    keys = {}
+    for identity in identities:
+        try:
+            keys[identity] = pm.read_gpg_pubkey(identity)
+        except (IOError, OpenPGPError):
+            pass
+    unparsed = [x for x in identities if x not in keys]
+    if unparsed:
+        keys.update(pm.resolve_gpg_keys(unparsed))
+
+    if full:
+        header = ('Fingerprint', 'Other subkeys', 'User id')
+        rows = []
+        for identity in identities:
+            key = keys[identity]
+            rows.append((
+                identity,
+                '\n'.join(sk.fpr for sk in key.subkeys),
+                '\n'.join(
+                    '{0} <{1}>'.format(u.name, u.email)
+                    for u in key.uids)
+            ))
+        return header, rows
+
+    header = ('Fingerprint', 'User id')
+    rows = []
+    for identity in identities:
+        key = keys[identity]
+        uids = ['{0} <{1}>'.format(u.name, u.email) for u in key.uids]
+        rows.append((identity, uids[0] if uids else ''))
+    return header, rows
@@ -0,0 +1,90 @@
+"""
+Pool of gpgme contexts, shared by all the PasswordManager instances.
+
+Creating and configuring a ``gpgme.Context`` is relatively
+expensive, so we keep idle contexts around (one pool per GnuPG home
+directory) and hand them out again on the next request.
+
+gpgme contexts must not be used by more than one thread at the same
+time: each context is checked out exclusively until it is returned
+to the pool.
+"""
+
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class ContextPool(object):
+    def __init__(self, max_idle=8):
+        """
+        :param max_idle:
+            maximum number of idle contexts kept for each gpghome;
+            extra contexts are simply discarded when released.
+        """
+        self.max_idle = max_idle
+        self.hits = 0
+        self.misses = 0
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def create(self, gpghome=None):
+        """Create a new gpgme Context, with correct gnupghome set"""
+
+        import gpgme
+
+        ctx = gpgme.Context()
+        if gpghome is not None:
+            ctx.set_engine_info(gpgme.PROTOCOL_OpenPGP, None, gpghome)
+        return ctx
+
+    def get(self, gpghome=None):
+        """Check out a context for the given gpghome"""
+
+        with self._lock:
+            idle = self._idle[gpghome]
+            if idle:
+                self.hits += 1
+                return idle.pop()
+            self.misses += 1
+        return self.create(gpghome)
+
+    def release(self, ctx, gpghome=None):
+        """Return a context to the pool"""
+
+        with self._lock:
+            idle = self._idle[gpghome]
+            if len(idle) < self.max_idle:
+                idle.append(ctx)
+
+    @contextmanager
+    def context(self, gpghome=None):
+        ctx = self.get(gpghome)
+        try:
+            yield ctx
+        finally:
+            self.release(ctx, gpghome)
+
+    def clear(self):
+        """Drop all the idle contexts"""
+
+        with self._lock:
+            self._idle.clear()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'idle': sum(len(x) for x in self._idle.values()),
+            }
+
+
+# Default pool, used by all PasswordManager instances
+default_pool = ContextPool()
@@ -0,0 +1,224 @@
+"""
+On-disk format of the secret files.
+
+Each secret is stored as::
+
+    magic (4) | version (1) | key id (8) | nonce (16) | ciphertext | tag (32)
+
+The data is encrypted with AES in CTR mode, starting from ``nonce``;
+``tag`` is a HMAC-SHA256 of everything before it (encrypt-then-MAC).
+Encryption and MAC keys are derived from the AES master key, whose
+id (see :py:func:`password_manager.aes_key_id`) is stored in the
+header: we can tell which key a file was encrypted with just by
+reading its first few bytes, and tampered or corrupted files are
+detected instead of decrypting to garbage.
+
+With a deterministic (synthetic) nonce, derived from the plaintext
+with HMAC, the same secret encrypted twice with the same key gives
+the same file: unchanged secrets don't show up in diffs, at the cost
+of revealing which secrets have identical contents.
+
+Files written by older versions (``iv (16) | AES-CFB ciphertext``,
+with no header) are still supported for reading; a legacy file has
+a 1 in 2^32 chance of starting with the magic number, in which case
+it will fail authentication, rather than being decrypted.
+"""
+
+import binascii
+import hashlib
+import hmac
+import struct
+from collections import namedtuple
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+from Crypto import Random
+
+from password_manager import PasswordManagerException, aes_key_id
+from password_manager.utils import buffer_view
+
+MAGIC = b'\x89PMS'
+VERSION = 1
+KEY_ID_SIZE = 8
+NONCE_SIZE = AES.block_size
+HEADER_SIZE = len(MAGIC) + 1 + KEY_ID_SIZE + NONCE_SIZE
+TAG_SIZE = hashlib.sha256().digest_size
+
+# Old format: IV + AES-CFB ciphertext
+LEGACY_IV_SIZE = AES.block_size
+
+
+class SecretFormatError(PasswordManagerException):
+    """The secret file is corrupt, or in an unsupported format"""
+
+
+class WrongKeyError(SecretFormatError):
+    """The secret was encrypted with a different AES key"""
+
+    def __init__(self, key_id, expected_key_id):
+        super(WrongKeyError, self).__init__(
+            "Secret was encrypted with key {0}, not {1}"
+            .format(key_id, expected_key_id))
+        self.key_id = key_id
+        self.expected_key_id = expected_key_id
+
+
+class SecretHeader(namedtuple('SecretHeader', 'version,key_id,nonce')):
+    """
+    Header of a secret file.
+
+    ``key_id`` is the (hex) id of the AES key used for encryption.
+    """
+
+    def pack(self):
+        return (MAGIC + struct.pack('B', self.version) +
+                binascii.unhexlify(self.key_id) + self.nonce)
+
+
+def parse_header(data):
+    """
+    Parse the header from the first bytes of a secret file.
+
+    :param data: at least the first ``HEADER_SIZE`` bytes of the file
+    :return: a :py:class:`SecretHeader`, or ``None`` for legacy files
+    """
+
+    data = bytes(data[:HEADER_SIZE])
+    if len(data) < HEADER_SIZE or not data.startswith(MAGIC):
+        return None
+    offset = len(MAGIC)
+    version = ord(data[offset:offset + 1])
+    if version != VERSION:
+        raise SecretFormatError(
+            "Unsupported secret format version: {0}".format(version))
+    offset += 1
+    key_id = binascii.hexlify(data[offset:offset + KEY_ID_SIZE])
+    offset += KEY_ID_SIZE
+    return SecretHeader(version, key_id.decode('ascii'),
+                        data[offset:offset + NONCE_SIZE])
+
+
+def plaintext_size(size, header):
+    """Size of the plaintext of a secret file ``size`` bytes long"""
+
+    if header is None:
+        return max(0, size - LEGACY_IV_SIZE)
+    return max(0, size - HEADER_SIZE - TAG_SIZE)
+
+
+def _derive_keys(aes_key):
+    enc_key = hmac.new(aes_key, b'password-manager encryption',
+                       hashlib.sha256).digest()
+    mac_key = hmac.new(aes_key, b'password-manager authentication',
+                       hashlib.sha256).digest()
+    return enc_key, mac_key
+
+
+def content_digest(aes_key):
+    """
+    Keyed digest of a plaintext (a ``hmac`` object, to be fed
+    with the data), used to compare secrets without keeping
+    them around, and as synthetic nonce.
+    """
+
+    siv_key = hmac.new(aes_key, b'password-manager synthetic nonce',
+                       hashlib.sha256).digest()
+    return hmac.new(siv_key, digestmod=hashlib.sha256)
+
+
+def synthetic_nonce(aes_key, data):
+    """Deterministic nonce for encrypting ``data``"""
+
+    digest = content_digest(aes_key)
+    digest.update(data)
+    return digest.digest()[:NONCE_SIZE]
+
+
+def _new_cipher(enc_key, nonce):
+    counter = Counter.new(
+        128, initial_value=int(binascii.hexlify(nonce), 16))
+    return AES.new(enc_key, AES.MODE_CTR, counter=counter)
+
+
+class Encryptor(object):
+    """
+    Incrementally encrypt a secret.
+
+    Write :py:attr:`header`, then the output of :py:meth:`update`
+    for all the data, then the tag returned by :py:meth:`finalize`.
+    """
+
+    def __init__(self, key, nonce=None):
+        if nonce is None:
+            nonce = Random.new().read(NONCE_SIZE)
+        enc_key, mac_key = _derive_keys(key)
+        self.header = SecretHeader(VERSION, aes_key_id(key), nonce).pack()
+        self.cipher = _new_cipher(enc_key, nonce)
+        self.mac = hmac.new(mac_key, self.header, hashlib.sha256)
+
+    def update(self, data):
+        encrypted = self.cipher.encrypt(data)
+        self.mac.update(encrypted)
+        return encrypted
+
+    def finalize(self):
+        return self.mac.digest()
+
+
+class Decryptor(object):
+    """
+    Incrementally decrypt a secret.
+
+    Feed the ciphertext to :py:meth:`update`, then check the
+    tag with :py:meth:`finalize`: until then, the returned
+    plaintext must not be trusted.
+
+    :raises WrongKeyError: if ``key`` is not the one used for encryption
+    """
+
+    def __init__(self, key, header):
+        expected = aes_key_id(key)
+        if header.key_id != expected:
+            raise WrongKeyError(header.key_id, expected)
+        enc_key, mac_key = _derive_keys(key)
+        self.cipher = _new_cipher(enc_key, header.nonce)
+        self.mac = hmac.new(mac_key, header.pack(), hashlib.sha256)
+
+    def update(self, data):
+        self.mac.update(data)
+        return self.cipher.decrypt(data)
+
+    def finalize(self, tag):
+        if not hmac.compare_digest(self.mac.digest(), bytes(tag)):
+            raise SecretFormatError("Secret authentication failed")
+
+
+def encrypt(key, data, deterministic=False):
+    """
+    Encrypt a whole secret.
+
+    :param deterministic: use a synthetic nonce, derived from ``data``
+    """
+
+    nonce = synthetic_nonce(key, data) if deterministic else None
+    encryptor = Encryptor(key, nonce=nonce)
+    return encryptor.header + encryptor.update(data) + encryptor.finalize()
+
+
+def decrypt(key, data):
+    """
+    Decrypt a whole secret, in the current format.
+
+    :raises SecretFormatError: if the data is corrupt or not authentic
+    """
+
+    header = parse_header(data)
+    if header is None:
+        raise SecretFormatError("Not a secret file")
+    if len(data) < HEADER_SIZE + TAG_SIZE:
+        raise SecretFormatError("Truncated secret file")
+    end = len(data) - TAG_SIZE
+    decryptor = Decryptor(key, header)
+    plaintext = decryptor.update(buffer_view(data, HEADER_SIZE, end))
+    decryptor.finalize(data[end:])
+    return plaintext
@@ -0,0 +1,267 @@
+"""
+Git integration: merge driver and diff text conversion for secrets.
+
+Since each secret is encrypted with a random nonce, two versions of a
+secret never have anything in common as far as git is concerned:
+every concurrent change becomes a conflict, and diffs are useless.
+
+The merge driver decrypts the three versions (base, ours, theirs) in
+memory, merges the plaintext (see :py:mod:`password_manager.merge`)
+and encrypts the result with the current AES key; the textconv filter
+lets ``git diff`` / ``git log -p`` show the plaintext.  Plaintext is
+never written to disk, except for conflict markers being encrypted
+along with the rest of the secret.
+
+Each version can be encrypted with a different AES key (eg. when
+merging a branch where the key was regenerated): old keys are looked
+up in the git history of ``.keys`` (see
+:py:meth:`~password_manager.scanner.VaultScanner.history_keys`).
+
+git runs the driver once per file: when an agent is running (see
+:py:mod:`password_manager.agent`), decryption and encryption are
+sent to it, so the AES keys are unwrapped only once per merge, rather
+than once per file.
+
+Files that are not secrets (a README, secrets in the legacy format,
+..) are merged with ``git merge-file``, and diffed as they are.
+
+Use :py:func:`setup_git` (``password_manager git setup``) to enable
+the driver in a repository.
+"""
+
+import os
+import subprocess
+import threading
+
+from password_manager import PasswordManagerException, aes_key_id
+
+DRIVER_NAME = 'password-manager'
+
+# Secret names can't start with a dot: leave hidden files alone, and
+# the key files and packed storage (see password_manager.storage) of
+# every key scope.
+GITATTRIBUTES = (
+    '* merge={0} diff={0}\n'
+    '.* merge diff\n'
+    '.secrets.pack -merge -diff\n'
+    '**/.keys/** -merge -diff\n'
+).format(DRIVER_NAME)
+
+
+class SecretCodec(object):
+    """
+    Encrypt and decrypt secret data, keeping all the
+    AES keys used so far in memory.
+    """
+
+    def __init__(self, pm, current_key=None, history=True):
+        """
+        :param pm: the :py:class:`~password_manager.PasswordManager`
+        :param current_key: the current AES key, if already known
+        :param history: look for old keys in the git history
+        """
+        self.pm = pm
+        self.history = history
+        self._current_key = current_key
+        self._keys = {}
+        self._missing = set()
+        self._lock = threading.Lock()
+
+    @property
+    def current_key(self):
+        with self._lock:
+            if self._current_key is None:
+                self._current_key = self.pm.get_aes_key()
+            return self._current_key
+
+    def get_key(self, key_id):
+        """
+        Get an AES key by id.
+
+        :raises PasswordManagerException: if the key can't be found
+        """
+
+        current_key = self.current_key
+        if key_id == aes_key_id(current_key):
+            return current_key
+
+        with self._lock:
+            if key_id not in self._keys and key_id not in self._missing:
+                if self.history:
+                    from password_manager.scanner import VaultScanner
+                    scanner = VaultScanner(self.pm)
+                    self._keys.update(scanner.history_keys([key_id]))
+                if key_id not in self._keys:
+                    self._missing.add(key_id)
+            if key_id in self._keys:
+                return self._keys[key_id]
+        raise PasswordManagerException(
+            "AES key {0} not found".format(key_id))
+
+    def add_key(self, aes_key):
+        """Make an old AES key known"""
+
+        with self._lock:
+            self._keys[aes_key_id(aes_key)] = aes_key
+            self._missing.discard(aes_key_id(aes_key))
+
+    def decrypt(self, data):
+        """
+        Decrypt data encrypted with any known AES key.
+
+        :raises SecretFormatError: if ``data`` is not a secret in the
+            current format (legacy secrets can't be told apart from
+            any other file)
+        """
+
+        from password_manager.fileformat import (
+            SecretFormatError, parse_header)
+
+        header = parse_header(data)
+        if header is None:
+            raise SecretFormatError("Not a secret file")
+        return self.pm.aes_decrypt(data, key=self.get_key(header.key_id))
+
+    def encrypt(self, data):
+        """Encrypt data with the current AES key"""
+
+        return self.pm.aes_encrypt(data, key=self.current_key)
+
+    def is_current(self, data):
+        """Whether data is encrypted with the current AES key"""
+
+        from password_manager.fileformat import parse_header
+
+        header = parse_header(data)
+        return (header is not None and
+                header.key_id == aes_key_id(self.current_key))
+
+    def forget(self):
+        with self._lock:
+            self._current_key = None
+            self._keys.clear()
+            self._missing.clear()
+
+
+def get_codec(pm):
+    """
+    Get an object to encrypt / decrypt secret data for ``pm``:
+    the agent client, if ``pm`` talks to an agent, or a
+    :py:class:`SecretCodec`.
+    """
+
+    agent = getattr(pm, 'agent', None)
+    if agent is not None:
+        return agent
+    return SecretCodec(pm)
+
+
+def merge_files(codec, base_file, ours_file, theirs_file,
+                marker_size=None, path=None):
+    """
+    Merge driver: merge three encrypted versions of a secret,
+    writing the result to ``ours_file``.
+
+    Files that are not secrets are merged by ``git merge-file``.
+
+    :return: the number of conflicts
+    """
+
+    from password_manager.fileformat import parse_header
+    from password_manager.merge import merge3, MARKER_SIZE
+    from password_manager.utils import write_file_atomic
+
+    versions = []
+    for filename in (base_file, ours_file, theirs_file):
+        with open(filename, 'rb') as fp:
+            versions.append(fp.read())
+    if not all(parse_header(x) is not None for x in versions if x):
+        return _git_merge_file(base_file, ours_file, theirs_file,
+                               marker_size=marker_size, path=path)
+    base, ours, theirs = [codec.decrypt(x) if x else b''
+                          for x in versions]
+
+    labels = ('ours', 'theirs')
+    if path is not None:
+        labels = tuple('{0} ({1})'.format(path, x) for x in labels)
+    merged, conflicts = merge3(base, ours, theirs,
+                               marker_size=marker_size or MARKER_SIZE,
+                               labels=labels)
+
+    # Avoid rewriting a side that is already the result (same
+    # plaintext, same key), so that the file doesn't change.
+    for data, plaintext in ((versions[1], ours), (versions[2], theirs)):
+        if merged == plaintext and codec.is_current(data):
+            result = data
+            break
+    else:
+        result = codec.encrypt(merged)
+
+    if result != versions[1]:
+        write_file_atomic(ours_file, result)
+    return conflicts
+
+
+def _git_merge_file(base_file, ours_file, theirs_file,
+                    marker_size=None, path=None):
+    """Plain ``git merge-file``, for files that are not secrets"""
+
+    labels = ('ours', 'base', 'theirs')
+    if path is not None:
+        labels = tuple('{0} ({1})'.format(path, x) for x in labels)
+    command = ['git', 'merge-file']
+    for label in labels:
+        command += ['-L', label]
+    if marker_size:
+        command.append('--marker-size={0}'.format(marker_size))
+    command += [ours_file, base_file, theirs_file]
+
+    # The exit status is the number of conflicts, or negative on error
+    status = subprocess.call(command)
+    if not 0 <= status < 128:
+        raise PasswordManagerException(
+            "git merge-file failed on {0}".format(path or ours_file))
+    return status
+
+
+def textconv(codec, filename):
+    """
+    Textconv filter: get the plaintext of a secret file
+    (or the file as it is, if it's not a secret)
+    """
+
+    from password_manager.fileformat import parse_header
+
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    if parse_header(data) is None:
+        return data
+    return codec.decrypt(data)
+
+
+def setup_git(basedir):
+    """
+    Enable the merge driver and textconv filter in the git
+    repository containing ``basedir``.
+    """
+
+    command = 'password_manager git'
+    settings = [
+        ('merge.{0}.name'.format(DRIVER_NAME), 'password manager secrets'),
+        ('merge.{0}.driver'.format(DRIVER_NAME),
+         command + ' merge %O %A %B --marker-size %L --path %P'),
+        ('diff.{0}.textconv'.format(DRIVER_NAME), command + ' textconv'),
+    ]
+    for name, value in settings:
+        subprocess.check_call(['git', 'config', name, value], cwd=basedir)
+
+    filename = os.path.join(basedir, '.gitattributes')
+    existing = ''
+    if os.path.exists(filename):
+        with open(filename, 'r') as fp:
+            existing = fp.read()
+    if GITATTRIBUTES not in existing:
+        with open(filename, 'a') as fp:
+            if existing and not existing.endswith('\n'):
+                fp.write('\n')
+            fp.write(GITATTRIBUTES)
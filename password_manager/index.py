@@ -0,0 +1,265 @@
+"""
+Index of the secret files in a vault.
+
+Walking the whole directory tree to find secrets gets slow on large
+vaults; instead, we keep a list of secret paths (with their size and
+mtime) in ``.keys/.index``, along with the mtime of every directory
+containing secrets.
+
+Adding, removing or renaming a file changes the mtime of its parent
+directory, so checking whether the index is up to date only requires
+a ``stat()`` per directory; directories that did change are re-scanned
+(non-recursively, unless new sub-directories appeared).  Key scopes
+(see :py:meth:`~password_manager.PasswordManager.get_scope`) have
+an index of their own, and are left out.
+
+Within :py:meth:`~password_manager.PasswordManager.batch_updates`,
+the changes to the index are deferred and saved once, at the end.
+
+The index is local state: it is kept out of version control through
+``.keys/.gitignore``.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from password_manager.utils import ensure_gitignored, write_file_atomic
+
+INDEX_VERSION = 1
+
+
+class SecretIndex(object):
+    def __init__(self, pm):
+        self.pm = pm
+        # Deferred updates: relpath -> whether it was deleted
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    @property
+    def filename(self):
+        return os.path.join(self.pm.keydir, '.index')
+
+    @property
+    def lock_filename(self):
+        return os.path.join(self.pm.keydir, '.index.lock')
+
+    def list(self):
+        """
+        Get the paths of all secrets, relative to the base directory.
+        """
+
+        with self._locked():
+            data = self._load()
+            if self._refresh(data):
+                self._save(data)
+        return sorted(data['secrets'])
+
+    def get(self, relpath):
+        """
+        :return: ``(size, mtime)`` of a secret, or ``None``
+        """
+
+        with self._locked():
+            data = self._load()
+            if self._refresh(data):
+                self._save(data)
+        return data['secrets'].get(relpath)
+
+    def update(self, relpath):
+        """Record a secret that was just written"""
+
+        self._apply({relpath: False})
+
+    def remove(self, relpath):
+        """Forget a secret that was just deleted"""
+
+        self._apply({relpath: True})
+
+    def flush(self):
+        """Save the updates deferred so far (see :py:meth:`update`)"""
+
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            self._save_changes(pending)
+
+    def remove_dir(self, reldir):
+        """Forget a directory, and the secrets in it"""
+
+        with self._locked():
+            data = self._load()
+            self._drop_dir(data, reldir)
+            self._save(data)
+
+    def rebuild(self):
+        """Discard the index and scan the whole directory again"""
+
+        with self._locked():
+            data = self._empty()
+            self._scan_dir(data, '', recursive=True)
+            self._save(data)
+
+    # ----------------------------------------------------------------------
+
+    def _apply(self, changes):
+        if self.pm._deferring_updates():
+            with self._pending_lock:
+                self._pending.update(changes)
+        else:
+            self._save_changes(changes)
+
+    def _save_changes(self, changes):
+        """
+        Record secrets written or deleted (``changes`` maps their
+        paths to whether they were deleted) in the index.
+        """
+
+        with self._locked():
+            data = self._load()
+            # Pick up changes made by others before stamping the
+            # directories' new mtime, or they would never be seen.
+            self._refresh(data)
+            for relpath, deleted in sorted(changes.items()):
+                st = None
+                if not deleted:
+                    try:
+                        st = os.stat(os.path.join(self.pm.basedir, relpath))
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                if st is None:
+                    data['secrets'].pop(relpath, None)
+                else:
+                    data['secrets'][relpath] = [st.st_size, st.st_mtime]
+            for reldir in set(os.path.dirname(x) for x in changes):
+                self._update_dir(data, reldir)
+            self._save(data)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_filename, 'a') as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def _empty(self):
+        return {'version': INDEX_VERSION, 'dirs': {}, 'secrets': {}}
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as fp:
+                data = json.loads(fp.read().decode('utf-8'))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            data = None
+        except ValueError:
+            data = None  # Corrupted: just rebuild
+
+        if data is None or data.get('version') != INDEX_VERSION:
+            data = self._empty()
+            self._scan_dir(data, '', recursive=True)
+            self._save(data)
+        return data
+
+    def _save(self, data):
+        self._ensure_ignored()
+        write_file_atomic(self.filename, json.dumps(data).encode('utf-8'))
+
+    def _ensure_ignored(self):
+        ensure_gitignored(self.pm.keydir, ['/.index', '/.index.lock'])
+
+    def _refresh(self, data):
+        """
+        Re-scan the directories that changed since the last update.
+
+        :return: whether anything changed
+        """
+
+        changed = False
+        for reldir, mtime in sorted(data['dirs'].items()):
+            if reldir not in data['dirs']:
+                continue  # Dropped along with its parent
+            try:
+                st = os.stat(os.path.join(self.pm.basedir, reldir))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._drop_dir(data, reldir)
+                changed = True
+                continue
+            if st.st_mtime != mtime:
+                self._scan_dir(data, reldir)
+                changed = True
+        return changed
+
+    def _scan_dir(self, data, reldir, recursive=False):
+        """
+        Scan a directory, updating the index.
+
+        Sub-directories are scanned only if they are not yet
+        in the index, or ``recursive`` is set.
+        """
+
+        dirname = os.path.join(self.pm.basedir, reldir)
+        if reldir and self.pm._is_scope_dir(dirname):
+            # Just became a key scope (which changed its mtime)
+            self._drop_dir(data, reldir)
+            return
+        data['dirs'][reldir] = os.stat(dirname).st_mtime
+
+        found = set()
+        subdirs = set()
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            relpath = os.path.join(reldir, name)
+            if os.path.isdir(path):
+                if (not name.startswith('.') and
+                        not self.pm._is_scope_dir(path)):
+                    subdirs.add(relpath)
+                continue
+            if not self.pm._is_secret_file(name):
+                continue
+            st = os.stat(path)
+            data['secrets'][relpath] = [st.st_size, st.st_mtime]
+            found.add(relpath)
+
+        # Files removed from this directory
+        for relpath in list(data['secrets']):
+            if (os.path.dirname(relpath) == reldir and
+                    relpath not in found):
+                del data['secrets'][relpath]
+
+        # Directories removed from this directory
+        for other in list(data['dirs']):
+            if (other and os.path.dirname(other) == reldir and
+                    other not in subdirs):
+                self._drop_dir(data, other)
+
+        for subdir in sorted(subdirs):
+            if recursive or subdir not in data['dirs']:
+                self._scan_dir(data, subdir, recursive=True)
+
+    def _drop_dir(self, data, reldir):
+        prefix = os.path.join(reldir, '')
+        for other in list(data['dirs']):
+            if other == reldir or other.startswith(prefix):
+                del data['dirs'][other]
+        for relpath in list(data['secrets']):
+            if relpath.startswith(prefix):
+                del data['secrets'][relpath]
+
+    def _update_dir(self, data, reldir):
+        if reldir not in data['dirs']:
+            return  # Will be picked up by the next refresh
+        try:
+            st = os.stat(os.path.join(self.pm.basedir, reldir))
+        except OSError:
+            return
+        data['dirs'][reldir] = st.st_mtime
@@ -0,0 +1,153 @@
+"""
+Timing instrumentation for the password manager operations.
+
+The main :py:class:`~password_manager.PasswordManager` operations
+(AES key handling, encryption, GPG key listings, ..) are wrapped with
+:py:func:`instrumented`: when at least one hook is registered, each
+call is timed and reported to the hooks as ``hook(name, elapsed,
+error)``; otherwise, the overhead is a single check.  Timings are
+inclusive: eg. ``get_aes_key`` includes the ``read_aes_key`` it may
+trigger.
+
+:py:class:`CallStats` is a hook collecting per-operation call counts
+and timings, which can be printed or exported::
+
+    stats = CallStats()
+    add_hook(stats)
+    try:
+        pm.read_secret('example')
+    finally:
+        remove_hook(stats)
+    print(stats.format())
+"""
+
+import functools
+import inspect
+import json
+import threading
+import time
+from timeit import default_timer
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """Register a callable, called as ``hook(name, elapsed, error)``"""
+
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + [hook]
+
+
+def remove_hook(hook):
+    global _hooks
+    with _hooks_lock:
+        _hooks = [x for x in _hooks if x is not hook]
+
+
+def record(name, elapsed, error=None):
+    """Report a timing to all the hooks"""
+
+    for hook in _hooks:
+        hook(name, elapsed, error)
+
+
+def instrumented(name):
+    """
+    Decorator timing calls to a function, as operation ``name``.
+
+    For generator functions, the time spent iterating is measured.
+    """
+
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not _hooks:
+                    for item in func(*args, **kwargs):
+                        yield item
+                    return
+                elapsed = 0
+                iterator = func(*args, **kwargs)
+                while True:
+                    start = default_timer()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        record(name, elapsed + default_timer() - start)
+                        return
+                    except Exception as e:
+                        record(name, elapsed + default_timer() - start, e)
+                        raise
+                    elapsed += default_timer() - start
+                    yield item
+            return wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _hooks:
+                return func(*args, **kwargs)
+            start = default_timer()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                record(name, default_timer() - start, e)
+                raise
+            record(name, default_timer() - start)
+            return result
+        return wrapper
+
+    return decorator
+
+
+class CallStats(object):
+    """Hook collecting call counts and timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def __call__(self, name, elapsed, error=None):
+        with self._lock:
+            item = self.stats.get(name)
+            if item is None:
+                item = self.stats[name] = {
+                    'calls': 0, 'errors': 0, 'total': 0.0,
+                    'min': elapsed, 'max': elapsed,
+                }
+            item['calls'] += 1
+            item['total'] += elapsed
+            item['min'] = min(item['min'], elapsed)
+            item['max'] = max(item['max'], elapsed)
+            if error is not None:
+                item['errors'] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return dict((name, dict(item))
+                        for name, item in self.stats.items())
+
+    def format(self):
+        """Table of the operations, slowest first"""
+
+        lines = ['{0:<28} {1:>6} {2:>10} {3:>10} {4:>10}'.format(
+            'Operation', 'Calls', 'Total (s)', 'Mean (ms)', 'Max (ms)')]
+        stats = self.to_dict()
+        for name in sorted(stats, key=lambda x: -stats[x]['total']):
+            item = stats[name]
+            lines.append('{0:<28} {1:>6} {2:>10.4f} {3:>10.2f} {4:>10.2f}'
+                         .format(name, item['calls'], item['total'],
+                                 1000 * item['total'] / item['calls'],
+                                 1000 * item['max']))
+        return '\n'.join(lines)
+
+    def export(self, filename, **extra):
+        """
+        Append the stats to ``filename``, as a JSON line (along with a
+        timestamp and ``extra`` fields), for later aggregation.
+        """
+
+        record = dict(extra, timestamp=time.time(), stats=self.to_dict())
+        with open(filename, 'a') as fp:
+            fp.write(json.dumps(record, sort_keys=True) + '\n')
@@ -0,0 +1,158 @@
+"""
+Cache of the GnuPG keyring metadata.
+
+Listing keys means a round-trip to gpg (and, with GnuPG 2, to the
+agent) every time: looking up the 100 users of a team one by one, or
+listing our private keys before every unkeyed decryption, adds up.
+
+The key objects returned by gpgme (fingerprints, sub-keys, user ids,
+whether the secret key is available, ..) are kept in memory, and
+thrown away as soon as the keyring files in the GnuPG home directory
+change, however they were changed (our own imports, another gpg
+process, ..).  At most ``max_size`` keys are kept, evicting the least
+recently used ones.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+# Files and directories holding the keys, for GnuPG 1.x and 2.x
+KEYRING_FILES = (
+    'pubring.gpg',
+    'pubring.kbx',
+    'secring.gpg',
+    'private-keys-v1.d',
+)
+
+
+def get_gpghome(gpghome=None):
+    """The GnuPG home directory gpg will actually use"""
+
+    if gpghome is not None:
+        return gpghome
+    if os.environ.get('GNUPGHOME'):
+        return os.environ['GNUPGHOME']
+    return os.path.join(os.path.expanduser('~'), '.gnupg')
+
+
+class KeyringCache(object):
+    def __init__(self, gpghome=None, max_size=256):
+        """
+        :param gpghome: GnuPG home directory (defaults to GNUPGHOME)
+        :param max_size:
+            maximum number of keys kept in memory (full listings
+            are not counted). Use ``0`` to disable caching.
+        """
+        self.gpghome = gpghome
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._listings = {}
+        self._state = None
+        self._lock = threading.Lock()
+
+    def _keyring_state(self):
+        """
+        Identify the current version of the keyring files.
+
+        gpg replaces the keyrings with renamed temporary files, so
+        the inode changes as well: we don't depend on the resolution
+        of the modification time alone.
+        """
+
+        home = get_gpghome(self.gpghome)
+        state = []
+        for name in KEYRING_FILES:
+            try:
+                st = os.stat(os.path.join(home, name))
+            except OSError:
+                continue
+            state.append((name, st.st_ino, st.st_size,
+                          st.st_mtime, st.st_ctime))
+        return tuple(state)
+
+    def _check(self):
+        """Drop everything if the keyring changed (lock held)"""
+
+        state = self._keyring_state()
+        if state != self._state:
+            self._keys.clear()
+            self._listings.clear()
+            self._state = state
+
+    def get(self, name):
+        """
+        Get a cached key by name (fingerprint, key id or user id
+        it was looked up with), or ``None``.
+        """
+
+        if not self.max_size:
+            return None
+        with self._lock:
+            self._check()
+            key = self._keys.get(name)
+            if key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Move to the end (most recently used)
+            del self._keys[name]
+            self._keys[name] = key
+            return key
+
+    def put(self, name, key):
+        """Cache a key, as looked up by ``name`` and its fingerprint"""
+
+        if not self.max_size:
+            return
+        with self._lock:
+            self._check()
+            for _name in (name, key.subkeys[0].fpr):
+                self._keys.pop(_name, None)
+                self._keys[_name] = key
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def get_listing(self, secret=False):
+        """Get the cached listing of all the (secret) keys, or ``None``"""
+
+        if not self.max_size:
+            return None
+        with self._lock:
+            self._check()
+            listing = self._listings.get(secret)
+            if listing is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return listing
+
+    def put_listing(self, keys, secret=False):
+        """
+        Cache the listing of all the (secret) keys; public keys are
+        also made available to :py:meth:`get`, by fingerprint.
+        """
+
+        if not self.max_size:
+            return
+        keys = list(keys)
+        with self._lock:
+            self._check()
+            self._listings[secret] = keys
+        if not secret:
+            for key in keys[:self.max_size]:
+                self.put(key.subkeys[0].fpr, key)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+            self._listings.clear()
+            self._state = None
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._keys)}
@@ -0,0 +1,135 @@
+"""
+Three-way merge of (decrypted) secrets, in memory.
+
+This is the classic diff3 algorithm: find the regions of the base
+version left unchanged by both sides, then, for each region in between
+them, take whichever side changed it, or report a conflict if both did
+(in different ways).
+"""
+
+from difflib import SequenceMatcher
+
+MARKER_SIZE = 7
+
+
+def merge3(base, ours, theirs, marker_size=MARKER_SIZE,
+           labels=('ours', 'theirs')):
+    """
+    Merge the changes made to ``base`` by ``ours`` and ``theirs``.
+
+    Data is merged line by line; binary data (containing NUL bytes)
+    can only be merged if at most one side changed it.
+
+    :param base, ours, theirs: the three versions, as bytes
+    :return:
+        ``(merged, conflicts)``: the merged data, with conflict
+        markers in case of conflicts, and the number of conflicts.
+        When binary data can't be merged, ``ours`` is returned.
+    """
+
+    if ours == theirs or theirs == base:
+        return ours, 0
+    if ours == base:
+        return theirs, 0
+    if any(b'\0' in x for x in (base, ours, theirs)):
+        return ours, 1
+
+    base_lines = base.splitlines(True)
+    ours_lines = ours.splitlines(True)
+    theirs_lines = theirs.splitlines(True)
+
+    output = []
+    conflicts = 0
+    for region in _merge_regions(base_lines, ours_lines, theirs_lines):
+        if region[0] != 'conflict':
+            output.extend(region[1])
+            continue
+        conflicts += 1
+        ours_part, theirs_part = region[1], region[2]
+        output.append(b'<' * marker_size + b' ' +
+                      labels[0].encode('utf-8') + b'\n')
+        output.extend(_terminated(ours_part))
+        output.append(b'=' * marker_size + b'\n')
+        output.extend(_terminated(theirs_part))
+        output.append(b'>' * marker_size + b' ' +
+                      labels[1].encode('utf-8') + b'\n')
+    return b''.join(output), conflicts
+
+
+def _terminated(lines):
+    """Make sure the last line ends with a newline"""
+
+    if lines and not lines[-1].endswith(b'\n'):
+        return lines[:-1] + [lines[-1] + b'\n']
+    return lines
+
+
+def _merge_regions(base, ours, theirs):
+    """
+    :return:
+        iterator of ``('ok', lines)`` and
+        ``('conflict', ours_lines, theirs_lines)``
+    """
+
+    i_base = i_ours = i_theirs = 0
+    for sync in _sync_regions(base, ours, theirs):
+        base_start, base_end, ours_start, ours_end, theirs_start, \
+            theirs_end = sync
+
+        # Lines between the previous stable region and this one
+        base_chunk = base[i_base:base_start]
+        ours_chunk = ours[i_ours:ours_start]
+        theirs_chunk = theirs[i_theirs:theirs_start]
+
+        if ours_chunk == theirs_chunk:
+            yield 'ok', ours_chunk
+        elif ours_chunk == base_chunk:
+            yield 'ok', theirs_chunk
+        elif theirs_chunk == base_chunk:
+            yield 'ok', ours_chunk
+        else:
+            yield 'conflict', ours_chunk, theirs_chunk
+
+        # The stable region itself
+        yield 'ok', base[base_start:base_end]
+        i_base, i_ours, i_theirs = base_end, ours_end, theirs_end
+
+
+def _sync_regions(base, ours, theirs):
+    """
+    Find the regions of ``base`` unchanged in both versions.
+
+    :return:
+        list of ``(base_start, base_end, ours_start, ours_end,
+        theirs_start, theirs_end)``, ending with an empty region
+        at the end of all the versions.
+    """
+
+    ours_matches = SequenceMatcher(
+        None, base, ours, autojunk=False).get_matching_blocks()
+    theirs_matches = SequenceMatcher(
+        None, base, theirs, autojunk=False).get_matching_blocks()
+
+    regions = []
+    i = j = 0
+    while i < len(ours_matches) and j < len(theirs_matches):
+        o_base, o_start, o_len = ours_matches[i]
+        t_base, t_start, t_len = theirs_matches[j]
+
+        start = max(o_base, t_base)
+        end = min(o_base + o_len, t_base + t_len)
+        if start < end:
+            length = end - start
+            o_sync = o_start + (start - o_base)
+            t_sync = t_start + (start - t_base)
+            regions.append((start, end, o_sync, o_sync + length,
+                            t_sync, t_sync + length))
+
+        if o_base + o_len < t_base + t_len:
+            i += 1
+        else:
+            j += 1
+
+    regions.append((len(base), len(base), len(ours), len(ours),
+                    len(theirs), len(theirs)))
+    return regions
@@ -0,0 +1,172 @@
+"""
+Minimal OpenPGP packet reader (RFC 4880).
+
+Only what we need to handle exported public keys: splitting a stream
+of packets, computing key fingerprints and reading user ids.  This is
+enough to describe the users of a vault from the ``.keys/*.pub`` files
+alone, without importing them into the keyring.
+
+Signatures are *not* verified: use the keyring (through gpgme) for
+anything security-relevant, such as choosing the keys to encrypt for.
+"""
+
+import base64
+import hashlib
+import re
+import struct
+from collections import namedtuple
+
+TAG_PUBLIC_KEY = 6
+TAG_USER_ID = 13
+TAG_PUBLIC_SUBKEY = 14
+
+ARMOR_HEADER = b'-----BEGIN PGP PUBLIC KEY BLOCK-----'
+ARMOR_FOOTER = b'-----END PGP PUBLIC KEY BLOCK-----'
+
+# Attribute names match the ones of gpgme keys
+Subkey = namedtuple('Subkey', 'fpr,keyid')
+UserId = namedtuple('UserId', 'uid,name,comment,email')
+PublicKey = namedtuple('PublicKey', 'fpr,subkeys,uids')
+
+
+class OpenPGPError(ValueError):
+    pass
+
+
+def iter_packets(data):
+    """
+    Iterate the packets in binary OpenPGP data.
+
+    :return: iterator of ``(tag, header, body)``
+    """
+
+    pos = 0
+    while pos < len(data):
+        start = pos
+        ctb = ord(data[pos:pos + 1])
+        if not ctb & 0x80:
+            raise OpenPGPError("Invalid packet header at {0}".format(pos))
+
+        if ctb & 0x40:
+            # New format packet
+            tag = ctb & 0x3f
+            pos += 1
+            length, pos = _new_format_length(data, pos)
+        else:
+            # Old format packet
+            tag = (ctb >> 2) & 0x0f
+            length_type = ctb & 0x03
+            pos += 1
+            if length_type == 3:
+                length = len(data) - pos  # Indeterminate length
+            else:
+                size = (1, 2, 4)[length_type]
+                length = _unpack_int(data[pos:pos + size])
+                pos += size
+
+        if pos + length > len(data):
+            raise OpenPGPError("Truncated packet at {0}".format(start))
+        yield tag, data[start:pos], data[pos:pos + length]
+        pos += length
+
+
+def _new_format_length(data, pos):
+    first = ord(data[pos:pos + 1])
+    if first < 192:
+        return first, pos + 1
+    if first < 224:
+        second = ord(data[pos + 1:pos + 2])
+        return ((first - 192) << 8) + second + 192, pos + 2
+    if first == 255:
+        return _unpack_int(data[pos + 1:pos + 5]), pos + 5
+    # Partial body lengths are not used for keys
+    raise OpenPGPError("Unsupported partial body length")
+
+
+def _unpack_int(data):
+    return struct.unpack('>I', b'\x00' * (4 - len(data)) + data)[0]
+
+
+def key_fingerprint(body):
+    """Compute the fingerprint of a (v4) public key packet body"""
+
+    version = ord(body[0:1])
+    if version != 4:
+        raise OpenPGPError("Unsupported key version: {0}".format(version))
+    header = b'\x99' + struct.pack('>H', len(body))
+    return hashlib.sha1(header + body).hexdigest().upper()
+
+
+def split_keys(data):
+    """
+    Split binary data containing multiple exported keys.
+
+    :return: dict mapping primary key fingerprints to key data
+    """
+
+    keys = {}
+    current = None
+    for tag, header, body in iter_packets(data):
+        if tag == TAG_PUBLIC_KEY:
+            current = key_fingerprint(body)
+            keys[current] = []
+        if current is None:
+            raise OpenPGPError("Data doesn't start with a public key")
+        keys[current].append(header + body)
+    return dict((fpr, b''.join(packets)) for fpr, packets in keys.items())
+
+
+def dearmor(data):
+    """Convert ASCII-armored key data to binary (binary data is kept)"""
+
+    if ARMOR_HEADER not in data:
+        return data
+    blocks = []
+    for block in data.split(ARMOR_HEADER)[1:]:
+        if ARMOR_FOOTER not in block:
+            raise OpenPGPError("Truncated armored data")
+        block = block.split(ARMOR_FOOTER)[0]
+        # Skip the armor headers, up to the first empty line
+        lines = block.strip().splitlines()
+        if b'' in [x.strip() for x in lines]:
+            lines = lines[[x.strip() for x in lines].index(b'') + 1:]
+        # Drop the checksum line
+        lines = [x.strip() for x in lines if not x.startswith(b'=')]
+        try:
+            blocks.append(base64.b64decode(b''.join(lines)))
+        except (TypeError, ValueError):
+            raise OpenPGPError("Invalid armored data")
+    return b''.join(blocks)
+
+
+def parse_uid(uid):
+    """Split a user id into name, comment and email, like gpgme does"""
+
+    match = re.match(r'^(.*?)\s*(?:\((.*)\))?\s*(?:<([^>]*)>)?\s*$', uid)
+    name, comment, email = match.groups()
+    return UserId(uid, name, comment or '', email or '')
+
+
+def parse_keys(data):
+    """
+    Read the fingerprints and user ids of exported public keys.
+
+    :param data: exported keys, binary or ASCII-armored
+    :return: list of :py:class:`PublicKey`, whose first sub-key
+        is the primary key (as with gpgme keys)
+    """
+
+    keys = []
+    for tag, header, body in iter_packets(dearmor(data)):
+        if tag == TAG_PUBLIC_KEY:
+            fpr = key_fingerprint(body)
+            keys.append(PublicKey(fpr, [Subkey(fpr, fpr[-16:])], []))
+        elif not keys:
+            raise OpenPGPError("Data doesn't start with a public key")
+        elif tag == TAG_PUBLIC_SUBKEY:
+            fpr = key_fingerprint(body)
+            keys[-1].subkeys.append(Subkey(fpr, fpr[-16:]))
+        elif tag == TAG_USER_ID:
+            uid = body.decode('utf-8', 'replace')
+            keys[-1].uids.append(parse_uid(uid))
+    return keys
@@ -0,0 +1,443 @@
+"""
+AES key rotation.
+
+Rotating the key means re-encrypting every secret in the vault; to
+avoid leaving the vault half-migrated if something goes wrong, the
+process runs in three phases, tracked by a journal stored in
+``.keys/.rotation/``:
+
+``recrypt``
+    the new AES key is encrypted for all the identities and
+    stored in the journal directory; every secret is then decrypted
+    with the old key and re-encrypted with the new one, to a temporary
+    ``.<name>.rotate`` file next to the original.  Finished secrets are
+    appended to the journal, so an interrupted run can pick up where it
+    stopped.
+
+``commit``
+    secrets changed since they were re-encrypted (or written after
+    the rotation started) are re-encrypted again, and the ones
+    deleted are dropped; then the originals are backed up
+    (``.<name>.rotate-old``) and the new files, then the new keys,
+    are renamed in place.
+
+``cleanup``
+    backups and journal are removed.
+
+Until the cleanup phase starts, the rotation can be rolled back.
+
+Secrets still encrypted with an even older key can't be re-encrypted:
+they are left as they are (and logged), to be fixed later with
+``vault fix`` (see :py:mod:`password_manager.scanner`).
+
+With the packed storage (see :py:mod:`password_manager.storage`), the
+re-encrypted secrets are written to a new pack in the journal
+directory instead; on commit, the original pack is backed up
+(``..secrets.pack.rotate-old``) and replaced by the new one.  The pack
+stays locked during the whole commit, so that no secret is written
+with the old key in the meanwhile.
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from password_manager import PasswordManagerException, aes_key_id
+from password_manager.storage import PackedStorage
+from password_manager.utils import write_file_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class KeyRotation(object):
+    def __init__(self, pm, max_workers=8):
+        """
+        :param pm: the :py:class:`~password_manager.PasswordManager`
+        :param max_workers: number of threads re-encrypting secrets
+        """
+        self.pm = pm
+        self.max_workers = max(1, max_workers)
+
+    @property
+    def journal_dir(self):
+        return os.path.join(self.pm.keydir, '.rotation')
+
+    @property
+    def journal_file(self):
+        return os.path.join(self.journal_dir, 'journal.json')
+
+    @property
+    def done_file(self):
+        return os.path.join(self.journal_dir, 'done')
+
+    @property
+    def packed(self):
+        """Whether the secrets are kept in a pack"""
+
+        return isinstance(self.pm.storage, PackedStorage)
+
+    def in_progress(self):
+        """Whether there is an interrupted rotation to resume"""
+
+        return os.path.exists(self.journal_file)
+
+    def run(self):
+        """Rotate the key, resuming a pending rotation if there is one"""
+
+        if not self.in_progress():
+            self.start()
+        self.resume()
+
+    def start(self, identities=None):
+        """
+        Generate the new key and write the journal.
+
+        :param identities: users to encrypt the new key for;
+            defaults to the current ones
+        """
+
+        if os.path.exists(self.journal_dir):
+            # Leftovers from a rotation interrupted before the
+            # journal was written: nothing was touched yet.
+            shutil.rmtree(self.journal_dir)
+        os.makedirs(self.journal_dir)
+
+        new_aes_key = self.pm.generate_aes_key()
+        if identities is None:
+            identities = list(self.pm.list_identities())
+        for identity in identities:
+            self.pm.write_aes_key(new_aes_key, identity,
+                                  filename=self._staged_key(identity))
+
+        secrets = [os.path.relpath(x, self.pm.basedir)
+                   for x in self.pm.list_secrets()]
+
+        self._write_journal({
+            'state': 'recrypt',
+            'identities': identities,
+            'secrets': secrets,
+        })
+
+    def resume(self):
+        """Carry on a rotation from where it was interrupted"""
+
+        journal = self._read_journal()
+
+        if journal['state'] == 'recrypt':
+            self._recrypt(journal)
+            journal['state'] = 'commit'
+            self._write_journal(journal)
+
+        if journal['state'] == 'commit':
+            self._commit(journal)
+            journal['state'] = 'cleanup'
+            self._write_journal(journal)
+
+        self._cleanup(journal)
+        self.pm.forget()
+
+    def rollback(self):
+        """Abort a pending rotation, restoring the original files"""
+
+        journal = self._read_journal()
+        if journal['state'] == 'cleanup':
+            raise PasswordManagerException(
+                "Rotation already committed, it can only be resumed")
+
+        for secret in journal['secrets']:
+            filename = self.pm.get_secret_filename(secret)
+            backup = self._backup_name(filename)
+            if os.path.exists(backup):
+                os.rename(backup, filename)
+            _unlink_if_exists(self._temp_name(filename))
+
+        if self.packed:
+            backup = self._backup_name(self.pm.storage.filename)
+            if os.path.exists(backup):
+                os.rename(backup, self.pm.storage.filename)
+
+        for identity in journal['identities']:
+            for backup, filename in self._key_files(identity, backup=True):
+                if os.path.exists(backup):
+                    os.rename(backup, filename)
+
+        shutil.rmtree(self.journal_dir)
+        self.pm.forget()
+
+    # ----------------------------------------------------------------------
+    #   Phases
+
+    def _get_keys(self):
+        """
+        :return: ``(old, new)`` AES keys, or ``None`` if the new
+            key was already put in place
+        """
+
+        identity = self.pm.get_own_identity()
+        staged_key = self._staged_key(identity)
+        if not os.path.exists(staged_key):
+            return None
+        # The live keys are still the old ones
+        old_aes_key = self.pm.get_aes_key(identity)
+        new_aes_key = self.pm.read_aes_key(identity, filename=staged_key)
+        return old_aes_key, new_aes_key
+
+    def _recrypt(self, journal):
+        from password_manager import fileformat
+
+        old_aes_key, new_aes_key = self._get_keys()
+        done = self._read_done()
+        pending = [x for x in journal['secrets'] if x not in done]
+        staged_pack = self._staged_pack() if self.packed else None
+        storage = self.pm.storage
+
+        def _recrypt_one(secret):
+            try:
+                data = storage.read(secret)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Deleted in the meanwhile: nothing to do
+                return secret, None
+            try:
+                secret_data = self.pm.aes_decrypt(data, key=old_aes_key)
+                encrypted = self.pm.aes_encrypt(secret_data, key=new_aes_key)
+            except fileformat.WrongKeyError as e:
+                # Encrypted with an older key: left as it is
+                logger.warning('Not re-encrypting {0}: {1}'.format(secret, e))
+                encrypted = data
+            self._stage(secret, encrypted, staged_pack)
+            return secret, _digest(data)
+
+        pool = ThreadPool(self.max_workers)
+        try:
+            with open(self.done_file, 'a') as fp:
+                for secret, digest in pool.imap_unordered(
+                        _recrypt_one, pending):
+                    fp.write(json.dumps([secret, digest]) + '\n')
+                    fp.flush()
+        finally:
+            pool.terminate()
+
+    def _catch_up(self, journal):
+        """
+        Bring the re-encrypted secrets up to date with the changes
+        made after they were re-encrypted.
+
+        :return: whether the journal was changed
+        """
+
+        from password_manager import fileformat
+
+        keys = self._get_keys()
+        if keys is None:
+            return False  # Already committed
+        old_aes_key, new_aes_key = keys
+        new_key_id = aes_key_id(new_aes_key)
+        storage = self.pm.storage
+        staged_pack = self._staged_pack() if self.packed else None
+        if (staged_pack is not None and
+                not os.path.exists(staged_pack.filename) and
+                os.path.exists(self._backup_name(storage.filename))):
+            return False  # Already committed
+
+        done = self._read_done()
+        live = set(storage.list())
+        for secret in sorted(live):
+            data = storage.read(secret)
+            header = fileformat.parse_header(data)
+            if header is not None and header.key_id == new_key_id:
+                continue  # Already committed
+            if done.get(secret) == _digest(data):
+                continue  # Unchanged since it was re-encrypted
+            try:
+                secret_data = self.pm.aes_decrypt(data, key=old_aes_key)
+                data = self.pm.aes_encrypt(secret_data, key=new_aes_key)
+            except fileformat.WrongKeyError as e:
+                # Encrypted with an older key: left as it is
+                logger.warning('Not re-encrypting {0}: {1}'.format(secret, e))
+            self._stage(secret, data, staged_pack)
+
+        # Deleted after they were re-encrypted
+        for secret in done:
+            if secret not in live:
+                self._unstage(secret, staged_pack)
+
+        new_secrets = live.difference(journal['secrets'])
+        if not new_secrets:
+            return False
+        journal['secrets'] = sorted(live.union(journal['secrets']))
+        return True
+
+    def _commit(self, journal):
+        with self._commit_lock():
+            if self._catch_up(journal):
+                self._write_journal(journal)
+            self._commit_files(journal)
+
+    @contextmanager
+    def _commit_lock(self):
+        if self.packed:
+            # Nobody writes to the pack until the new key is in place
+            with self.pm.storage._locked():
+                yield
+        else:
+            yield
+
+    def _commit_files(self, journal):
+        if self.packed:
+            self._commit_pack()
+
+        for secret in journal['secrets']:
+            filename = self.pm.get_secret_filename(secret)
+            tempname = self._temp_name(filename)
+            if not os.path.exists(tempname):
+                continue  # Already committed, or deleted
+            _backup(filename, self._backup_name(filename))
+            os.rename(tempname, filename)
+
+        if not os.path.exists(self._backup_key_dir()):
+            os.makedirs(self._backup_key_dir())
+
+        for identity in journal['identities']:
+            for backup, filename in self._key_files(identity, backup=True):
+                _backup(filename, backup)
+            for staged, filename in self._key_files(identity):
+                if os.path.exists(staged):
+                    os.rename(staged, filename)
+
+    def _commit_pack(self):
+        storage = self.pm.storage
+        staged_pack = self._staged_pack()
+        if not os.path.exists(staged_pack.filename):
+            return  # Already committed (or an empty vault)
+
+        _backup(storage.filename, self._backup_name(storage.filename))
+        os.rename(staged_pack.filename, storage.filename)
+
+    def _cleanup(self, journal):
+        for secret in journal['secrets']:
+            filename = self.pm.get_secret_filename(secret)
+            _unlink_if_exists(self._backup_name(filename))
+        if self.packed:
+            _unlink_if_exists(self._backup_name(self.pm.storage.filename))
+        shutil.rmtree(self.journal_dir)
+
+    # ----------------------------------------------------------------------
+    #   Journal
+
+    def _read_journal(self):
+        try:
+            with open(self.journal_file, 'r') as fp:
+                return json.load(fp)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise PasswordManagerException("No key rotation in progress")
+
+    def _write_journal(self, journal):
+        write_file_atomic(self.journal_file,
+                          json.dumps(journal).encode('utf-8'))
+
+    def _read_done(self):
+        """
+        Secrets whose re-encrypted version is ready.
+
+        :return: dict mapping their names to the digest of the
+            original they were re-encrypted from (``None`` if it
+            was deleted)
+        """
+
+        if not os.path.exists(self.done_file):
+            return {}
+        done = {}
+        with open(self.done_file, 'r') as fp:
+            for line in fp:
+                # Skip the last line, if it was partially written
+                if not line.endswith('\n'):
+                    continue
+                secret, digest = json.loads(line)
+                done[secret] = digest
+        return done
+
+    def _stage(self, secret, data, staged_pack):
+        """Write the re-encrypted version of a secret"""
+
+        if staged_pack is not None:
+            staged_pack.write(secret, data, atomic=True)
+        else:
+            filename = self.pm.get_secret_filename(secret)
+            write_file_atomic(self._temp_name(filename), data)
+
+    def _unstage(self, secret, staged_pack):
+        if staged_pack is not None:
+            if secret in staged_pack.list():
+                staged_pack.delete(secret)
+        else:
+            filename = self.pm.get_secret_filename(secret)
+            _unlink_if_exists(self._temp_name(filename))
+
+    # ----------------------------------------------------------------------
+    #   File names
+
+    def _staged_pack(self):
+        return PackedStorage(
+            self.pm, filename=os.path.join(self.journal_dir, 'secrets.pack'),
+            lock_filename=os.path.join(self.journal_dir, 'secrets.pack.lock'))
+
+    def _staged_key(self, identity):
+        return os.path.join(self.journal_dir, '{0}.key'.format(identity))
+
+    def _backup_key_dir(self):
+        return os.path.join(self.journal_dir, 'old')
+
+    def _key_files(self, identity, backup=False):
+        """
+        :return:
+            list of ``(staged or backup, live)`` names of the files
+            describing the AES key encrypted for ``identity``.
+        """
+
+        dirname = self._backup_key_dir() if backup else self.journal_dir
+        files = []
+        for filename in (self.pm.get_aes_key_filename(identity),
+                         self.pm.get_aes_key_meta_filename(identity)):
+            files.append((os.path.join(dirname, os.path.basename(filename)),
+                          filename))
+        return files
+
+    def _temp_name(self, filename):
+        dirname, basename = os.path.split(filename)
+        return os.path.join(dirname, '.{0}.rotate'.format(basename))
+
+    def _backup_name(self, filename):
+        dirname, basename = os.path.split(filename)
+        return os.path.join(dirname, '.{0}.rotate-old'.format(basename))
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _backup(filename, backup):
+    """Keep a copy of ``filename``, unless we already have one"""
+
+    if os.path.exists(backup) or not os.path.exists(filename):
+        return
+    try:
+        os.link(filename, backup)
+    except (OSError, AttributeError):
+        shutil.copy2(filename, backup)
+
+
+def _unlink_if_exists(filename):
+    try:
+        os.unlink(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,283 @@
+"""
+Find (and fix) secrets encrypted with a stale AES key.
+
+After merging a branch where the AES key was regenerated, some
+secrets can be left encrypted with the old key (see "Merges can be a
+pain" in the README).  The id of the key is stored in the header of
+each secret file (see :py:mod:`password_manager.fileformat`), so the
+whole vault can be classified by reading just a few bytes per file:
+
+``current``
+    encrypted with the current AES key
+
+``stale``
+    encrypted with a different key
+
+``legacy``
+    written in the old format, which doesn't record the key
+
+``corrupt``
+    the header can't be parsed
+
+Stale secrets can then be re-encrypted with the current key, provided
+we can find the old one: keys are looked up in the history of the
+``.keys`` directory (when the vault is a git repository), or read
+from encrypted key files given by the user.
+
+A scanner only looks at the secrets of a single key scope, since
+each scope has its own AES key: the secrets of nested scopes (see
+:py:meth:`~password_manager.PasswordManager.get_scope`) are left out,
+and checked with a scanner for the scope (``vault check --scope``).
+"""
+
+import errno
+import json
+import os
+import subprocess
+from collections import namedtuple
+from io import BytesIO
+from timeit import default_timer
+
+from password_manager import aes_key_id
+
+STATUS_CURRENT = 'current'
+STATUS_STALE = 'stale'
+STATUS_LEGACY = 'legacy'
+STATUS_CORRUPT = 'corrupt'
+
+SecretStatus = namedtuple('SecretStatus', 'name,status,key_id')
+
+
+class VaultScanner(object):
+    def __init__(self, pm, max_workers=8):
+        """
+        :param pm: the :py:class:`~password_manager.PasswordManager`
+        :param max_workers: number of secrets processed in parallel
+        """
+        self.pm = pm
+        self.max_workers = max(1, max_workers)
+        self._current_key = None
+
+    @property
+    def current_key(self):
+        if self._current_key is None:
+            self._current_key = self.pm.get_aes_key()
+        return self._current_key
+
+    @property
+    def current_key_id(self):
+        return aes_key_id(self.current_key)
+
+    def scan(self):
+        """
+        Classify all the secrets, by reading their headers.
+
+        :return: ``(statuses, stats)``: a list of
+            :py:class:`SecretStatus`, sorted by name, and a dict with
+            the ``count`` of secrets and ``elapsed`` time.
+        """
+
+        from password_manager.fileformat import SecretFormatError
+
+        current_id = self.current_key_id
+        start = default_timer()
+
+        def _check(name):
+            try:
+                header = self.pm.read_secret_header(name)
+            except SecretFormatError:
+                return SecretStatus(name, STATUS_CORRUPT, None)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return None  # Deleted in the meanwhile
+            if header is None:
+                return SecretStatus(name, STATUS_LEGACY, None)
+            if header.key_id == current_id:
+                return SecretStatus(name, STATUS_CURRENT, header.key_id)
+            return SecretStatus(name, STATUS_STALE, header.key_id)
+
+        names = [os.path.relpath(x, self.pm.basedir)
+                 for x in self.pm.list_secrets()]
+        statuses = [x for x in self._map(_check, names) if x is not None]
+        statuses.sort()
+        return statuses, _stats(len(statuses), 0, start)
+
+    def fix(self, statuses, keys, legacy=False):
+        """
+        Re-encrypt stale secrets with the current key.
+
+        :param statuses: the result of :py:meth:`scan`
+        :param keys: dict mapping key ids to old AES keys
+        :param legacy:
+            also rewrite secrets in the legacy format, assuming they
+            were encrypted with the current key (this can't be
+            verified, as the old format is not authenticated)
+        :return: ``(result, stats)``: a dict listing the ``fixed``
+            secrets, the ones whose key is ``missing`` and the ones
+            that ``failed``, as ``(name, error)``; and a dict with the
+            ``count`` of rewritten secrets, their ``bytes`` and the
+            ``elapsed`` time.
+        """
+
+        keys = dict(keys)
+        keys[self.current_key_id] = self.current_key
+
+        result = {'fixed': [], 'missing': [], 'failed': []}
+        todo = []
+        for status in statuses:
+            if status.status == STATUS_STALE:
+                if status.key_id in keys:
+                    todo.append(status)
+                else:
+                    result['missing'].append(status.name)
+            elif status.status == STATUS_LEGACY and legacy:
+                todo.append(status)
+
+        start = default_timer()
+
+        def _fix(status):
+            try:
+                return status.name, self._recrypt(status, keys), None
+            except Exception as e:
+                return status.name, 0, e
+
+        total = 0
+        with self.pm.batch_updates():
+            for name, size, error in self._map(_fix, todo):
+                if error is None:
+                    result['fixed'].append(name)
+                    total += size
+                else:
+                    result['failed'].append((name, error))
+
+        for value in result.values():
+            value.sort()
+        return result, _stats(len(result['fixed']), total, start)
+
+    def _recrypt(self, status, keys):
+        storage = self.pm.storage
+        data = storage.read(status.name)
+        if status.key_id is None:
+            old_key = self.current_key
+        else:
+            old_key = keys[status.key_id]
+        secret = self.pm.aes_decrypt(data, key=old_key)
+        storage.write(status.name,
+                      self.pm.aes_encrypt(secret, key=self.current_key),
+                      atomic=True)
+        self.pm._update_search_index(status.name, secret)
+        return len(data)
+
+    # ----------------------------------------------------------------------
+    #   Old keys
+
+    def read_key_file(self, filename):
+        """
+        Decrypt an AES key file (eg. a ``.keys/<fingerprint>.key``
+        from another copy of the vault) with our private key.
+
+        :return: dict mapping the key id to the key
+        """
+
+        with open(filename, 'rb') as fp:
+            aes_key = self._decrypt_aes_key(fp.read())
+        return {aes_key_id(aes_key): aes_key}
+
+    def history_keys(self, wanted=None):
+        """
+        Find old versions of the AES key in the git history.
+
+        Only the versions of our own key file are decrypted (one
+        GnuPG operation each); when the metadata file is available,
+        versions of keys not in ``wanted`` are skipped without
+        decrypting them.
+
+        :param wanted:
+            ids of the keys we are looking for; the search stops when
+            all of them were found.  ``None`` means all of them.
+        :return: dict mapping key ids to keys
+        """
+
+        identity = self.pm.get_own_identity()
+        key_path = os.path.relpath(self.pm.get_aes_key_filename(identity),
+                                   self.pm.basedir)
+        meta_path = os.path.relpath(
+            self.pm.get_aes_key_meta_filename(identity), self.pm.basedir)
+
+        try:
+            revisions = self._git('log', '--all', '--format=%H',
+                                  '--', key_path).split()
+        except (OSError, subprocess.CalledProcessError):
+            return {}  # Not a git repository, or git not installed
+
+        if wanted is not None:
+            wanted = set(wanted)
+
+        found = {}
+        seen = set()
+        for rev in revisions:
+            if wanted is not None and wanted.issubset(found):
+                break
+            if wanted is not None:
+                meta_id = self._history_meta_key_id(rev, meta_path)
+                if meta_id is not None and (meta_id in found or
+                                            meta_id not in wanted):
+                    continue
+            try:
+                data = self._git('show', '{0}:./{1}'.format(rev, key_path),
+                                 text=False)
+            except subprocess.CalledProcessError:
+                continue  # Deleted in this revision
+            if data in seen:
+                continue
+            seen.add(data)
+            try:
+                aes_key = self._decrypt_aes_key(data)
+            except Exception:
+                continue  # Not encrypted for our current private key
+            found[aes_key_id(aes_key)] = aes_key
+        return found
+
+    def _history_meta_key_id(self, rev, meta_path):
+        try:
+            meta = json.loads(self._git('show',
+                                        '{0}:./{1}'.format(rev, meta_path)))
+        except (subprocess.CalledProcessError, ValueError):
+            return None
+        return meta.get('aes_key_id')
+
+    def _decrypt_aes_key(self, data):
+        output = BytesIO()
+        with self.pm.gpg_context() as gpg:
+            gpg.decrypt(BytesIO(data), output)
+        return output.getvalue()
+
+    def _git(self, *args, **kwargs):
+        with open(os.devnull, 'wb') as devnull:
+            output = subprocess.check_output(
+                ('git',) + args, cwd=self.pm.basedir, stderr=devnull)
+        if kwargs.get('text', True):
+            output = output.decode('utf-8')
+        return output
+
+    # ----------------------------------------------------------------------
+
+    def _map(self, func, items):
+        from multiprocessing.pool import ThreadPool
+
+        if not items:
+            return []
+        pool = ThreadPool(min(self.max_workers, len(items)))
+        try:
+            return list(pool.imap_unordered(func, items))
+        finally:
+            pool.terminate()
+
+
+def _stats(count, size, start):
+    return {
+        'count': count,
+        'bytes': size,
+        'elapsed': default_timer() - start,
+    }
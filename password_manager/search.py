@@ -0,0 +1,303 @@
+"""
+Encrypted index of the secrets contents, to search them.
+
+Secrets are usually JSON objects (see
+:py:meth:`~password_manager.PasswordManager.setup`): the values of
+their fields (except for the ones listed in ``HIDDEN_FIELDS``) and
+their ``tags`` are kept in ``.keys/.search``, encrypted with the
+vault AES key, so that finding a secret requires decrypting just the
+index, rather than every secret in the vault.
+
+The index is updated when secrets are written through the password
+manager; secrets changed in other ways (eg. by ``git pull``) are
+noticed by their version (see
+:py:meth:`~password_manager.storage.SecretStorage.version`), and
+indexed again on the next search.  Like the secrets index, it is
+local state, kept out of version control through ``.keys/.gitignore``.
+
+Each update rewrites the whole index: bulk operations defer them with
+:py:meth:`~password_manager.PasswordManager.batch_updates`, so that
+the index is saved once at the end.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from password_manager.utils import ensure_gitignored, write_file_atomic
+
+SEARCH_INDEX_VERSION = 2
+
+# Fields whose values are never stored in the index
+HIDDEN_FIELDS = ('password',)
+
+TAGS_FIELD = 'tags'
+
+
+def extract_terms(secret, hidden_fields=HIDDEN_FIELDS):
+    """
+    Get the searchable contents of a secret.
+
+    :param secret: the plaintext secret, as bytes
+    :return:
+        ``(fields, tags)``: a dict mapping (dotted, for nested
+        objects) field names to lists of values, and a list of tags.
+        Both are empty if the secret is not a JSON object.
+    """
+
+    try:
+        if isinstance(secret, bytes):
+            secret = secret.decode('utf-8')
+        data = json.loads(secret)
+    except (UnicodeDecodeError, ValueError):
+        return {}, []
+    if not isinstance(data, dict):
+        return {}, []
+
+    tags = data.get(TAGS_FIELD) or []
+    if not isinstance(tags, list):
+        tags = _text(tags).split(',') if _is_scalar(tags) else []
+    tags = sorted(set(_text(x).strip() for x in tags if _is_scalar(x)))
+
+    fields = {}
+
+    def _add(prefix, value):
+        if isinstance(value, dict):
+            for name, item in value.items():
+                _add(prefix + [name], item)
+        elif isinstance(value, list):
+            for item in value:
+                _add(prefix, item)
+        elif _is_scalar(value):
+            fields.setdefault('.'.join(prefix), []).append(_text(value))
+
+    for name, value in data.items():
+        if name not in hidden_fields and name != TAGS_FIELD:
+            _add([name], value)
+    return fields, [x for x in tags if x]
+
+
+def _is_scalar(value):
+    return value is not None and not isinstance(value, (dict, list))
+
+
+def _text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    return value
+
+
+class SearchIndex(object):
+    def __init__(self, pm, hidden_fields=HIDDEN_FIELDS, max_workers=8):
+        """
+        :param pm: the :py:class:`~password_manager.PasswordManager`
+        :param hidden_fields: fields left out of the index
+        :param max_workers: number of secrets decrypted in parallel,
+            when indexing
+        """
+        self.pm = pm
+        self.hidden_fields = hidden_fields
+        self.max_workers = max_workers
+        # Deferred updates: relpath -> entry (None to remove)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    @property
+    def filename(self):
+        return os.path.join(self.pm.keydir, '.search')
+
+    @property
+    def lock_filename(self):
+        return os.path.join(self.pm.keydir, '.search.lock')
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def search(self, text=None, fields=None, tags=None):
+        """
+        Find secrets.  All the given criteria must match; text is
+        matched case-insensitively, as a substring.
+
+        :param text: text in the secret name or any field value or tag
+        :param fields: dict mapping field names to text in their value
+        :param tags: tags the secrets must have (all of them)
+        :return: sorted list of secret names
+        """
+
+        key = self.pm.get_aes_key()
+        with self._locked():
+            data = self._load(key)
+            if self._refresh(data, key):
+                self._save(data, key)
+
+        text = text.lower() if text else None
+        fields = dict((name, value.lower())
+                      for name, value in (fields or {}).items())
+        tags = set(x.lower() for x in (tags or []))
+
+        found = []
+        for name, entry in data['secrets'].items():
+            if _matches(name, entry, text, fields, tags):
+                found.append(name)
+        return sorted(found)
+
+    def update(self, relpath, secret):
+        """Index a secret that was just written"""
+
+        self._apply({relpath: self._make_entry(relpath, secret)})
+
+    def remove(self, relpath):
+        """
+        Forget a secret that was deleted (or changed without us
+        knowing its contents: it will be indexed again on the
+        next search).
+        """
+
+        self._apply({relpath: None})
+
+    def flush(self):
+        """Save the updates deferred so far (see :py:meth:`update`)"""
+
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            self._save_entries(pending)
+
+    def rebuild(self):
+        """Discard the index and index all the secrets again"""
+
+        key = self.pm.get_aes_key()
+        with self._locked():
+            data = self._empty()
+            self._refresh(data, key)
+            self._save(data, key)
+
+    # ----------------------------------------------------------------------
+
+    def _apply(self, entries):
+        if self.pm._deferring_updates():
+            with self._pending_lock:
+                self._pending.update(entries)
+        else:
+            self._save_entries(entries)
+
+    def _save_entries(self, entries):
+        """Store entries (``None`` to remove them) in the index"""
+
+        key = self.pm.get_aes_key()
+        with self._locked():
+            data = self._load(key)
+            changed = False
+            for relpath, entry in entries.items():
+                if entry is None:
+                    changed |= data['secrets'].pop(relpath, None) is not None
+                else:
+                    data['secrets'][relpath] = entry
+                    changed = True
+            if changed:
+                self._save(data, key)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_filename, 'a') as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def _empty(self):
+        return {'version': SEARCH_INDEX_VERSION, 'secrets': {}}
+
+    def _load(self, key):
+        from password_manager import fileformat
+
+        try:
+            with open(self.filename, 'rb') as fp:
+                encrypted = fp.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self._empty()
+        try:
+            data = json.loads(fileformat.decrypt(key, encrypted)
+                              .decode('utf-8'))
+        except (fileformat.SecretFormatError, ValueError):
+            # Encrypted with an old key, or corrupted: just rebuild
+            return self._empty()
+        if data.get('version') != SEARCH_INDEX_VERSION:
+            return self._empty()
+        return data
+
+    def _save(self, data, key):
+        from password_manager import fileformat
+
+        ensure_gitignored(self.pm.keydir, ['/.search', '/.search.lock'])
+        plaintext = json.dumps(data, sort_keys=True).encode('utf-8')
+        write_file_atomic(self.filename, fileformat.encrypt(key, plaintext))
+
+    def _make_entry(self, relpath, secret):
+        version = self.pm.storage.version(relpath)
+        if version is None:
+            return None
+        fields, tags = extract_terms(secret, self.hidden_fields)
+        return {'version': version, 'fields': fields, 'tags': tags}
+
+    def _refresh(self, data, key):
+        """
+        Index the secrets that changed since they were indexed,
+        and drop the deleted ones.
+
+        :return: whether anything changed
+        """
+
+        secrets = data['secrets']
+        storage = self.pm.storage
+        current = {}
+        for relpath in storage.list():
+            version = storage.version(relpath)
+            if version is not None:
+                current[relpath] = version
+
+        deleted = [x for x in secrets if x not in current]
+        for relpath in deleted:
+            del secrets[relpath]
+
+        stale = sorted(relpath for relpath, version in current.items()
+                       if relpath not in secrets or
+                       secrets[relpath]['version'] != version)
+        for result in self.pm.read_secrets(stale, key=key,
+                                           max_workers=self.max_workers):
+            if result.error is not None:
+                # Not readable with the current key: keep it out of the
+                # results, without trying again until it changes.
+                secrets[result.name] = {'version': current[result.name],
+                                        'fields': {}, 'tags': []}
+                continue
+            entry = self._make_entry(result.name, result.secret)
+            if entry is not None:
+                secrets[result.name] = entry
+        return bool(deleted or stale)
+
+
+def _matches(name, entry, text, fields, tags):
+    values = [x.lower() for items in entry['fields'].values()
+              for x in items]
+    entry_tags = set(x.lower() for x in entry['tags'])
+
+    if tags and not tags.issubset(entry_tags):
+        return False
+    for field, value in fields.items():
+        if not any(value in x.lower()
+                   for x in entry['fields'].get(field, [])):
+            return False
+    if text is not None:
+        haystack = [name.lower()] + values + list(entry_tags)
+        if not any(text in x for x in haystack):
+            return False
+    return True
@@ -0,0 +1,559 @@
+"""
+Storage backends, keeping the (already encrypted) secrets.
+
+:py:class:`DirectoryStorage` (the default) stores each secret in its
+own file, named after the secret, under the vault directory.
+
+:py:class:`PackedStorage` stores all of them in a single file,
+``.secrets.pack``: an append-only log of records, each one either
+storing the new version of a secret, or marking it as deleted::
+
+    magic (4) | version (1) | record | record | ...
+
+    record: type (1) | name length (2) | data length (4) | crc32 (4)
+            | name (utf-8) | data
+
+The offset of the latest version of each secret is kept in memory, so
+reads are a single seek; the log is scanned once, then only the
+records appended in the meanwhile (by any process) are read.  Old
+versions are left in place until :py:meth:`PackedStorage.compact`
+rewrites the file with just the live records.
+
+The backend is selected by the ``storage`` vault setting (see
+:py:meth:`~password_manager.PasswordManager.migrate_storage`).
+"""
+
+import errno
+import fcntl
+import io
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+
+from password_manager import PasswordManagerException
+from password_manager.utils import (
+    buffer_view, ensure_gitignored, release_view, write_file_atomic)
+
+PACK_FILENAME = '.secrets.pack'
+PACK_MAGIC = b'\x89PMP'
+PACK_VERSION = 1
+PACK_HEADER = PACK_MAGIC + struct.pack('B', PACK_VERSION)
+
+RECORD_HEADER = struct.Struct('>BHII')
+RECORD_PUT = 1
+RECORD_DELETE = 2
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class PackFormatError(PasswordManagerException):
+    """The pack file is corrupt, or in an unsupported format"""
+
+
+def _not_found(name):
+    return IOError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
+
+class StagedSecret(object):
+    """
+    Temporary file a secret is written to; :py:meth:`commit`
+    makes it the current version, :py:meth:`abort` discards it.
+    """
+
+    def __init__(self, dirname, basename, commit):
+        fd, self.tmpname = tempfile.mkstemp(dir=dirname,
+                                            prefix='.' + basename + '.')
+        self.fp = os.fdopen(fd, 'w+b')
+        self._commit = commit
+
+    def commit(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        try:
+            self._commit(self)
+        finally:
+            self.abort()
+
+    def abort(self):
+        if not self.fp.closed:
+            self.fp.close()
+        try:
+            os.unlink(self.tmpname)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class SecretStorage(object):
+    """
+    Base class for the storage backends.
+
+    Secrets are identified by name (their path, relative to the vault
+    directory); missing secrets raise ``IOError`` with ``ENOENT``.
+    """
+
+    #: Name of the backend, for the ``storage`` vault setting
+    name = None
+
+    def __init__(self, pm):
+        self.pm = pm
+
+    def list(self):
+        """Names of all the secrets"""
+        raise NotImplementedError
+
+    def read(self, name):
+        raise NotImplementedError
+
+    def read_header(self, name, size):
+        """Read the first ``size`` bytes of a secret"""
+        return self.read(name)[:size]
+
+    def write(self, name, data, atomic=False):
+        """
+        :param atomic:
+            make sure the secret is either fully written or left
+            untouched, even if we crash (slower)
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def version(self, name):
+        """
+        A (JSON serializable) value that changes whenever the
+        secret is written, or ``None`` if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def open(self, name):
+        """
+        Open a secret for streaming.
+
+        :return: ``(fp, size)``
+        """
+        raise NotImplementedError
+
+    def stage(self, name):
+        """Get a :py:class:`StagedSecret` to write a secret to"""
+        raise NotImplementedError
+
+    @contextmanager
+    def map(self, name):
+        """Get a secret as a read-only buffer (not copied in memory)"""
+        yield self.read(name)
+
+    def compact(self):
+        """
+        Reclaim the space taken by deleted or overwritten secrets.
+
+        :return: the number of bytes reclaimed
+        """
+        return 0
+
+
+class DirectoryStorage(SecretStorage):
+    """One file per secret"""
+
+    name = 'directory'
+
+    def filename(self, name):
+        return self.pm.get_secret_filename(name)
+
+    def list(self):
+        index = self.pm.index
+        if index is not None:
+            for relpath in index.list():
+                yield relpath
+            return
+
+        basedir = self.pm.basedir
+        for dirpath, dirnames, filenames in os.walk(basedir):
+            # Key scopes keep their own secrets
+            dirnames[:] = [
+                x for x in dirnames if not x.startswith('.') and
+                not self.pm._is_scope_dir(os.path.join(dirpath, x))]
+            for filename in filenames:
+                if self.pm._is_secret_file(filename):
+                    yield os.path.relpath(os.path.join(dirpath, filename),
+                                          basedir)
+
+    def read(self, name):
+        with open(self.filename(name), 'rb') as fp:
+            return fp.read()
+
+    def read_header(self, name, size):
+        with open(self.filename(name), 'rb') as fp:
+            return fp.read(size)
+
+    def write(self, name, data, atomic=False):
+        filename = self.filename(name)
+        _makedirs(os.path.dirname(filename))
+        if atomic:
+            write_file_atomic(filename, data)
+        else:
+            with open(filename, 'wb') as fp:
+                fp.write(data)
+        self.pm._update_index(filename)
+
+    def delete(self, name):
+        filename = self.filename(name)
+        os.unlink(filename)
+        self.pm._update_index(filename, deleted=True)
+
+    def version(self, name):
+        try:
+            st = os.stat(self.filename(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return [st.st_size, st.st_mtime]
+
+    def open(self, name):
+        fp = open(self.filename(name), 'rb')
+        return fp, os.fstat(fp.fileno()).st_size
+
+    def stage(self, name):
+        filename = self.filename(name)
+
+        def _commit(staged):
+            staged.fp.close()
+            os.rename(staged.tmpname, filename)
+            self.pm._update_index(filename)
+
+        dirname, basename = os.path.split(filename)
+        _makedirs(dirname)
+        return StagedSecret(dirname, basename, _commit)
+
+    @contextmanager
+    def map(self, name):
+        with open(self.filename(name), 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                yield b''  # Can't mmap empty files
+                return
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield mapped
+            finally:
+                mapped.close()
+
+
+class PackedStorage(SecretStorage):
+    """All the secrets in a single append-only file"""
+
+    name = 'packed'
+
+    def __init__(self, pm, filename=None, lock_filename=None):
+        """
+        :param pm: the :py:class:`~password_manager.PasswordManager`
+        :param filename: the pack file (defaults to ``.secrets.pack``
+            in the vault directory)
+        :param lock_filename: file locked while writing to the pack
+            (defaults to ``.keys/.pack.lock``)
+        """
+        super(PackedStorage, self).__init__(pm)
+        self.filename = filename or os.path.join(pm.basedir, PACK_FILENAME)
+        self.lock_filename = lock_filename
+        self._lock = threading.RLock()
+        self._fp = None
+        self._inode = None
+        self._scanned = 0
+        self._records = {}  # name -> (data offset, data size, crc32)
+        self._garbage = 0
+
+    # ----------------------------------------------------------------------
+    #   Reading
+
+    def list(self):
+        with self._lock:
+            self._refresh()
+            return sorted(self._records)
+
+    def read(self, name):
+        with self._lock:
+            offset, size, crc = self._get(name)
+            self._fp.seek(offset)
+            data = self._fp.read(size)
+        if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+            raise PackFormatError("Corrupt record for {0}".format(name))
+        return data
+
+    def read_header(self, name, size):
+        with self._lock:
+            offset, record_size, crc = self._get(name)
+            self._fp.seek(offset)
+            return self._fp.read(min(size, record_size))
+
+    def version(self, name):
+        with self._lock:
+            try:
+                offset, size, crc = self._get(name)
+            except IOError:
+                return None
+            # Unlike the offset, doesn't change on compaction
+            return [size, crc]
+
+    def open(self, name):
+        with self._lock:
+            offset, size, crc = self._get(name)
+            fp = open(self.filename, 'rb')
+        return _RecordReader(fp, offset, size), size
+
+    @contextmanager
+    def map(self, name):
+        with self._lock:
+            offset, size, crc = self._get(name)
+            fp = open(self.filename, 'rb')
+        with fp:
+            if size == 0:
+                yield b''
+                return
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            view = buffer_view(mapped, offset, offset + size)
+            try:
+                yield view
+            finally:
+                release_view(view)
+                mapped.close()
+
+    @property
+    def stats(self):
+        """Number of live ``records``, ``size`` and ``garbage`` bytes"""
+
+        with self._lock:
+            self._refresh()
+            return {'records': len(self._records),
+                    'size': self._scanned,
+                    'garbage': self._garbage}
+
+    def _get(self, name):
+        self._refresh()
+        try:
+            return self._records[name]
+        except KeyError:
+            raise _not_found(name)
+
+    def _refresh(self):
+        """Pick up the changes made since we last looked"""
+
+        try:
+            st = os.stat(self.filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._reset()
+            return
+
+        if st.st_ino != self._inode or st.st_size < self._scanned:
+            # Replaced (eg. compacted) by someone else
+            self._reset()
+            self._fp = open(self.filename, 'rb')
+            self._inode = os.fstat(self._fp.fileno()).st_ino
+            header = self._fp.read(len(PACK_HEADER))
+            if header != PACK_HEADER:
+                raise PackFormatError("Not a pack file, or unsupported "
+                                      "version: {0}".format(self.filename))
+            self._scanned = len(PACK_HEADER)
+        if st.st_size > self._scanned:
+            self._scan(st.st_size)
+
+    def _reset(self):
+        if self._fp is not None:
+            self._fp.close()
+        self._fp = None
+        self._inode = None
+        self._scanned = 0
+        self._records = {}
+        self._garbage = 0
+
+    def _scan(self, end):
+        """
+        Read the record headers from where we stopped, up to ``end``.
+        An incomplete last record (being written, or left by a crash)
+        is not taken into account.
+        """
+
+        fp = self._fp
+        pos = self._scanned
+        fp.seek(pos)
+        while pos + RECORD_HEADER.size <= end:
+            kind, name_size, size, crc = RECORD_HEADER.unpack(
+                fp.read(RECORD_HEADER.size))
+            data_offset = pos + RECORD_HEADER.size + name_size
+            if data_offset + size > end:
+                break
+            name = fp.read(name_size).decode('utf-8')
+            old = self._records.pop(name, None)
+            if old is not None:
+                self._garbage += RECORD_HEADER.size + name_size + old[1]
+            if kind == RECORD_PUT:
+                self._records[name] = (data_offset, size, crc)
+            elif kind == RECORD_DELETE:
+                self._garbage += RECORD_HEADER.size + name_size
+            else:
+                raise PackFormatError("Invalid record at {0}".format(pos))
+            fp.seek(size, io.SEEK_CUR)
+            pos = data_offset + size
+        self._scanned = pos
+
+    # ----------------------------------------------------------------------
+    #   Writing
+
+    def write(self, name, data, atomic=False):
+        crc = zlib.crc32(data) & 0xffffffff
+        with self._appending(sync=atomic) as fp:
+            _write_record(fp, RECORD_PUT, name, len(data), crc)
+            fp.write(data)
+
+    def delete(self, name):
+        with self._appending() as fp:
+            if name not in self._records:
+                raise _not_found(name)
+            _write_record(fp, RECORD_DELETE, name, 0, 0)
+
+    def stage(self, name):
+        def _commit(staged):
+            fp = staged.fp
+            size = fp.seek(0, io.SEEK_END) or fp.tell()
+            fp.seek(0)
+            crc = 0
+            for chunk in iter(lambda: fp.read(COPY_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+            with self._appending(sync=True) as out:
+                _write_record(out, RECORD_PUT, name, size,
+                              crc & 0xffffffff)
+                fp.seek(0)
+                for chunk in iter(lambda: fp.read(COPY_CHUNK_SIZE), b''):
+                    out.write(chunk)
+
+        return StagedSecret(self.pm.keydir, 'pack-staged', _commit)
+
+    def compact(self):
+        """
+        Rewrite the pack with just the current version of each secret;
+        an empty pack is removed.
+
+        :return: the number of bytes reclaimed
+        """
+
+        with self._locked(), self._lock:
+            self._refresh()
+            before = self._scanned
+            if not self._records:
+                if self._fp is not None:
+                    os.unlink(self.filename)
+                    self._reset()
+                return before
+            dirname, basename = os.path.split(self.filename)
+            fd, tmpname = tempfile.mkstemp(dir=dirname,
+                                           prefix=basename + '.')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    out.write(PACK_HEADER)
+                    for name in sorted(self._records):
+                        data = self.read(name)
+                        _write_record(out, RECORD_PUT, name, len(data),
+                                      zlib.crc32(data) & 0xffffffff)
+                        out.write(data)
+                    out.flush()
+                    os.fsync(out.fileno())
+                    after = out.tell()
+                os.rename(tmpname, self.filename)
+            except Exception:
+                os.unlink(tmpname)
+                raise
+            self._reset()
+        return before - after
+
+    @contextmanager
+    def _appending(self, sync=False):
+        """
+        Lock the pack and get it, open for appending.  Leftovers of
+        an interrupted write are truncated first.
+        """
+
+        with self._locked(), self._lock:
+            self._refresh()
+            if self._fp is None:
+                with open(self.filename, 'wb') as fp:
+                    fp.write(PACK_HEADER)
+                self._refresh()
+            with open(self.filename, 'r+b') as fp:
+                fp.truncate(self._scanned)
+                fp.seek(self._scanned)
+                yield fp
+                fp.flush()
+                if sync:
+                    os.fsync(fp.fileno())
+            self._scan(os.stat(self.filename).st_size)
+
+    @contextmanager
+    def _locked(self):
+        lock_filename = self.lock_filename
+        if lock_filename is None:
+            ensure_gitignored(self.pm.keydir, ['/.pack.lock'])
+            lock_filename = os.path.join(self.pm.keydir, '.pack.lock')
+        with open(lock_filename, 'a') as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+class _RecordReader(object):
+    """File-like object reading a single record of a pack"""
+
+    def __init__(self, fp, offset, size):
+        self._fp = fp
+        self._remaining = size
+        fp.seek(offset)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fp.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._fp.close()
+
+    @property
+    def closed(self):
+        return self._fp.closed
+
+
+def _write_record(fp, kind, name, size, crc):
+    name = name.encode('utf-8')
+    fp.write(RECORD_HEADER.pack(kind, len(name), size, crc) + name)
+
+
+def _makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+STORAGE_BACKENDS = {
+    DirectoryStorage.name: DirectoryStorage,
+    PackedStorage.name: PackedStorage,
+}
+
+
+def get_storage(name, pm):
+    """Get a storage backend for ``pm``, by name"""
+
+    try:
+        return STORAGE_BACKENDS[name](pm)
+    except KeyError:
+        raise PasswordManagerException(
+            "Unknown storage backend: {0}".format(name))
@@ -0,0 +1,268 @@
+"""
+File-like objects to read / write secrets in chunks.
+
+Large secrets (certificate bundles, keystores, ..) can be streamed
+through these, without ever holding the whole plaintext or ciphertext
+in memory.  The on-disk format is the same one produced by
+:py:meth:`~password_manager.PasswordManager.aes_encrypt`.
+"""
+
+import hmac
+import mmap
+import os
+
+from Crypto.Cipher import AES
+
+from password_manager import aes_key_id, fileformat
+from password_manager.fileformat import HEADER_SIZE, TAG_SIZE
+from password_manager.utils import buffer_view, release_view
+
+CHUNK_SIZE = 64 * 1024
+
+
+def decrypt_into(key, data, output, chunk_size=CHUNK_SIZE):
+    """
+    Decrypt an encrypted secret into a preallocated buffer.
+
+    :param data:
+        the encrypted secret, as any object supporting
+        the buffer interface, eg. a ``mmap``
+    :param output:
+        writable buffer (eg. a ``bytearray``), of exactly
+        :py:func:`~password_manager.fileformat.plaintext_size` bytes
+    :raises password_manager.fileformat.SecretFormatError:
+        if the secret is corrupt; ``output`` is wiped in that case.
+    """
+
+    header = fileformat.parse_header(data)
+    size = fileformat.plaintext_size(len(data), header)
+    if len(output) != size:
+        raise ValueError("Output buffer must be {0} bytes long"
+                         .format(size))
+
+    if header is None:
+        offset = fileformat.LEGACY_IV_SIZE
+        if len(data) < offset:
+            raise fileformat.SecretFormatError("Truncated secret file")
+        decryptor = None
+        cipher = AES.new(key, AES.MODE_CFB, bytes(data[:offset]))
+    else:
+        offset = HEADER_SIZE
+        if len(data) < HEADER_SIZE + TAG_SIZE:
+            raise fileformat.SecretFormatError("Truncated secret file")
+        decryptor = fileformat.Decryptor(key, header)
+        cipher = decryptor.cipher
+
+    # When reading from a mmap, drop the pages we are done with, so
+    # they don't count towards our resident set (Python 3.8+).
+    advise = getattr(data, 'madvise', None)
+    if getattr(mmap, 'MADV_DONTNEED', None) is None:
+        advise = None
+    dropped = 0
+
+    for start in range(0, size, chunk_size):
+        end = min(start + chunk_size, size)
+        chunk = buffer_view(data, offset + start, offset + end)
+        try:
+            if decryptor is not None:
+                decryptor.mac.update(chunk)
+            _decrypt_chunk(cipher, chunk, output, start, end)
+        finally:
+            release_view(chunk)
+
+        if advise is not None:
+            done = (offset + end) // mmap.PAGESIZE * mmap.PAGESIZE
+            if done > dropped:
+                advise(mmap.MADV_DONTNEED, dropped, done - dropped)
+                dropped = done
+
+    if decryptor is not None:
+        try:
+            decryptor.finalize(data[offset + size:])
+        except fileformat.SecretFormatError:
+            output[:] = bytearray(size)
+            raise
+
+
+def _decrypt_chunk(cipher, chunk, output, start, end):
+    target = memoryview(output)[start:end]
+    try:
+        # pycryptodome can decrypt in place, straight into the output
+        cipher.decrypt(chunk, output=target)
+    except TypeError:
+        output[start:end] = cipher.decrypt(chunk)
+    finally:
+        release_view(target)
+
+
+class SecretReader(object):
+    """
+    Decrypt a secret file, a chunk at a time.
+
+    The authentication tag can only be checked at the end of the
+    file: :py:class:`~password_manager.fileformat.SecretFormatError`
+    is raised by the read returning the last chunk, if the secret
+    is corrupt.
+    """
+
+    def __init__(self, fp, key, chunk_size=CHUNK_SIZE, size=None):
+        """
+        :param fp: file object, positioned at the start of the secret
+        :param size: size of the secret (defaults to the file size)
+        """
+        if size is None:
+            size = os.fstat(fp.fileno()).st_size
+        self._fp = fp
+        self.chunk_size = chunk_size
+        head = fp.read(HEADER_SIZE)
+        header = fileformat.parse_header(head)
+        if header is None:
+            iv_size = fileformat.LEGACY_IV_SIZE
+            self._decryptor = None
+            self._cipher = AES.new(key, AES.MODE_CFB, head[:iv_size])
+            self._pending = self._cipher.decrypt(head[iv_size:])
+        else:
+            self._decryptor = fileformat.Decryptor(key, header)
+            self._pending = b''
+            self._remaining = size - HEADER_SIZE - TAG_SIZE
+            if self._remaining < 0:
+                raise fileformat.SecretFormatError("Truncated secret file")
+            self._verified = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(self.chunk_size), b''))
+        if size == 0:
+            return b''
+        if self._pending:
+            data = self._pending[:size]
+            self._pending = self._pending[size:]
+            return data
+        if self._decryptor is None:
+            return self._cipher.decrypt(self._fp.read(size))
+
+        encrypted = b''
+        if self._remaining:
+            encrypted = self._fp.read(min(size, self._remaining))
+            if not encrypted:
+                raise fileformat.SecretFormatError("Truncated secret file")
+            self._remaining -= len(encrypted)
+        data = self._decryptor.update(encrypted)
+        if not self._remaining and not self._verified:
+            self._decryptor.finalize(self._fp.read(TAG_SIZE))
+            self._verified = True
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+    def close(self):
+        self._fp.close()
+
+    @property
+    def closed(self):
+        return self._fp.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class SecretWriter(object):
+    """
+    Encrypt data to a secret, a chunk at a time.
+
+    Data is written to a temporary file (see
+    :py:meth:`password_manager.storage.SecretStorage.stage`), which
+    replaces the secret only when the writer is closed; if an exception
+    is raised inside a ``with`` block, the secret is left untouched.
+
+    ``on_close``, if set, is called once the secret was replaced.
+
+    With ``skip_unchanged``, if the destination already contains the
+    same data (encrypted with the same key), it is not replaced, and
+    :py:attr:`written` is ``False``.  Data is compared by keyed
+    digest, so this works in constant memory.
+
+    The nonce is always random: a synthetic one would require
+    going through the data twice.
+    """
+
+    def __init__(self, storage, name, key, on_close=None,
+                 skip_unchanged=False):
+        """
+        :param storage: the :py:class:`~password_manager.storage.SecretStorage`
+        :param name: name of the secret
+        """
+        self.storage = storage
+        self.name = name
+        self.on_close = on_close
+        self.written = False
+        self._staged = storage.stage(name)
+        self._fp = self._staged.fp
+        self._key = key
+        self._encryptor = fileformat.Encryptor(key)
+        self._fp.write(self._encryptor.header)
+        self._digest = None
+        if skip_unchanged:
+            self._digest = fileformat.content_digest(key)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if self._digest is not None:
+            self._digest.update(data)
+        self._fp.write(self._encryptor.update(data))
+
+    def close(self):
+        if self._fp.closed:
+            return
+        if self._digest is not None and self._is_unchanged():
+            self.abort()
+            return
+        self._fp.write(self._encryptor.finalize())
+        self._staged.commit()
+        self.written = True
+        if self.on_close is not None:
+            self.on_close()
+
+    def _is_unchanged(self):
+        try:
+            header = fileformat.parse_header(
+                self.storage.read_header(self.name, HEADER_SIZE))
+            if header is None or header.key_id != aes_key_id(self._key):
+                return False  # Rewrite legacy and stale files
+            fp, size = self.storage.open(self.name)
+        except (IOError, fileformat.SecretFormatError):
+            return False
+        digest = fileformat.content_digest(self._key)
+        try:
+            for chunk in SecretReader(fp, self._key, size=size):
+                digest.update(chunk)
+        except fileformat.SecretFormatError:
+            return False
+        finally:
+            fp.close()
+        return hmac.compare_digest(digest.digest(), self._digest.digest())
+
+    def abort(self):
+        """Discard everything written so far"""
+
+        if self._fp.closed:
+            return
+        self._staged.abort()
+
+    @property
+    def closed(self):
+        return self._fp.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
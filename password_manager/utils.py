@@ -0,0 +1,71 @@
+"""
+Miscellaneous helpers
+"""
+
+import errno
+import os
+import tempfile
+
+
+def write_file_atomic(filename, data):
+    """
+    Replace the contents of a file atomically.
+
+    Data is written to a temporary file in the same directory,
+    which is then renamed over the destination.
+    """
+
+    dirname, basename = os.path.split(filename)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.' + basename + '.')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmpname, filename)
+    except Exception:
+        os.unlink(tmpname)
+        raise
+
+
+def ensure_gitignored(dirname, entries):
+    """
+    Make sure ``entries`` are listed in the ``.gitignore`` of
+    ``dirname`` (for local state kept in the vault).
+    """
+
+    gitignore = os.path.join(dirname, '.gitignore')
+    try:
+        with open(gitignore, 'r') as fp:
+            existing = set(fp.read().splitlines())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        existing = set()
+    missing = [x for x in entries if x not in existing]
+    if missing:
+        with open(gitignore, 'a') as fp:
+            fp.write(''.join(x + '\n' for x in missing))
+
+
+def buffer_view(data, start, end):
+    """
+    Get a read-only view of ``data[start:end]``, without copying it.
+
+    pycrypto only accepts old-style buffers on Python 2, and
+    memoryviews on Python 3; release the view (if it has a
+    ``release()`` method) once done, eg. before closing a mmap.
+    """
+
+    try:
+        return buffer(data, start, end - start)
+    except NameError:  # Python 3
+        return memoryview(data)[start:end]
+
+
+def release_view(view):
+    """Release a view returned by :py:func:`buffer_view`"""
+
+    release = getattr(view, 'release', None)
+    if release is not None:
+        release()
@@ -5,8 +5,15 @@ install_requires = [
     'pygpgme',  # For pubkey encryption via GPG
     'pycrypto',  # For symmetric crypto via AES
     'cliff',  # For the CLI
+    'futures; python_version < "3"',  # For password_manager.aio
 ]
 
+extras_require = {
+    'bench': [
+        'python-gnupg',  # To generate keys for the benchmarks
+    ],
+}
+
 dependency_links = [
     'https://github.com/rshk/pygpgme/tarball/master#egg=pygpgme-0.3.1',
 ]
@@ -28,6 +35,24 @@ entry_points = {
         'secret_put = password_manager.cli.commands:SecretPut',
         'secret_get = password_manager.cli.commands:SecretGet',
         'secret_delete = password_manager.cli.commands:SecretDelete',
+        'secret_search = password_manager.cli.commands:SecretSearch',
+        'batch = password_manager.cli.commands:Batch',
+
+        'scope_create = password_manager.cli.commands:ScopeCreate',
+        'scope_list = password_manager.cli.commands:ScopeList',
+
+        'vault_check = password_manager.cli.commands:VaultCheck',
+        'vault_fix = password_manager.cli.commands:VaultFix',
+        'vault_config = password_manager.cli.commands:VaultConfig',
+        'vault_compact = password_manager.cli.commands:VaultCompact',
+        'vault_export = password_manager.cli.commands:VaultExport',
+        'vault_import = password_manager.cli.commands:VaultImport',
+
+        'git_merge = password_manager.cli.commands:GitMerge',
+        'git_textconv = password_manager.cli.commands:GitTextconv',
+        'git_setup = password_manager.cli.commands:GitSetup',
+
+        'agent = password_manager.cli.commands:Agent',
     ],
 }
 
@@ -42,6 +67,7 @@ setup(
     description='Directory based, multi-user, password manager',
     long_description='',
     install_requires=install_requires,
+    extras_require=extras_require,
     dependency_links=dependency_links,
     # test_suite='tests',
     classifiers=[
@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+from password_manager import PasswordManager
+from password_manager.agent import (
+    AgentClient, AgentPasswordManager, AgentServer)
+
+from utils import get_password_manager
+
+
+def test_agent(tmpdir, keyfiles, monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmpdir.join('run')))
+    tmpdir.join('run').ensure(dir=True).chmod(0o700)
+
+    pm = get_password_manager(tmpdir, keyfiles)
+    pm.write_secret('secret1', 'Secret 1')
+
+    # No agent running yet
+    assert AgentClient.connect(pm.basedir) is None
+
+    server = AgentServer(pm, idle_timeout=None)
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+
+    try:
+        client = AgentClient.connect(pm.basedir)
+        assert client is not None
+
+        # The agent doesn't need GPG any more
+        pm2 = PasswordManager(pm.basedir, gpghome='/no/such/dir')
+        apm = AgentPasswordManager(client, pm2)
+
+        assert apm.read_secret('secret1') == 'Secret 1'
+        assert apm.write_secret('secret2', 'Secret 2') is True
+        assert pm.read_secret('secret2') == 'Secret 2'
+
+        # Same as PasswordManager.write_secret(): tells if it changed
+        assert apm.write_secret('secret2', 'Secret 2') is False
+
+        with apm.open_secret('secret3', 'wb') as fp:
+            fp.write('Secret 3')
+        assert apm.open_secret('secret3').read() == 'Secret 3'
+
+        assert len(list(apm.list_secrets())) == 4
+        apm.delete_secret('secret3')
+        assert len(list(apm.list_secrets())) == 3
+
+        with pytest.raises(IOError):
+            apm.read_secret('does-not-exist')
+
+        # Raw data, as used by the git merge driver
+        assert client.decrypt(pm.aes_encrypt(b'Raw')) == b'Raw'
+        encrypted = client.encrypt(b'Raw')
+        assert client.is_current(encrypted)
+        assert pm.aes_decrypt(encrypted) == b'Raw'
+
+        # The agent notices the key was regenerated
+        pm.regenerate_aes_key()
+        assert apm.read_secret('secret1') == 'Secret 1'
+        apm.write_secret('secret4', 'Secret 4')
+        assert pm.read_secret('secret4') == 'Secret 4'
+
+        client.close()
+
+    finally:
+        server.stop()
+        thread.join()
+
+    # The key was wiped from memory
+    assert server._aes_key == bytearray(len(server._aes_key))
+    assert AgentClient.connect(pm.basedir) is None
+
+
+def test_agent_ping_closed_connection(tmpdir):
+    import socket
+
+    # Something listening on the socket, hanging up right away
+    path = str(tmpdir.join('agent.sock'))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+
+    def _hang_up():
+        conn, _ = sock.accept()
+        conn.close()
+
+    thread = threading.Thread(target=_hang_up)
+    thread.start()
+    try:
+        assert AgentClient(path).ping() is None
+    finally:
+        thread.join()
+        sock.close()
@@ -0,0 +1,51 @@
+import threading
+import time
+
+from password_manager.aio import AsyncPasswordManager
+
+from utils import get_password_manager
+
+
+def test_async_password_manager(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles, key_cache_ttl=0)
+
+    unwrapped = []
+    running = []
+    _read_aes_key = pm.read_aes_key
+
+    def read_aes_key(identity):
+        unwrapped.append(identity)
+        time.sleep(.2)  # Give other requests a chance to pile up
+        return _read_aes_key(identity)
+
+    _read_secret = pm.read_secret
+    lock = threading.Lock()
+
+    def read_secret(name, key=None):
+        with lock:
+            running.append(name)
+            concurrent = len(running)
+        time.sleep(.05)
+        with lock:
+            running.remove(name)
+        assert concurrent <= 2
+        return _read_secret(name, key=key)
+
+    pm.read_aes_key = read_aes_key
+    pm.read_secret = read_secret
+
+    with AsyncPasswordManager(pm, max_concurrency=2) as apm:
+        apm.write_secret('secret1', 'Secret 1').result()
+        del unwrapped[:]
+
+        futures = [apm.read_secret('secret1') for _ in range(10)]
+        assert [f.result() for f in futures] == ['Secret 1'] * 10
+
+        # Concurrent requests shared the same unwrap
+        assert len(unwrapped) == 1
+
+        names = apm.list_secrets().result()
+        assert len(names) == 2
+
+        assert apm.delete_secret('secret1').result() is None
+        assert len(apm.list_secrets().result()) == 1
@@ -0,0 +1,53 @@
+import os
+from io import BytesIO
+
+import pytest
+
+from password_manager import PasswordManager, fileformat
+from password_manager.archive import (
+    ARCHIVE_HEADER, LENGTH, RECORD_END, RECORD_SECRET,
+    ArchiveFormatError, VaultArchive, _pack_record)
+
+from utils import get_password_manager
+
+
+def test_vault_archive(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+    os.makedirs(os.path.join(pm.basedir, 'foo'))
+    for i in range(20):
+        pm.write_secret('foo/secret{0}'.format(i), os.urandom(i * 10))
+
+    archive = BytesIO()
+    stats = VaultArchive(pm, max_workers=4).export(archive)
+    assert stats['count'] == 21
+
+    # Another vault, with its own AES key
+    other = PasswordManager(str(tmpdir.join('other')), gpghome=pm.gpghome)
+    other.setup(list(pm.list_identities()))
+    archive.seek(0)
+    stats = VaultArchive(other, max_workers=4).import_(archive)
+    assert stats['count'] == 21
+    assert stats['written'] == 20  # 'example' is the same
+    for i in range(20):
+        name = 'foo/secret{0}'.format(i)
+        assert other.read_secret(name) == pm.read_secret(name)
+
+    # Truncated archives are detected
+    data = archive.getvalue()
+    with pytest.raises(ArchiveFormatError):
+        VaultArchive(other).import_(BytesIO(data[:-10]))
+
+    # So are duplicate names
+    archive_key = pm.generate_aes_key()
+    gpg_keys = pm.resolve_gpg_keys(list(pm.list_identities())).values()
+    encrypted_key = VaultArchive(pm)._encrypt_archive_key(
+        list(gpg_keys), archive_key)
+    data = ARCHIVE_HEADER + LENGTH.pack(len(encrypted_key)) + encrypted_key
+    for record in (_pack_record(RECORD_SECRET, 0, 'dup', b'One'),
+                   _pack_record(RECORD_SECRET, 1, 'dup', b'Two'),
+                   _pack_record(RECORD_END, 2, '', b'')):
+        record = fileformat.encrypt(archive_key, record)
+        data += LENGTH.pack(len(record)) + record
+    with pytest.raises(ArchiveFormatError) as excinfo:
+        VaultArchive(other).import_(BytesIO(data))
+    assert 'Duplicate' in str(excinfo.value)
@@ -0,0 +1,31 @@
+import json
+from io import BytesIO
+
+from password_manager.batch import BatchRunner
+
+from utils import get_password_manager
+
+
+def test_batch(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+    requests = [
+        {'op': 'put', 'name': 'secret1', 'data': 'Secret 1',
+         'encoding': 'utf-8'},
+        {'op': 'get', 'name': 'secret1', 'id': 1},
+        {'op': 'get', 'name': 'missing'},
+        {'op': 'delete', 'name': 'example'},
+        {'op': 'list'},
+    ]
+    infile = BytesIO(b''.join(json.dumps(x).encode('utf-8') + b'\n'
+                              for x in requests))
+    outfile = BytesIO()
+    assert BatchRunner(pm).run(infile, outfile) == 1
+
+    responses = [json.loads(x.decode('utf-8'))
+                 for x in outfile.getvalue().splitlines()]
+    assert len(responses) == 5
+    assert responses[0] == {'ok': True, 'changed': True}
+    assert responses[1] == {'ok': True, 'id': 1, 'data': 'U2VjcmV0IDE='}
+    assert not responses[2]['ok']
+    assert responses[3] == {'ok': True}
+    assert responses[4] == {'ok': True, 'names': ['secret1']}
@@ -0,0 +1,37 @@
+from password_manager import PasswordManager
+from password_manager.context_pool import ContextPool
+
+from utils import get_gpg
+
+
+def test_context_pool_reuse(tmpdir, keyfiles):
+    gpg = get_gpg(str(tmpdir.join('gnupg')))
+    for keyname in ('key1.sec', 'key1.pub', 'key2.pub'):
+        with keyfiles.open(keyname, 'rb') as fp:
+            gpg.import_(fp)
+    privkey = list(gpg.keylist('', True))[0].subkeys[0].fpr
+
+    pool = ContextPool()
+    pm = PasswordManager(
+        str(tmpdir.join('passwords')),
+        gpghome=str(tmpdir.join('gnupg')),
+        context_pool=pool)
+    pm.setup([privkey])
+    with keyfiles.open('key2.fpr', 'r') as fp:
+        pm.add_identity(fp.read().strip())
+
+    # All the operations were sequential: only one context was created
+    assert pool.stats['misses'] == 1
+    assert pool.stats['hits'] > 0
+    assert pool.stats['idle'] == 1
+
+    # Nested checkouts (same home) get different contexts
+    with pool.context(str(tmpdir.join('gnupg'))) as ctx1:
+        with pool.context(str(tmpdir.join('gnupg'))) as ctx2:
+            assert ctx1 is not ctx2
+    assert pool.stats['misses'] == 2
+
+    # The "gpg" attribute is a context of its own, not a pool leak
+    assert pm.gpg is pm.gpg
+    assert pool.stats['misses'] == 2
+    assert pool.stats['idle'] == 2
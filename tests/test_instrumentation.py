@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from password_manager.instrumentation import (
+    CallStats, add_hook, instrumented, remove_hook)
+
+from utils import get_password_manager
+
+
+def test_instrumented():
+    @instrumented('square')
+    def square(x):
+        if x < 0:
+            raise ValueError(x)
+        return x * x
+
+    @instrumented('numbers')
+    def numbers(n):
+        for i in range(n):
+            yield i
+
+    # No hooks: plain calls
+    assert square(3) == 9
+    assert list(numbers(3)) == [0, 1, 2]
+
+    stats = CallStats()
+    add_hook(stats)
+    try:
+        assert square(3) == 9
+        assert square(4) == 16
+        with pytest.raises(ValueError):
+            square(-1)
+        assert list(numbers(3)) == [0, 1, 2]
+    finally:
+        remove_hook(stats)
+    square(5)
+
+    result = stats.to_dict()
+    assert sorted(result) == ['numbers', 'square']
+    assert result['square']['calls'] == 3
+    assert result['square']['errors'] == 1
+    assert result['numbers']['calls'] == 1
+    assert 'square' in stats.format()
+
+
+def test_call_stats_export(tmpdir):
+    stats = CallStats()
+    stats('read_secret', 0.5)
+    stats('read_secret', 1.5)
+
+    filename = str(tmpdir.join('stats.jsonl'))
+    stats.export(filename, command='secret get')
+    stats.export(filename, command='secret get')
+    with open(filename) as fp:
+        records = [json.loads(line) for line in fp]
+    assert len(records) == 2
+    assert records[0]['command'] == 'secret get'
+    item = records[0]['stats']['read_secret']
+    assert item['calls'] == 2
+    assert item['total'] == 2.0
+    assert (item['min'], item['max']) == (0.5, 1.5)
+
+
+def test_password_manager_instrumentation(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+    pm.write_secret('example', b'Hello')
+
+    stats = CallStats()
+    add_hook(stats)
+    try:
+        assert pm.read_secret('example') == b'Hello'
+        assert len(list(pm.list_secrets())) == 1
+    finally:
+        remove_hook(stats)
+
+    result = stats.to_dict()
+    for name in ('read_secret', 'get_aes_key', 'aes_decrypt',
+                 'list_secrets'):
+        assert result[name]['calls'] == 1
@@ -0,0 +1,32 @@
+from utils import get_gpg, get_password_manager
+
+
+def test_keyring_cache(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles,
+                              public_keys=('key1.pub', 'key2.pub'))
+    with keyfiles.open('key2.fpr', 'r') as fp:
+        key2_fp = fp.read().strip()
+    with keyfiles.open('key3.fpr', 'r') as fp:
+        key3_fp = fp.read().strip()
+    pm.add_identity(key2_fp)
+
+    pm.keyring_cache.clear()
+    assert len(list(pm.list_gpg_pubkeys())) == 2
+    assert len(list(pm.list_gpg_privkeys())) == 1
+    misses = pm.keyring_cache.stats['misses']
+
+    # Listings and lookups are now served from the cache
+    for i in range(3):
+        assert len(list(pm.list_gpg_pubkeys())) == 2
+        assert len(list(pm.list_gpg_privkeys())) == 1
+        assert pm.get_key_fingerprint(key2_fp) == key2_fp
+        assert sorted(pm.resolve_gpg_keys(pm.list_identities())) == \
+            sorted(pm.list_identities())
+    assert pm.keyring_cache.stats['misses'] == misses
+
+    # Changes to the keyring are noticed
+    gpg = get_gpg(str(tmpdir.join('gnupg')))
+    with keyfiles.open('key3.pub', 'rb') as fp:
+        gpg.import_(fp)
+    assert key3_fp in list(pm.list_gpg_pubkeys())
+    assert pm.get_key_fingerprint(key3_fp) == key3_fp
@@ -0,0 +1,116 @@
+import os
+import sys
+from io import BytesIO
+
+from password_manager.gitmerge import SecretCodec, merge_files, textconv
+from password_manager.merge import merge3
+
+from utils import get_password_manager
+
+BASE = b'user: alice\npassword: 1234\nurl: http://example.com\n'
+
+
+def test_merge3():
+    ours = BASE.replace(b'alice', b'bob')
+    theirs = BASE.replace(b'example.com', b'example.org') + b'notes: -\n'
+    merged, conflicts = merge3(BASE, ours, theirs)
+    assert conflicts == 0
+    assert merged == (b'user: bob\npassword: 1234\n'
+                      b'url: http://example.org\nnotes: -\n')
+
+    # Same change on both sides
+    assert merge3(BASE, ours, ours) == (ours, 0)
+
+    theirs = BASE.replace(b'alice', b'carol')
+    merged, conflicts = merge3(BASE, ours, theirs)
+    assert conflicts == 1
+    assert merged == (b'<<<<<<< ours\nuser: bob\n=======\nuser: carol\n'
+                      b'>>>>>>> theirs\npassword: 1234\n'
+                      b'url: http://example.com\n')
+
+    # Binary data is not merged
+    assert merge3(b'\0a', b'\0b', b'\0c') == (b'\0b', 1)
+    assert merge3(b'\0a', b'\0a', b'\0c') == (b'\0c', 0)
+
+
+def test_merge_files(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+    old_key = pm.get_aes_key()
+    pm.regenerate_aes_key()
+    codec = SecretCodec(pm, history=False)
+
+    def _write(name, data, key=None):
+        filename = str(tmpdir.join(name))
+        with open(filename, 'wb') as fp:
+            fp.write(pm.aes_encrypt(data, key=key))
+        return filename
+
+    # Their side is still encrypted with the old key
+    codec.add_key(old_key)
+    base = _write('base', BASE, key=old_key)
+    ours = _write('ours', BASE.replace(b'alice', b'bob'))
+    theirs = _write('theirs', BASE.replace(b'.com', b'.org'), key=old_key)
+
+    assert merge_files(codec, base, ours, theirs) == 0
+    assert textconv(codec, ours) == BASE.replace(
+        b'alice', b'bob').replace(b'.com', b'.org')
+    assert codec.is_current(open(ours, 'rb').read())
+
+    # Nothing to do, the file is left untouched
+    with open(ours, 'rb') as fp:
+        before = fp.read()
+    assert merge_files(codec, base, ours, base) == 0
+    with open(ours, 'rb') as fp:
+        assert fp.read() == before
+
+
+def test_merge_files_not_secrets(tmpdir):
+    # Not secrets (eg. a README): merged and diffed as plain files
+    codec = SecretCodec(None)
+
+    def _write(name, data):
+        filename = str(tmpdir.join(name))
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+        return filename
+
+    base = _write('base', b'a\nb\nc\n')
+    ours = _write('ours', b'A\nb\nc\n')
+    theirs = _write('theirs', b'a\nb\nC\n')
+
+    assert merge_files(codec, base, ours, theirs) == 0
+    assert textconv(codec, ours) == b'A\nb\nC\n'
+
+
+def test_git_commands_in_key_scope(tmpdir, keyfiles, monkeypatch):
+    from password_manager.cli.fast import dispatch
+
+    pm = get_password_manager(tmpdir, keyfiles)
+    os.makedirs(os.path.join(pm.basedir, 'team'))
+    scope = pm.create_scope('team', list(pm.list_identities()))
+    monkeypatch.setenv('GNUPGHOME', pm.gpghome)
+    monkeypatch.setenv('PM_AGENT_SOCK', str(tmpdir.join('no-agent.sock')))
+
+    def _write(name, data):
+        filename = str(tmpdir.join(name))
+        with open(filename, 'wb') as fp:
+            fp.write(scope.aes_encrypt(data))
+        return filename
+
+    # Encrypted with the key of the scope, not the one of the vault
+    base = _write('base', BASE)
+    ours = _write('ours', BASE.replace(b'alice', b'bob'))
+    theirs = _write('theirs', BASE.replace(b'.com', b'.org'))
+    assert dispatch(['git', 'merge', base, ours, theirs,
+                     '--pm-home', pm.basedir,
+                     '--path', 'team/secret1']) == 0
+    merged = BASE.replace(b'alice', b'bob').replace(b'.com', b'.org')
+    with open(ours, 'rb') as fp:
+        assert scope.aes_decrypt(fp.read()) == merged
+
+    scope.write_secret('secret1', merged)
+    stdout = BytesIO()
+    monkeypatch.setattr(sys, 'stdout', stdout)
+    assert dispatch(['git', 'textconv', '--pm-home', pm.basedir,
+                     pm.get_secret_filename('team/secret1')]) == 0
+    assert stdout.getvalue() == merged
@@ -0,0 +1,34 @@
+from password_manager.openpgp import dearmor, parse_keys, parse_uid
+
+
+def test_parse_keys(keyfiles):
+    for name in ('key1', 'key2'):
+        with keyfiles.open(name + '.fpr', 'r') as fp:
+            fpr = fp.read().strip()
+        with keyfiles.open(name + '.pub') as fp:
+            data = fp.read()
+
+        keys = parse_keys(data)
+        assert len(keys) == 1
+        assert keys[0].fpr == fpr
+        assert keys[0].subkeys[0].fpr == fpr
+        assert keys[0].subkeys[0].keyid == fpr[-16:]
+        assert keys[0].uids[0].name == 'Autogenerated Key'
+        assert keys[0].uids[0].email == 'samu@tr-is'
+
+        # Binary and armored data give the same result
+        assert parse_keys(dearmor(data)) == keys
+
+    # Many keys at once
+    with keyfiles.open('key1.pub') as fp1, keyfiles.open('key2.pub') as fp2:
+        data = fp1.read() + fp2.read()
+    assert len(parse_keys(data)) == 2
+    assert len(parse_keys(dearmor(data))) == 2
+
+
+def test_parse_uid():
+    uid = parse_uid('John Doe (work) <john@example.com>')
+    assert (uid.name, uid.comment, uid.email) == \
+        ('John Doe', 'work', 'john@example.com')
+    assert parse_uid('John Doe').email == ''
+    assert parse_uid('<john@example.com>').name == ''
@@ -0,0 +1,72 @@
+import os
+from io import BytesIO
+
+from password_manager import PasswordManager
+from password_manager.archive import VaultArchive
+from password_manager.batch import BatchRunner
+
+from utils import get_password_manager
+
+
+def test_key_scopes(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles,
+                              public_keys=('key1.pub', 'key2.pub'))
+    identity = list(pm.list_identities())[0]
+    os.makedirs(os.path.join(pm.basedir, 'team'))
+    pm.write_secret('team/secret1', 'Secret 1')
+    pm.write_secret('secret2', 'Secret 2')
+
+    scope = pm.create_scope('team', [identity])
+    assert pm.list_scopes() == ['team']
+    assert pm.get_scope('team/secret1') is scope
+    assert sorted(os.path.relpath(x, pm.basedir)
+                  for x in pm.list_secrets()) == ['example', 'secret2']
+    assert [os.path.relpath(x, scope.basedir)
+            for x in scope.list_secrets()] == ['secret1']
+
+    # Secret operations go to the right scope
+    assert pm.read_secret('team/secret1') == 'Secret 1'
+    pm.write_secret('team/secret3', 'Secret 3')
+    assert scope.read_secret('secret3') == 'Secret 3'
+    assert (pm.read_secret_header('team/secret3').key_id !=
+            pm.read_secret_header('secret2').key_id)
+
+    # An explicit key is passed on if it is the key of the scope,
+    # ignored if it's the key of the vault (as the agent does)
+    opened = []
+    _open_secret = scope.open_secret
+
+    def open_secret(name, mode='rb', key=None):
+        opened.append(key)
+        return _open_secret(name, mode, key=key)
+
+    scope.open_secret = open_secret
+    with pm.open_secret('team/secret3', key=scope.get_aes_key()) as fp:
+        assert fp.read() == b'Secret 3'
+    with pm.open_secret('team/secret3', key=pm.get_aes_key()) as fp:
+        assert fp.read() == b'Secret 3'
+    assert opened == [scope.get_aes_key(), None]
+    del scope.open_secret
+
+    # Changing the key of the vault leaves the scope alone
+    with open(scope.get_secret_filename('secret1'), 'rb') as fp:
+        before = fp.read()
+    pm.regenerate_aes_key()
+    with open(scope.get_secret_filename('secret1'), 'rb') as fp:
+        assert fp.read() == before
+    assert pm.read_secret('team/secret1') == 'Secret 1'
+    assert pm.read_secret('secret2') == 'Secret 2'
+
+    # Bulk operations see the secrets of the scope too
+    assert [x for x, _ in pm.iter_scopes()] == ['', 'team']
+    archive = BytesIO()
+    assert VaultArchive(pm).export(archive)['count'] == 4
+    archive.seek(0)
+    other = PasswordManager(str(tmpdir.join('other')), gpghome=pm.gpghome)
+    other.setup([identity])
+    VaultArchive(other).import_(archive)
+    assert other.read_secret('team/secret3') == 'Secret 3'
+
+    response = BatchRunner(pm).handle(b'{"op": "list"}')
+    assert response['names'] == [
+        'example', 'secret2', 'team/secret1', 'team/secret3']
@@ -0,0 +1,94 @@
+import json
+
+from password_manager.search import extract_terms
+
+from utils import get_password_manager
+
+
+def test_extract_terms():
+    secret = json.dumps({
+        'username': 'admin',
+        'password': 'secret',
+        'host': {'name': 'db1.example.com', 'port': 5432},
+        'aliases': ['db1', 'primary'],
+        'tags': ['prod', 'db'],
+    }).encode('utf-8')
+    fields, tags = extract_terms(secret)
+    assert fields == {
+        'username': ['admin'],
+        'host.name': ['db1.example.com'],
+        'host.port': ['5432'],
+        'aliases': ['db1', 'primary'],
+    }
+    assert tags == ['db', 'prod']
+
+    assert extract_terms(b'{"tags": "a, b"}') == ({}, ['a', 'b'])
+    assert extract_terms(b'Not JSON') == ({}, [])
+    assert extract_terms(b'[1, 2]') == ({}, [])
+
+
+def test_search_secrets(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+    pm.write_secret('db-prod', json.dumps({
+        'username': 'admin', 'password': 'secret',
+        'host': 'db.example.com', 'tags': ['prod']}))
+    pm.write_secret('db-staging', json.dumps({
+        'username': 'admin', 'password': 'secret',
+        'host': 'db.staging.example.com', 'tags': ['staging']}))
+
+    # The index is built on the first search
+    assert not pm.search_index.exists()
+    assert pm.search_secrets('example.com') == ['db-prod', 'db-staging']
+    assert pm.search_index.exists()
+
+    assert pm.search_secrets(fields={'host': 'STAGING'}) == ['db-staging']
+    assert pm.search_secrets(tags=['prod']) == ['db-prod']
+    assert pm.search_secrets('admin', tags=['prod']) == ['db-prod']
+    assert pm.search_secrets('secret') == []  # Passwords are not indexed
+
+    # The index is encrypted
+    with open(pm.search_index.filename, 'rb') as fp:
+        assert b'example.com' not in fp.read()
+
+    # Updated on write and delete, without reading the other secrets
+    read_secret = pm.read_secret
+    read = []
+
+    def _read_secret(name, key=None):
+        read.append(name)
+        return read_secret(name, key=key)
+
+    pm.read_secret = _read_secret
+    pm.write_secret('web', json.dumps({'url': 'https://example.com',
+                                       'tags': ['prod']}))
+    pm.delete_secret('db-prod')
+    assert pm.search_secrets(tags=['prod']) == ['web']
+    assert read == []
+
+    # Changed by other means: indexed again
+    with pm.open_secret('web', 'wb') as fp:
+        fp.write(json.dumps({'url': 'https://example.org'}).encode('utf-8'))
+    assert pm.search_secrets('example.org') == ['web']
+    assert read == ['web']
+    assert pm.search_secrets(tags=['prod']) == []
+
+    # Bulk operations save the index only once
+    search_index = pm.search_index
+    save = search_index._save
+    saved = []
+
+    def _save(data, key):
+        saved.append(len(data['secrets']))
+        return save(data, key)
+
+    search_index._save = _save
+    with pm.batch_updates():
+        for i in range(5):
+            pm.write_secret('bulk{0}'.format(i),
+                            json.dumps({'tags': ['bulk']}))
+        pm.delete_secret('bulk0')
+        assert saved == []
+    assert len(saved) == 1
+    assert pm.search_secrets(tags=['bulk']) == [
+        'bulk1', 'bulk2', 'bulk3', 'bulk4']
+    assert read == ['web']
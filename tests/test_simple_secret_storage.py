@@ -1,9 +1,11 @@
+import os
+
 import pytest
 
 from password_manager import PasswordManager, PasswordManagerException
 
 # From test utils!
-from utils import get_gpg
+from utils import get_gpg, get_password_manager
 
 
 def test_oneuser(tmpdir, keyfiles):
@@ -147,3 +149,481 @@ def test_multiple_users(tmpdir, keyfiles):
     assert pm_bob.read_secret('secret1') == secret
     with pytest.raises(PasswordManagerException):
         pm_eve.read_secret('secret1')
+
+
+def test_remove_identity_rotation_fails(tmpdir, keyfiles, monkeypatch):
+    from password_manager.rotation import KeyRotation
+
+    pm = get_password_manager(tmpdir, keyfiles,
+                              public_keys=('key1.pub', 'key2.pub'))
+    with keyfiles.open('key2.fpr', 'r') as fp:
+        key2_fp = fp.read().strip()
+    pm.add_identity(key2_fp)
+    old_key = pm.get_aes_key()
+
+    def _recrypt(self, journal):
+        raise PasswordManagerException('Something went wrong')
+
+    # The key could not be changed: the user is still there
+    monkeypatch.setattr(KeyRotation, '_recrypt', _recrypt)
+    with pytest.raises(PasswordManagerException):
+        pm.remove_identity(key2_fp)
+    assert key2_fp in pm.list_identities()
+    assert os.path.exists(pm.get_aes_key_filename(key2_fp))
+    assert pm.get_aes_key() == old_key
+
+    # Trying again finishes the job
+    monkeypatch.undo()
+    pm.remove_identity(key2_fp)
+    assert key2_fp not in pm.list_identities()
+    assert not os.path.exists(pm.get_aes_key_filename(key2_fp))
+    assert pm.get_aes_key() != old_key
+    assert pm.read_secret('example')
+
+
+def test_aes_key_cache(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+
+    unwrapped = []
+    _read_aes_key = pm.read_aes_key
+
+    def read_aes_key(identity, *args, **kwargs):
+        unwrapped.append(identity)
+        return _read_aes_key(identity, *args, **kwargs)
+
+    pm.read_aes_key = read_aes_key
+    pm.forget()
+
+    for i in range(5):
+        pm.write_secret('secret{0}'.format(i), 'Secret {0}'.format(i))
+    for i in range(5):
+        assert pm.read_secret('secret{0}'.format(i)) == 'Secret {0}'.format(i)
+    assert unwrapped == list(pm.list_identities())
+
+    # Explicitly wiping the key forces another unwrap
+    pm.forget()
+    assert pm._aes_key_cache is None
+    pm.read_secret('secret0')
+    assert len(unwrapped) == 2
+
+    # Rotating the key invalidates the cache
+    pm.regenerate_aes_key()
+    assert pm.read_secret('secret0') == 'Secret 0'
+
+    # Caching can be disabled
+    pm.key_cache_ttl = 0
+    pm.forget()
+    del unwrapped[:]
+    pm.read_secret('secret0')
+    pm.read_secret('secret1')
+    assert len(unwrapped) == 2
+
+
+def test_read_secrets(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+
+    secrets = dict(('secret{0}'.format(i), 'Secret {0}'.format(i))
+                   for i in range(20))
+    for name, secret in secrets.items():
+        pm.write_secret(name, secret)
+
+    names = sorted(secrets) + ['does-not-exist']
+    results = dict((r.name, r) for r in pm.read_secrets(names, max_workers=4))
+
+    assert sorted(results) == sorted(names)
+    for name, secret in secrets.items():
+        assert results[name].secret == secret
+        assert results[name].error is None
+    assert results['does-not-exist'].secret is None
+    assert isinstance(results['does-not-exist'].error, IOError)
+
+    # read_all() yields full paths, as list_secrets() does
+    results = list(pm.read_all())
+    assert len(results) == len(secrets) + 1  # the example secret
+    assert all(r.error is None for r in results)
+
+
+def test_key_rotation_resume_and_rollback(tmpdir, keyfiles):
+    from password_manager.rotation import KeyRotation
+
+    pm = get_password_manager(tmpdir, keyfiles)
+    for i in range(10):
+        pm.write_secret('secret{0}'.format(i), 'Secret {0}'.format(i))
+    old_key = pm.get_aes_key()
+
+    # Start a rotation, then abort it: nothing changes
+    rotation = KeyRotation(pm, max_workers=4)
+    rotation.start()
+    assert rotation.in_progress()
+    assert sorted(pm.list_secrets()) == sorted(
+        str(tmpdir.join('passwords', x))
+        for x in ['example'] + ['secret{0}'.format(i) for i in range(10)])
+    rotation.rollback()
+    assert not rotation.in_progress()
+    assert pm.get_aes_key() == old_key
+    assert pm.read_secret('secret3') == 'Secret 3'
+
+    # Start again, pretend we crashed while re-encrypting
+    rotation.start()
+    journal = rotation._read_journal()
+    rotation._recrypt(dict(journal, secrets=journal['secrets'][:5]))
+    assert len(rotation._read_done()) == 5
+    assert pm.get_aes_key() == old_key
+
+    # Running again resumes the pending rotation
+    pm.regenerate_aes_key()
+    assert not rotation.in_progress()
+    assert pm.get_aes_key() != old_key
+    for i in range(10):
+        assert pm.read_secret('secret{0}'.format(i)) == 'Secret {0}'.format(i)
+    assert not [x for x in os.listdir(pm.basedir) if 'rotate' in x]
+
+
+@pytest.mark.parametrize('storage', ['directory', 'packed'])
+def test_key_rotation_concurrent_changes(tmpdir, keyfiles, storage):
+    from password_manager.rotation import KeyRotation
+
+    pm = get_password_manager(tmpdir, keyfiles)
+    pm.migrate_storage(storage)
+    for i in range(3):
+        pm.write_secret('secret{0}'.format(i), 'Secret {0}'.format(i))
+
+    rotation = KeyRotation(pm, max_workers=4)
+    rotation.start()
+    rotation._recrypt(rotation._read_journal())
+
+    # Changed after being re-encrypted, but before the commit
+    pm.write_secret('secret0', 'Changed')
+    pm.write_secret('secret3', 'Secret 3')
+    pm.delete_secret('secret1')
+
+    rotation.resume()
+    other = PasswordManager(pm.basedir, gpghome=pm.gpghome)
+    assert other.read_secret('secret0') == 'Changed'
+    assert other.read_secret('secret2') == 'Secret 2'
+    assert other.read_secret('secret3') == 'Secret 3'
+    with pytest.raises(IOError):
+        other.read_secret('secret1')
+
+
+@pytest.mark.parametrize('storage', ['directory', 'packed'])
+def test_key_rotation_stale_secrets(tmpdir, keyfiles, storage):
+    pm = get_password_manager(tmpdir, keyfiles)
+    pm.migrate_storage(storage)
+    pm.write_secret('secret1', 'Secret 1')
+
+    # Encrypted with some older key: can't be re-encrypted
+    stale = pm.aes_encrypt(b'Stale', key=pm.generate_aes_key())
+    pm.storage.write('stale', stale)
+
+    old_key = pm.get_aes_key()
+    pm.regenerate_aes_key()
+    assert pm.get_aes_key() != old_key
+    assert pm.read_secret('secret1') == 'Secret 1'
+    assert pm.storage.read('stale') == stale
+
+
+def test_streaming_secrets(tmpdir, keyfiles):
+    from password_manager.streams import CHUNK_SIZE
+
+    pm = get_password_manager(tmpdir, keyfiles)
+
+    chunk = os.urandom(1000)
+    blob = chunk * (3 * CHUNK_SIZE // len(chunk))
+
+    with pm.open_secret('big', 'wb') as fp:
+        for i in range(0, len(blob), len(chunk)):
+            fp.write(blob[i:i + len(chunk)])
+
+    # Same format as the non-streaming API
+    assert pm.read_secret('big') == blob
+
+    with pm.open_secret('big', 'rb') as fp:
+        assert b''.join(fp) == blob
+
+    # Nothing gets written if we fail half way
+    with pytest.raises(RuntimeError):
+        with pm.open_secret('big', 'wb') as fp:
+            fp.write(b'Partial data')
+            raise RuntimeError()
+    assert pm.read_secret('big') == blob
+    assert sorted(os.listdir(pm.basedir)) == ['.keys', 'big', 'example']
+
+
+def test_read_secret_buffer(tmpdir, keyfiles):
+    from password_manager.streams import CHUNK_SIZE
+
+    pm = get_password_manager(tmpdir, keyfiles)
+
+    for size in (0, 1, 16, 17, CHUNK_SIZE, 3 * CHUNK_SIZE + 5):
+        blob = os.urandom(size)
+        pm.write_secret('blob', blob)
+        data = pm.read_secret_buffer('blob')
+        assert isinstance(data, bytearray)
+        assert data == blob
+
+
+def test_secrets_index(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+
+    def _list_secrets():
+        return sorted(os.path.relpath(x, pm.basedir)
+                      for x in pm.list_secrets())
+
+    os.makedirs(os.path.join(pm.basedir, 'foo', 'bar'))
+    pm.write_secret('foo/bar/secret1', 'Secret 1')
+    pm.write_secret('foo/secret2', 'Secret 2')
+    assert _list_secrets() == ['example', 'foo/bar/secret1', 'foo/secret2']
+    assert pm.index.get('foo/secret2')[0] == os.path.getsize(
+        pm.get_secret_filename('foo/secret2'))
+
+    # Changes made behind our back are picked up
+    os.makedirs(os.path.join(pm.basedir, 'baz'))
+    os.rename(pm.get_secret_filename('foo/bar/secret1'),
+              pm.get_secret_filename('baz/secret1'))
+    pm.delete_secret('example')
+    assert _list_secrets() == ['baz/secret1', 'foo/secret2']
+
+    # Same result as a full directory walk
+    pm.use_index = False
+    assert _list_secrets() == ['baz/secret1', 'foo/secret2']
+
+    # The index is kept out of version control
+    with open(os.path.join(pm.keydir, '.gitignore')) as fp:
+        assert '/.index' in fp.read().splitlines()
+
+
+def test_secrets_index_batch_updates(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+    list(pm.list_secrets())  # Build the index
+
+    saved = []
+    _save = pm.index._save
+
+    def _counting_save(data):
+        saved.append(sorted(data['secrets']))
+        return _save(data)
+
+    pm.index._save = _counting_save
+
+    # The index is saved once, at the end of the batch
+    with pm.batch_updates():
+        for i in range(10):
+            pm.write_secret('secret{0}'.format(i), 'Secret {0}'.format(i))
+        pm.delete_secret('example')
+        assert saved == []
+    assert len(saved) == 1
+    assert saved[0] == ['secret{0}'.format(i) for i in range(10)]
+
+    # Outside of a batch, it is saved right away
+    pm.write_secret('secret10', 'Secret 10')
+    assert len(saved) == 2
+
+
+def test_add_identities(tmpdir, keyfiles):
+    # (key4 and key5 have expired: gpg won't encrypt to them)
+    pm = get_password_manager(
+        tmpdir, keyfiles,
+        public_keys=('key1.pub', 'key2.pub', 'key3.pub'))
+
+    fingerprints = []
+    for name in ('key2.fpr', 'key3.fpr'):
+        with keyfiles.open(name, 'r') as fp:
+            fingerprints.append(fp.read().strip())
+
+    # Keys can be referred to by key id too
+    pm.add_identities([fingerprints[0], fingerprints[1][-16:]])
+
+    identities = set(pm.list_identities())
+    assert identities.issuperset(fingerprints)
+    assert len(identities) == 3
+
+    # The exported keys are the same we'd get one by one
+    for fpr in fingerprints:
+        with open(pm.get_gpg_pubkey_filename(fpr), 'rb') as fp:
+            exported = fp.read()
+        pm.store_gpg_pubkey(fpr)
+        with open(pm.get_gpg_pubkey_filename(fpr), 'rb') as fp:
+            assert fp.read() == exported
+
+    # Nothing is left behind if something fails
+    before = sorted(os.listdir(pm.keydir))
+    with pytest.raises(Exception):
+        pm.add_identities([fingerprints[0], 'no-such-user@example.com'])
+    assert sorted(os.listdir(pm.keydir)) == before
+
+
+def test_recrypt_aes_key(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles,
+                              public_keys=('key1.pub', 'key2.pub'))
+    with keyfiles.open('key2.fpr', 'r') as fp:
+        fpr = fp.read().strip()
+
+    # We need to check the key re-wrapped for key2 too
+    with keyfiles.open('key2.sec', 'rb') as fp:
+        get_gpg(pm.gpghome).import_(fp)
+    pm.add_identity(fpr)
+    pm.write_secret('example', 'Hello, world!')
+    identities = sorted(pm.list_identities())
+
+    # Everything was just written: nothing to do
+    result = pm.recrypt_aes_key()
+    assert result == {'rewritten': [], 'skipped': identities}
+
+    # A tampered key file is rewritten
+    with open(pm.get_aes_key_filename(fpr), 'ab') as fp:
+        fp.write(b'garbage')
+    result = pm.recrypt_aes_key()
+    assert result['rewritten'] == [fpr]
+    pm.forget()
+    assert pm.read_aes_key(fpr) == pm.get_aes_key()
+
+    # So is one with no metadata
+    os.unlink(pm.get_aes_key_meta_filename(fpr))
+    assert pm.recrypt_aes_key()['rewritten'] == [fpr]
+
+    assert pm.recrypt_aes_key(force=True)['rewritten'] == identities
+    assert pm.read_secret('example') == 'Hello, world!'
+
+
+def test_secret_file_format(tmpdir, keyfiles):
+    from Crypto.Cipher import AES
+    from password_manager import aes_key_id
+    from password_manager.fileformat import SecretFormatError, WrongKeyError
+
+    pm = get_password_manager(tmpdir, keyfiles)
+    key = pm.get_aes_key()
+
+    pm.write_secret('secret', b'Hello, world!')
+    header = pm.read_secret_header('secret')
+    assert header.key_id == aes_key_id(key)
+
+    # Tampering is detected
+    filename = pm.get_secret_filename('secret')
+    with open(filename, 'rb') as fp:
+        data = bytearray(fp.read())
+    data[-40] ^= 0x01
+    with open(filename, 'wb') as fp:
+        fp.write(data)
+    with pytest.raises(SecretFormatError):
+        pm.read_secret('secret')
+    with pytest.raises(SecretFormatError):
+        pm.read_secret_buffer('secret')
+
+    # So is the use of the wrong key
+    pm.write_secret('secret', b'Hello, world!')
+    with pytest.raises(WrongKeyError):
+        pm.read_secret('secret', key=pm.generate_aes_key())
+
+    # Files in the old format can still be read
+    iv = os.urandom(AES.block_size)
+    with open(filename, 'wb') as fp:
+        fp.write(iv + AES.new(key, AES.MODE_CFB, iv).encrypt(b'Old'))
+    assert pm.read_secret_header('secret') is None
+    assert pm.read_secret('secret') == b'Old'
+    with pm.open_secret('secret') as fp:
+        assert fp.read() == b'Old'
+
+
+def test_vault_scanner(tmpdir, keyfiles):
+    import shutil
+    from password_manager.scanner import VaultScanner
+
+    pm = get_password_manager(tmpdir, keyfiles)
+    identity = pm.get_own_identity()
+    pm.write_secret('secret1', b'Secret 1')
+
+    old_key_file = str(tmpdir.join('old.key'))
+    shutil.copy(pm.get_aes_key_filename(identity), old_key_file)
+    old_key = pm.get_aes_key()
+    pm.regenerate_aes_key()
+
+    # Eg. merged from a branch still using the old key
+    pm.write_secret('secret2', b'Secret 2', key=old_key)
+    pm.write_secret('secret3', b'Secret 3', key=pm.generate_aes_key())
+
+    scanner = VaultScanner(pm)
+    statuses, stats = scanner.scan()
+    assert stats['count'] == 4
+    assert [(x.name, x.status) for x in statuses] == [
+        ('example', 'current'),
+        ('secret1', 'current'),
+        ('secret2', 'stale'),
+        ('secret3', 'stale'),
+    ]
+
+    keys = scanner.read_key_file(old_key_file)
+    assert list(keys.values()) == [old_key]
+    result, stats = scanner.fix(statuses, keys)
+    assert result == {'fixed': ['secret2'], 'missing': ['secret3'],
+                      'failed': []}
+    assert pm.read_secret('secret2') == b'Secret 2'
+    assert [x.status for x in scanner.scan()[0]] == [
+        'current', 'current', 'current', 'stale']
+
+
+def test_skip_unchanged_secrets(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+    filename = pm.get_secret_filename('secret')
+
+    def _read_file():
+        with open(filename, 'rb') as fp:
+            return fp.read()
+
+    assert pm.write_secret('secret', b'Secret')
+    encrypted = _read_file()
+    assert not pm.write_secret('secret', b'Secret')
+    with pm.open_secret('secret', 'wb') as fp:
+        fp.write(b'Secret')
+    assert not fp.written
+    assert _read_file() == encrypted
+
+    assert pm.write_secret('secret', b'Changed')
+    assert _read_file() != encrypted
+
+    # With a deterministic IV, same data means same file
+    pm.write_config(deterministic_iv=True)
+    assert pm.aes_encrypt(b'Secret') == pm.aes_encrypt(b'Secret')
+    assert pm.aes_encrypt(b'Secret') != pm.aes_encrypt(b'Changed')
+    pm.write_secret('secret1', b'Secret')
+    pm.write_secret('secret2', b'Secret')
+    files = set()
+    for name in ('secret1', 'secret2'):
+        with open(pm.get_secret_filename(name), 'rb') as fp:
+            files.add(fp.read())
+    assert files == set([pm.aes_encrypt(b'Secret')])
+    assert PasswordManager(pm.basedir, deterministic_iv=False) \
+        .deterministic_iv is False
+
+    # The setting is noticed when changed by someone else
+    PasswordManager(pm.basedir).write_config(deterministic_iv=False)
+    assert pm.deterministic_iv is False
+
+
+def test_import_all_pubkeys(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles,
+                              public_keys=('key1.pub', 'key2.pub'))
+    with keyfiles.open('key2.fpr', 'r') as fp:
+        key2_fp = fp.read().strip()
+    pm.add_identity(key2_fp)
+
+    # User list straight from the .pub files
+    key = pm.read_gpg_pubkey(key2_fp)
+    assert key.fpr == key2_fp
+    assert key.uids[0].email == 'samu@tr-is'
+
+    # Another user, with an empty keyring
+    gpghome = str(tmpdir.join('gnupg-2'))
+    gpg = get_gpg(gpghome)
+    with keyfiles.open('key2.sec', 'rb') as fp:
+        gpg.import_(fp)
+    pm2 = PasswordManager(pm.basedir, gpghome=gpghome)
+    assert len(list(pm2.list_gpg_pubkeys())) == 1
+
+    imported = pm2.import_all_pubkeys()
+    assert sorted(imported) == sorted(pm.list_identities())
+    assert len(list(pm2.list_gpg_pubkeys())) == 2
+
+    # Nothing changed: nothing to import
+    assert pm2.import_all_pubkeys() == []
+    assert sorted(pm2.import_all_pubkeys(force=True)) == sorted(imported)
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from password_manager import PasswordManager
+from password_manager.storage import PackedStorage
+
+from utils import get_password_manager
+
+
+def test_packed_storage(tmpdir, keyfiles):
+    pm = get_password_manager(tmpdir, keyfiles)
+    pm.write_secret('secret1', 'Secret 1')
+    assert pm.migrate_storage('packed') == 2
+    assert sorted(os.listdir(pm.basedir)) == ['.keys', '.secrets.pack']
+
+    # The setting is shared: another instance uses the pack too
+    other = PasswordManager(pm.basedir, gpghome=pm.gpghome)
+    assert isinstance(other.storage, PackedStorage)
+    assert other.read_secret('secret1') == 'Secret 1'
+
+    pm.write_secret('secret1', 'Secret 1, again')
+    pm.write_secret('secret2', 'Secret 2')
+    pm.delete_secret('example')
+    assert other.read_secret('secret1') == 'Secret 1, again'
+    assert sorted(os.path.relpath(x, pm.basedir)
+                  for x in other.list_secrets()) == ['secret1', 'secret2']
+    with pytest.raises(IOError):
+        other.read_secret('example')
+
+    with pm.open_secret('secret2', 'rb') as fp:
+        assert fp.read() == b'Secret 2'
+    assert pm.read_secret_buffer('secret2') == b'Secret 2'
+
+    # Compaction drops the old versions, and nothing else
+    assert pm.storage.stats['garbage'] > 0
+    assert pm.storage.compact() > 0
+    assert pm.storage.stats['garbage'] == 0
+    assert other.read_secret('secret1') == 'Secret 1, again'
+
+    assert pm.migrate_storage('directory') == 2
+    assert sorted(os.listdir(pm.basedir)) == ['.keys', 'secret1', 'secret2']
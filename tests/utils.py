@@ -9,3 +9,25 @@ def get_gpg(home):
     ctx = gpgme.Context()
     ctx.set_engine_info(gpgme.PROTOCOL_OpenPGP, None, home)
     return ctx
+
+
+def get_password_manager(tmpdir, keyfiles, secret_key='key1.sec',
+                         public_keys=('key1.pub',), **kwargs):
+    """
+    Prepare a keyring in ``tmpdir`` and set up a password manager
+    with the (only) private key as initial user.
+    """
+
+    from password_manager import PasswordManager
+
+    gpghome = str(tmpdir.join('gnupg'))
+    gpg = get_gpg(gpghome)
+    for keyname in (secret_key,) + tuple(public_keys):
+        with keyfiles.open(keyname, 'rb') as fp:
+            gpg.import_(fp)
+    privkey = list(gpg.keylist('', True))[0].subkeys[0].fpr
+
+    pm = PasswordManager(str(tmpdir.join('passwords')),
+                         gpghome=gpghome, **kwargs)
+    pm.setup([privkey])
+    return pm